@@ -4,31 +4,105 @@ Thomas De Sa - 2025-06-04
 GNEW DOCS: gnews.io/docs/v4 
 """
 
-import requests
-from datetime import datetime, timedelta
+import os
 import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pymysql import Error
 import urllib.parse as up
+from hashlib import md5
 
 #Created modules
 from ethics_categories import ETHICS_CATEGORIES
 from config import API_KEY
 from database_functions import *
-from models import Article, pageNotInDatabaseError, APILimitReached
+from models import Article, pageNotInDatabaseError, APILimitReached, RetrievalError
+from rate_limit import TokenBucket, SharedTokenBucket, DailyQuota
+from refresh_worker import RefreshScheduler
+from categorizer import KeywordCategorizer
+from http_client import HTTPClient
+from single_flight import SingleFlight
+
+# Overridable to point the server at a local stand-in (see loadtest.py)
+GNEWS_ENDPOINT = os.environ.get("GNEWS_ENDPOINT", "https://gnews.io/api/v4/search")
+
+# GNEWS free plan: 1 request/second, 100 requests/day. Override in config.py on paid plans.
+# gnews_shared_quota keeps the daily count and the request rate in the database (api_usage,
+# rate_limits) so several server processes using the same API key share one budget and rate
+try:
+    from config import gnews_rate
+except ImportError:
+    gnews_rate = 1
+try:
+    from config import gnews_burst
+except ImportError:
+    gnews_burst = 1
+try:
+    from config import gnews_daily_quota
+except ImportError:
+    gnews_daily_quota = 100
+try:
+    from config import gnews_shared_quota
+except ImportError:
+    gnews_shared_quota = False
+
+#Max concurrent GNEWS requests when retrieving all categories
+GNEWS_WORKERS = 4
+
+#Compiled once from ETHICS_CATEGORIES, used by get_categories
+categorizer = KeywordCategorizer(ETHICS_CATEGORIES)
+
+#Cached articles older than this are refreshed
+CACHE_MAX_AGE = timedelta(days=2)
 
-GNEWS_ENDPOINT = "https://gnews.io/api/v4/search"
+#Seconds a retrieval waits for the same retrieval in another process
+RETRIEVAL_LOCK_TIMEOUT = 60
+#Retrievals in flight in this process, by (company, category, direction)
+retrievals = SingleFlight()
+
+if gnews_shared_quota:
+    gnews_limiter = SharedTokenBucket(gnews_rate, gnews_burst, "gnews", db_connection)
+else:
+    gnews_limiter = TokenBucket(gnews_rate, gnews_burst)
+gnews_quota = DailyQuota(gnews_daily_quota, "gnews", db_connection if gnews_shared_quota else None)
+#Kept-alive connections for GNEWS. Not cached, searches must be fresh. No retries: every
+#attempt is a request gnews_quota has to count, a failed query is retried by the next request
+gnews_client = HTTPClient(pool_maxsize=GNEWS_WORKERS, retries=0)
+
+
+#Started by server.py. While running, stale page-1 requests are served from the db and refreshed in the background
+refresh_scheduler = RefreshScheduler(
+    refresh=lambda company, category: get_and_store_articles(company, category, retrieve_old=False),
+    remaining_budget=lambda: gnews_quota.remaining(),
+    stale_pairs=get_stale_found,
+    max_age=CACHE_MAX_AGE)
+
+
+def gnews_budget():
+    """Remaining GNEWS budget, for monitoring and for deciding whether to spend requests"""
+    used = gnews_quota.used()
+    return {
+        "daily_limit": gnews_quota.limit,
+        "used": used,
+        "remaining": max(0, gnews_quota.limit - used),
+        "rate": gnews_limiter.rate,
+        "tokens": gnews_limiter.available(),
+    }
 
     
-def get_articles(company:str, category:str, to:datetime = None, session:requests.Session = None):
+def get_articles(company:str, category:str, to:datetime = None, session = None, check_company:bool = True, reserved:float = None):
     """Static function. Get articles form GNEWS API relating to a specific company and ethical category
 
     Args:
         company (str): Name of company
         category (str): Ethical category (relating to keys of ETHICAL_CATEGORIES dict. ethics_categories.py)
-        session (requests.Session, optional): Requests session. Defaults to None.
+        session (HTTPClient | requests.Session, optional): client to send the request with. Defaults to `gnews_client`.
+        check_company (bool, optional): check company exists in database first. Defaults to True.
+        reserved (float, optional): time.monotonic() of the rate token the caller reserved, the call is
+            already counted in `gnews_quota` (see get_articles_concurrently). Defaults to None, take both here.
     
     Raises:
-        APILimitReached: API Limit on GNEWS Reached
+        APILimitReached: API Limit on GNEWS Reached, or today's quota is used up (no request is made)
         Exception: 'Company' not in database
         
     ## Return:
@@ -40,73 +114,81 @@ def get_articles(company:str, category:str, to:datetime = None, session:requests
     articles = []
     articles_found = 0
     
-    #generated session
-    gen = False
-    
     if category not in ETHICS_CATEGORIES.keys():
         print("Invalid category")
     
-    elif not company_exists(company):
+    elif check_company and not company_exists(company):
         raise Exception(f"{company} not in database")
         
     else: 
-        #generate GNEWS API query. Doumentation here: https://gnews.io/docs/v4?python#search-endpoint
-        query = f'"{company}" AND ({" OR ".join(ETHICS_CATEGORIES[category])})'
-        print(query)
-        params = {
-            'q': query,
-            'lang': "en",
-            "apikey": API_KEY,
-            "in": "title"
-        }
-        if to:
-            params["to"] = to_iso(to)
+        params = gnews_params(company, category, to)
+
+        if reserved is None:
+            #Don't spend a request that would only return 403
+            if not gnews_quota.try_acquire():
+                raise APILimitReached("API Limit Reached - daily GNEWS quota used")
+            gnews_limiter.wait()
+        elif reserved > time.monotonic():
+            time.sleep(reserved - time.monotonic())
             
         if not session:
-            gen = True
-            session = requests.Session()
+            session = gnews_client
             
         res = session.get(GNEWS_ENDPOINT, params= params)
         
         print(f"get_articles({company}) - code: {res.status_code}")
         
         if res.ok and res.json:
-            json = res.json()
-            articles_json = json["articles"]
-            articles_found = json["totalArticles"]
-            for article in articles_json:
-                categories = get_categories(article['title'], article['description'])
-                
-                article_obj = Article(company, 
-                                    article["title"], 
-                                    article["url"], 
-                                    article["source"]["name"], 
-                                    categories,
-                                    datetime.fromisoformat(article["publishedAt"].replace("Z", "")),
-                                    article['description'])
-                articles.append(article_obj)
+            articles, articles_found = parse_articles(company, res.json())
         elif res.status_code == 403:
+            if reserved is None:
+                gnews_quota.exhaust()
             raise APILimitReached("API Limit Reached")
-        
-        if gen:
-            session.close()
 
     return articles, articles_found
 
+def gnews_params(company:str, category:str, to:datetime = None):
+    """Query parameters of a GNEWS search for company articles in category, published before `to`"""
+    #generate GNEWS API query. Doumentation here: https://gnews.io/docs/v4?python#search-endpoint
+    query = f'"{company}" AND ({" OR ".join(ETHICS_CATEGORIES[category])})'
+    print(query)
+    params = {
+        'q': query,
+        'lang': "en",
+        "apikey": API_KEY,
+        "in": "title"
+    }
+    if to:
+        params["to"] = to_iso(to)
+    return params
+
+def parse_articles(company:str, json:dict):
+    """Convert a GNEWS search response into Article objects
+
+    returns:
+        articles, found: articles in response and total articles found on the query
+    """
+    articles = []
+    for article in json["articles"]:
+        categories = get_categories(article['title'], article['description'])
+        
+        article_obj = Article(company, 
+                            article["title"], 
+                            article["url"], 
+                            article["source"]["name"], 
+                            categories,
+                            datetime.fromisoformat(article["publishedAt"].replace("Z", "")),
+                            article['description'])
+        articles.append(article_obj)
+    return articles, json["totalArticles"]
+
 def get_categories(headline:str, description:str):
-    """Get all categories for an article
+    """Get all categories for an article (see `categorizer`)
 
     Args:
         headline (str): headline
     """
-    categories = []
-    for category in ETHICS_CATEGORIES.keys():
-        
-        #if any keyword appears in description or headline
-        if any(kw.strip('"') for kw in ETHICS_CATEGORIES[category] if (kw.lower().strip('"') in description.lower() or kw.lower().strip('"') in headline.lower())):
-            categories.append(category)
-    
-    return categories
+    return categorizer.categorize(headline, description)
 
 def to_iso(date:datetime):
     """Convert datetime obj to iso format for GNEWS"""
@@ -133,6 +215,11 @@ def fetch_articles(company:str, page: int, category:str = None):
     returns:
         List of articles in page
     """
+    with request_scope():
+        return _fetch_articles(company, page, category)
+
+
+def _fetch_articles(company:str, page: int, category:str = None):
     num_articles = get_found(company, category)
     #If found not populated in db, company articles have never been retrieved
     if num_articles is None:
@@ -144,17 +231,7 @@ def fetch_articles(company:str, page: int, category:str = None):
     
     #If first page, check if needs cached articles need updating
     if page == 1:
-        timestamp = get_cache_timestamp(company, category)
-        if timestamp:
-            twodays = datetime.now()- timedelta(days=2)
-            if timestamp <= twodays:
-                get_and_store_articles(company, category, retrieve_old=False) #i.e., update
-                
-            else:
-                print("Cached articles up to date")
-        #No timestamp means articles have not been retrieved
-        else:
-            get_and_store_articles(company, category, retrieve_old=False)
+        refresh_if_stale(company, category)
     if page <= total_pages and page > 0:
         
         #I will limit the client side so that you can only request a page at a time,
@@ -177,10 +254,113 @@ def fetch_articles(company:str, page: int, category:str = None):
     
     return articles
 
+def fetch_articles_after(company:str, cursor:str = None, category:str = None):
+    """Cursor-based counterpart of `fetch_articles()`. Returns the 10 articles after `cursor`
+    (newest first) and the cursor for the next call, so a client can keep loading more
+    without page numbers or count queries.
+
+    When the stored articles run out and GNEWS found more than are stored, older ones are
+    retrieved from GNEWS once before giving up.
+
+    Args:
+        company (str): name of company
+        cursor (str, optional): cursor from the previous call, None for the first page
+        category (str, optional): category. Defaults to None.
+
+    Raises:
+        ValueError: cursor is malformed
+        Exception: Company not in databse (raised from get_articles)
+
+    returns:
+        (List of articles, next cursor). next cursor is None when there are no more articles
+    """
+    with request_scope():
+        if get_found(company, category) is None:
+            get_and_store_articles(company, category)
+
+        if not cursor:
+            refresh_if_stale(company, category)
+
+        articles, next_cursor = get_page_after(company, cursor, category)
+
+        #End of stored articles, check GNEWS for older ones if it found more than are stored
+        if next_cursor is None and num_articles_in_db(company, category=category) < (get_found(company, category) or 0):
+            total_found = get_and_store_articles(company, category, retrieve_old=True)
+            if total_found:
+                articles, next_cursor = get_page_after(company, cursor, category)
+
+    return articles, next_cursor
+
+def refresh_if_stale(company:str, category:str = None):
+    """Retrieve new articles from GNEWS if cached articles are older than two days.
+    If the refresh worker is running, the refresh is queued there and the stale articles are served
+    """
+    refresh_scheduler.record_request(company, category)
+    timestamp = get_cache_timestamp(company, category)
+    if timestamp:
+        if timestamp <= datetime.now() - CACHE_MAX_AGE:
+            if refresh_scheduler.running:
+                refresh_scheduler.request_refresh(company, category)
+            else:
+                get_and_store_articles(company, category, retrieve_old=False) #i.e., update
+            
+        else:
+            print("Cached articles up to date")
+    #No timestamp means articles have not been retrieved
+    else:
+        get_and_store_articles(company, category, retrieve_old=False)
+
 def get_and_store_articles(company:str, category:str = None, retrieve_old:bool = False):
+    """Coalesced `_get_and_store_articles()`: concurrent calls for the same (company, category, direction)
+    share one retrieval. Threads wait on the one in flight (`retrievals`), other processes on a
+    GET_LOCK named after the key, then skip the retrieval if it is no longer needed.
+    See `_get_and_store_articles()` for arguments.
+
+    returns:
+        total_found: total number of articles found
+    """
+    #Oldest stored article before waiting, if it changes another request retrieved older articles
+    oldest = None
+    if retrieve_old:
+        with db_connection() as connection:
+            oldest = get_oldest_date(company, connection, category)
+
+    key = (company.lower(), category, "old" if retrieve_old else "new")
+    try:
+        return retrievals.do(key, lambda: _get_and_store_locked(company, category, retrieve_old, oldest))
+    finally:
+        #Whoever retrieved, this thread's view of 'found' is outdated
+        forget_found(company)
+
+def retrieval_lock_name(company:str, category:str, retrieve_old:bool):
+    """GET_LOCK name of a retrieval, shared by every process (and async_server.py)"""
+    return "gnews:" + md5(f"{company.lower()}|{category}|{retrieve_old}".encode()).hexdigest()
+
+def _get_and_store_locked(company:str, category:str, retrieve_old:bool, oldest:datetime):
+    """`_get_and_store_articles()` under the key's advisory lock, unless another process did it while we waited"""
+    with advisory_lock(retrieval_lock_name(company, category, retrieve_old), RETRIEVAL_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            print(f"{company} - {category}: retrieval lock timed out, retrieving anyway")
+
+        if retrieve_old:
+            with db_connection() as connection:
+                done = get_oldest_date(company, connection, category) != oldest
+        else:
+            forget_found(company)
+            timestamp = get_cache_timestamp(company, category)
+            done = timestamp is not None and timestamp > datetime.now() - CACHE_MAX_AGE
+
+        if done:
+            print(f"{company} - {category}: already retrieved by another request")
+            forget_found(company)
+            return get_found(company, category) or 0
+
+        return _get_and_store_articles(company, category, retrieve_old)
+
+def _get_and_store_articles(company:str, category:str = None, retrieve_old:bool = False):
     """Combines `get_articles()` and `insert_articles()` and `insert_found()` into one wrapper function
     maintains one persistent db connection and retrieves articles from GNEWS and inserts all relevant article data into 
-    database.
+    database. Categories are queried concurrently and their results stored in one transaction.
     NOTE: retrieve_old toggles whether to get older articles from GNEWS (earlier than oldest in db) or check new articles
 
     Args:
@@ -189,34 +369,106 @@ def get_and_store_articles(company:str, category:str = None, retrieve_old:bool =
         retrieve_old (bool, optional): whether to retrieve old articles, other wise retrieves new ones. Defaults to None.
     
     Raises:
-        APILimitReached: Limit on GNEWS API Reached
+        APILimitReached: Limit on GNEWS API Reached (after storing the categories that succeeded)
+        RetrievalError: Some categories couldn't be retrieved (after storing the ones that succeeded)
+        Exception: Company not in database
     
     returns:
         total_found: total number of articles found
     """
-    #Only add 'to' parameter if retrieve_old is toggled
-    to = None
-    arr = ETHICS_CATEGORIES
+    arr = list(ETHICS_CATEGORIES)
     total_found = 0
+    retrieval_error = None
     if category: arr = [category]
+
+    if not company_exists(company):
+        raise Exception(f"{company} not in database")
     
     try:
         with db_connection() as connection:
             print(connection)
- 
-            for category in arr:
-                if retrieve_old: 
-                    to = get_oldest_date(company, connection, category)
-                
-                articles, found =  get_articles(company, category, to=to)
-                total_found += found
-                insert_articles(articles, connection)
-                insert_found(company, category, found, connection)
-                time.sleep(1)
-                    
-            connection.commit()
+
+            #Only add 'to' parameter if retrieve_old is toggled
+            dates = {category: get_oldest_date(company, connection, category) if retrieve_old else None for category in arr}
+
+            results, retrieval_error = get_articles_concurrently(company, dates)
+            total_found = store_results(company, results, connection)
             
     except Error as e:
         print(e)
+
+    if retrieval_error:
+        raise retrieval_error
         
     return total_found
+
+def store_results(company:str, results:dict, connection = None):
+    """Ingest GNEWS results of several categories in one transaction
+
+    Args:
+        results (dict): {category: (articles, found)}
+        connection (optional): pooled connection. Defaults to checking one out.
+
+    returns:
+        total_found: total number of articles found
+    """
+    if connection is None:
+        with db_connection() as connection:
+            return store_results(company, results, connection)
+
+    total_found = 0
+    articles = [article for category_articles, found in results.values() for article in category_articles]
+    insert_articles(articles, connection, commit=False)
+    for category, (category_articles, found) in results.items():
+        total_found += found
+        insert_found(company, category, found, connection, commit=False)
+            
+    connection.commit()
+    note_write(company)
+    return total_found
+
+def get_articles_concurrently(company:str, dates:dict):
+    """Query GNEWS for several categories in parallel, over the shared `gnews_client`.
+    Requests are scheduled by `gnews_limiter` rather than fixed sleeps. The quota and rate are
+    reserved for every category here, on the caller's connection when they are kept in the
+    database, so the worker threads don't each check out a pooled connection.
+
+    Args:
+        company (str): name of company (must exist in database)
+        dates (dict): {category: 'to' date or None}
+
+    returns:
+        results: {category: (articles, found)} of the successful queries
+        error: APILimitReached if any query hit the API limit, else RetrievalError if any other
+            query failed, else None
+    """
+    results = {}
+    limit_error = None
+    errors = {}
+    workers = max(1, min(GNEWS_WORKERS, len(dates)))
+
+    categories = list(dates)
+    granted = gnews_quota.try_acquire(len(categories))
+    if granted < len(categories):
+        limit_error = APILimitReached("API Limit Reached - daily GNEWS quota used")
+    times = gnews_limiter.reserve_times(granted)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {category: executor.submit(get_articles, company, category, dates[category], gnews_client, False, at)
+                   for category, at in zip(categories, times)}
+
+        for category, future in futures.items():
+            try:
+                results[category] = future.result()
+            except APILimitReached as e:
+                limit_error = e
+            except Exception as e: #request failed after retries, quota pool timeout...
+                print(f"get_articles({company}, {category}) failed: {e!r}")
+                errors[category] = e
+
+    if limit_error:
+        gnews_quota.exhaust()
+        return results, limit_error
+    if errors:
+        return results, RetrievalError(f"GNEWS retrieval failed for {company} - {', '.join(errors)}", errors)
+    return results, None
@@ -0,0 +1,81 @@
+"""
+Consistency check of the article_index read model against the normalized tables (articles,
+articles_companies, categories) it is built from.
+
+Articles are compared in id chunks: the rows index_rows() builds for a chunk against the
+rows stored for it. Articles whose rows differ are reported and, with --repair, rewritten.
+Each chunk is committed on its own, so the check can run next to the server.
+
+Run from /backend:
+    python article_index.py            report articles whose index rows differ
+    python article_index.py --repair   also rewrite them
+    python article_index.py --rebuild  rewrite every article's rows
+"""
+
+import sys
+import time
+
+from database_functions import db_connection, index_rows, refresh_article_index, INDEX_COLUMNS
+
+CHUNK_SIZE = 1000
+
+
+def expected_rows(cursor, start: int, end: int):
+    """article_index rows of the articles with start < id <= end, built from the normalized tables"""
+    rows = set()
+    for select in index_rows(f"a.id > {int(start)} AND a.id <= {int(end)}"):
+        cursor.execute(select)
+        rows.update(cursor.fetchall())
+    return rows
+
+
+def stored_rows(cursor, start: int, end: int):
+    """article_index rows stored for the articles with start < id <= end"""
+    cursor.execute(f"SELECT {INDEX_COLUMNS} FROM article_index WHERE id > %s AND id <= %s", (start, end))
+    return set(cursor.fetchall())
+
+
+def check(repair: bool = False, rebuild: bool = False, chunk_size: int = CHUNK_SIZE):
+    """Compare (and repair, or rebuild) article_index
+
+    Returns:
+        dict: articles checked, articles with differing rows, articles rewritten
+    """
+    totals = {"articles": 0, "mismatched": 0, "rewritten": 0}
+    start_time = time.perf_counter()
+
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM articles")
+            last = cursor.fetchall()[0][0]
+
+            for start in range(0, last, chunk_size):
+                end = start + chunk_size
+                cursor.execute("SELECT id FROM articles WHERE id > %s AND id <= %s", (start, end))
+                ids = [x[0] for x in cursor.fetchall()]
+                totals["articles"] += len(ids)
+
+                if rebuild:
+                    rewrite = ids
+                else:
+                    # id is the third column of INDEX_COLUMNS
+                    rewrite = sorted({row[2] for row in expected_rows(cursor, start, end) ^ stored_rows(cursor, start, end)})
+                    totals["mismatched"] += len(rewrite)
+                    if rewrite:
+                        print(f"ids {start + 1}-{end}: {len(rewrite)} articles differ, e.g. {rewrite[:5]}")
+                    if not repair:
+                        rewrite = []
+
+                if rewrite:
+                    refresh_article_index(cursor, rewrite)
+                    totals["rewritten"] += len(rewrite)
+                connection.commit()
+
+    print(f"Done in {time.perf_counter() - start_time:.1f}s: {totals}")
+    return totals
+
+
+if __name__ == "__main__":
+    totals = check(repair="--repair" in sys.argv, rebuild="--rebuild" in sys.argv)
+    # Non-zero exit when differences were found and left in place
+    sys.exit(1 if totals["mismatched"] > totals["rewritten"] else 0)
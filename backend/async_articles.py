@@ -0,0 +1,243 @@
+"""
+asyncio counterparts of article_functions.fetch_articles / fetch_articles_after, used by async_server.py.
+
+A cold company page queries GNEWS for every category concurrently with httpx, and while a
+request waits on GNEWS or MariaDB the event loop serves other requests, so a few cold
+requests can't starve the server the way they tie up waitress's worker threads. Rate
+limiting and the daily quota are shared with the synchronous code (gnews_limiter,
+gnews_quota). Results are ingested by article_functions.store_results in a worker thread.
+"""
+
+import time
+import asyncio
+from datetime import datetime
+
+import httpx
+
+from article_functions import (GNEWS_ENDPOINT, GNEWS_WORKERS, CACHE_MAX_AGE, RETRIEVAL_LOCK_TIMEOUT, gnews_params,
+                               parse_articles, store_results, retrieval_lock_name, gnews_limiter, gnews_quota,
+                               refresh_scheduler)
+from single_flight import AsyncSingleFlight
+from ethics_categories import ETHICS_CATEGORIES
+from models import pageNotInDatabaseError, APILimitReached, RetrievalError
+from database_functions import calculate_pages
+import async_database as db
+
+client = None
+retrievals = AsyncSingleFlight()
+_refreshing = set()  # (company, category) refreshed in the background
+
+
+def init_client():
+    """Create the httpx client, inside the server's event loop"""
+    global client
+    client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=GNEWS_WORKERS * 4,
+                                                              max_keepalive_connections=GNEWS_WORKERS))
+
+
+async def close_client():
+    if client is not None:
+        await client.aclose()
+
+
+async def get_articles(company: str, category: str, to: datetime = None, reserved: float = None):
+    """See article_functions.get_articles (the company must exist)
+
+    Raises:
+        APILimitReached: API Limit on GNEWS Reached, or today's quota is used up
+
+    returns:
+        articles, found
+    """
+    params = gnews_params(company, category.lower(), to)
+
+    if reserved is None:
+        # the quota may be kept in the database, don't block the loop on it
+        if not await asyncio.to_thread(gnews_quota.try_acquire):
+            raise APILimitReached("API Limit Reached - daily GNEWS quota used")
+        await gnews_limiter.wait_async()
+    elif reserved > time.monotonic():
+        await asyncio.sleep(reserved - time.monotonic())
+    res = await client.get(GNEWS_ENDPOINT, params=params)
+    print(f"get_articles({company}) - code: {res.status_code}")
+
+    if res.is_success:
+        return parse_articles(company, res.json())
+    if res.status_code == 403:
+        if reserved is None:
+            await asyncio.to_thread(gnews_quota.exhaust)
+        raise APILimitReached("API Limit Reached")
+    return [], 0
+
+
+async def get_and_store_articles(company: str, category: str = None, retrieve_old: bool = False):
+    """See article_functions.get_and_store_articles: concurrent requests for the same retrieval share
+    one, coalesced on this loop (`retrievals`) and across processes by the same GET_LOCK
+
+    returns:
+        total_found: total number of articles found
+    """
+    oldest = await db.get_oldest_date(company, category) if retrieve_old else None
+    key = (company.lower(), category, "old" if retrieve_old else "new")
+    return await retrievals.do(key, lambda: _get_and_store_locked(company, category, retrieve_old, oldest))
+
+
+async def _get_and_store_locked(company: str, category: str, retrieve_old: bool, oldest: datetime):
+    """See article_functions._get_and_store_locked"""
+    async with db.advisory_lock(retrieval_lock_name(company, category, retrieve_old), RETRIEVAL_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            print(f"{company} - {category}: retrieval lock timed out, retrieving anyway")
+
+        rows = await db.get_found_rows(company)
+        if retrieve_old:
+            done = await db.get_oldest_date(company, category) != oldest
+        else:
+            timestamp = db.cache_timestamp_in(rows, category)
+            done = timestamp is not None and timestamp > datetime.now() - CACHE_MAX_AGE
+
+        if done:
+            print(f"{company} - {category}: already retrieved by another request")
+            return db.found_in(rows, category) or 0
+
+        return await _get_and_store_articles(company, category, retrieve_old)
+
+
+async def _get_and_store_articles(company: str, category: str = None, retrieve_old: bool = False):
+    """See article_functions._get_and_store_articles
+
+    Raises:
+        APILimitReached: Limit on GNEWS API Reached (after storing the categories that succeeded)
+        RetrievalError: Some categories couldn't be retrieved (after storing the ones that succeeded)
+        Exception: Company not in database
+
+    returns:
+        total_found: total number of articles found
+    """
+    categories = [category] if category else list(ETHICS_CATEGORIES)
+    if not await db.company_exists(company):
+        raise Exception(f"{company} not in database")
+
+    dates = [await db.get_oldest_date(company, c) if retrieve_old else None for c in categories]
+    # Quota and rate for every category in one worker thread (one connection when kept in the database)
+    granted = await asyncio.to_thread(gnews_quota.try_acquire, len(categories))
+    times = await asyncio.to_thread(gnews_limiter.reserve_times, granted)
+    responses = await asyncio.gather(*(get_articles(company, c, to, at) for c, to, at in zip(categories, dates, times)),
+                                     return_exceptions=True)
+    responses += [APILimitReached("API Limit Reached - daily GNEWS quota used")] * (len(categories) - granted)
+
+    results = {}
+    limit_error = None
+    errors = {}
+    for c, response in zip(categories, responses):
+        if isinstance(response, APILimitReached):
+            limit_error = response
+        elif isinstance(response, Exception): #request failed after retries, quota pool timeout...
+            print(f"get_articles({company}, {c}) failed: {response!r}")
+            errors[c] = response
+        elif isinstance(response, BaseException):
+            raise response
+        else:
+            results[c] = response
+
+    total_found = await asyncio.to_thread(store_results, company, results)
+    if limit_error:
+        await asyncio.to_thread(gnews_quota.exhaust)
+        raise limit_error
+    if errors:
+        raise RetrievalError(f"GNEWS retrieval failed for {company} - {', '.join(errors)}", errors)
+    return total_found
+
+
+async def _refresh(company: str, category: str = None):
+    try:
+        await get_and_store_articles(company, category, retrieve_old=False)
+    except Exception as e:
+        print(f"refresh: {company} - {category}: {e}")
+    finally:
+        _refreshing.discard((company, category))
+
+
+async def refresh_if_stale(company: str, rows: dict, category: str = None):
+    """See article_functions.refresh_if_stale. Stale articles are served and refreshed in the
+    background, by the refresh worker if it runs, else by a task on this loop
+
+    Args:
+        rows (dict): company's get_found_rows
+
+    returns:
+        bool: True if articles were retrieved before returning (rows are outdated)
+    """
+    refresh_scheduler.record_request(company, category)
+    timestamp = db.cache_timestamp_in(rows, category)
+    if not timestamp:
+        await get_and_store_articles(company, category, retrieve_old=False)
+        return True
+    elif timestamp <= datetime.now() - CACHE_MAX_AGE:
+        if refresh_scheduler.running:
+            refresh_scheduler.request_refresh(company, category)
+        elif (company, category) not in _refreshing:
+            _refreshing.add((company, category))
+            asyncio.get_running_loop().create_task(_refresh(company, category))
+    return False
+
+
+async def fetch_articles(company: str, page: int, category: str = None):
+    """See article_functions.fetch_articles
+
+    returns:
+        (List of articles in page, company's get_found_rows after any retrieval)
+    """
+    rows = await db.get_found_rows(company)
+    num_articles = db.found_in(rows, category)
+    if num_articles is None:
+        await get_and_store_articles(company, category)
+        rows = await db.get_found_rows(company)
+        num_articles = db.found_in(rows, category)
+
+    total_pages = calculate_pages(num_articles)
+    articles = []
+
+    if page == 1 and await refresh_if_stale(company, rows, category):
+        rows = await db.get_found_rows(company)
+    if page <= total_pages and page > 0:
+        while not articles:
+            try:
+                articles = await db.get_page(company, page, category)
+            except pageNotInDatabaseError as e:
+                if e.db_pages + 1 != page:
+                    raise Exception(f"Page index too large, must be 1 greater than currently available. Currently available pages: {e.db_pages}/{total_pages}")
+
+                total_found = await get_and_store_articles(company, category, retrieve_old=True)
+                rows = await db.get_found_rows(company)
+                if total_found == 0: return [], rows
+    else:
+        if total_pages == 0:
+            return [], rows
+        raise Exception(f"Page {page} out of range for Company: {company} - Category: {category}. Total pages: {total_pages}")
+
+    return articles, rows
+
+
+async def fetch_articles_after(company: str, cursor: str = None, category: str = None):
+    """See article_functions.fetch_articles_after
+
+    returns:
+        (List of articles, next cursor, company's get_found_rows after any retrieval)
+    """
+    rows = await db.get_found_rows(company)
+    if db.found_in(rows, category) is None:
+        await get_and_store_articles(company, category)
+        rows = await db.get_found_rows(company)
+
+    if not cursor and await refresh_if_stale(company, rows, category):
+        rows = await db.get_found_rows(company)
+
+    articles, next_cursor = await db.get_page_after(company, cursor, category)
+
+    if next_cursor is None and await db.num_articles_in_db(company, category) < (db.found_in(rows, category) or 0):
+        total_found = await get_and_store_articles(company, category, retrieve_old=True)
+        rows = await db.get_found_rows(company)
+        if total_found:
+            articles, next_cursor = await db.get_page_after(company, cursor, category)
+
+    return articles, next_cursor, rows
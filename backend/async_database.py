@@ -0,0 +1,304 @@
+"""
+asyncio counterparts of the database_functions read paths, used by async_server.py.
+
+Queries run on an aiomysql pool, so a request waiting on MariaDB doesn't hold a thread.
+The SQL and row conversion are shared with database_functions (article_query,
+row_to_article...), so both servers return the same data. Writes only happen when GNEWS
+results are ingested; those stay on the synchronous pool (see async_articles.py).
+"""
+
+import asyncio
+import aiomysql
+from contextlib import asynccontextmanager
+from pymysql import Error
+
+from database_functions import (pool as sync_pool, db_pool_size, article_query, row_to_article,
+                                encode_cursor, decode_cursor, refresh_company_index, search_query, ALL_CATEGORIES,
+                                PAGE_ORDER, AFTER_CURSOR, oldest_date_query, recount_articles, stored_pages,
+                                COMPANY_SEARCH_SQL)
+from ethics_categories import ETHICS_CATEGORIES
+from models import pageNotInDatabaseError
+from cache import company_cache, search_cache, company_version, MISSING, COMPANY_VERSION_QUERY
+from search_index import company_index
+
+pool = None
+
+
+async def init_pool(size: int = db_pool_size):
+    """Create the aiomysql pool, same server and credentials as database_functions.pool"""
+    global pool
+    args = dict(sync_pool.connect_args)
+    args["db"] = args.pop("database")
+    pool = await aiomysql.create_pool(minsize=1, maxsize=size, autocommit=True, **args)
+
+
+async def close_pool():
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+
+
+def pool_stats():
+    if pool is None:
+        return {}
+    return {"size": pool.size, "free": pool.freesize, "maxsize": pool.maxsize}
+
+
+async def query(sql: str, params=()):
+    """Run sql on a pooled connection
+
+    Returns:
+        list: rows
+    """
+    async with pool.acquire() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(sql, params)
+            return await cursor.fetchall()
+
+
+@asynccontextmanager
+async def advisory_lock(name: str, timeout: float = 60):
+    """See database_functions.advisory_lock, holds a pooled connection while locked
+
+    Yields:
+        bool: True if the lock is held, False if waiting timed out
+    """
+    async with pool.acquire() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+            acquired = (await cursor.fetchone())[0] == 1
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    await cursor.execute("SELECT RELEASE_LOCK(%s)", (name, ))
+
+
+async def company_exists(company: str):
+    try:
+        return len(await query("SELECT name FROM companies WHERE name = %s", (company, ))) == 1
+    except Error as e:
+        print(e)
+        return False
+
+
+async def get_found_rows(company: str):
+    """See database_functions.get_found_rows
+
+    Returns:
+        dict: {category: (found, cache_time)}. Empty if articles on company were never retrieved
+    """
+    try:
+        rows = await query("SELECT category, found, cache_time FROM found WHERE company = %s", (company, ))
+    except Error as e:
+        print(e)
+        return {}
+    return {x[0]: (x[1], x[2]) for x in rows}
+
+
+def found_in(rows: dict, category: str = None):
+    """database_functions.get_found on rows from get_found_rows"""
+    if category:
+        row = rows.get(category)
+        return row[0] if row else 0
+    if not rows:
+        return None
+    return sum(x[0] for x in rows.values())
+
+
+def cache_timestamp_in(rows: dict, category: str = None):
+    """database_functions.get_cache_timestamp on rows from get_found_rows"""
+    if category is None:
+        timestamps = [x[1] for x in rows.values() if x[1] is not None]
+        return max(timestamps) if timestamps else None
+    row = rows.get(category)
+    return row[1] if row else None
+
+
+def all_found_in(rows: dict):
+    """database_functions.get_all_found on rows from get_found_rows"""
+    found = None
+    if rows:
+        found = {category: x[0] for category, x in rows.items()}
+        found["all"] = sum(found.values())
+    return found
+
+
+async def get_oldest_date(company: str, category: str = None):
+    """See database_functions.get_oldest_date"""
+    sql = oldest_date_query(category)
+    params = (company, category) if category else (company, )
+
+    results = await query(sql, params)
+    return results[0][0] if results else None
+
+
+async def get_article_counts(company: str):
+    """See database_functions.get_article_counts
+
+    Returns:
+        dict: {category: stored}, ALL_CATEGORIES for all articles
+    """
+    try:
+        return dict(await query("SELECT category, stored FROM article_counts WHERE company = %s", (company, )))
+    except Error as e:
+        print(e)
+        return {}
+
+
+def all_stored_in(counts: dict):
+    """database_functions.get_all_stored on counts from get_article_counts"""
+    stored = {category: counts.get(category, 0) for category in ETHICS_CATEGORIES}
+    stored["all"] = counts.get(ALL_CATEGORIES, 0)
+    return stored
+
+
+async def num_articles_in_db(company: str, category: str = None):
+    return (await get_article_counts(company)).get(category or ALL_CATEGORIES, 0)
+
+
+async def get_page(company: str, page: int, category: str = None):
+    """See database_functions.get_page
+
+    Raises:
+        pageNotInDatabaseError: Page is not contained in db
+    """
+    sql = article_query(category) + f"""
+    {PAGE_ORDER}
+    LIMIT 10 OFFSET %s"""
+    params = (company, category, (page-1)*10) if category else (company, (page-1)*10)
+
+    try:
+        result = await query(sql, params)
+        if result:
+            return [row_to_article(row) for row in result]
+
+        num_article = await num_articles_in_db(company, category)
+        if num_article > (page-1)*10:
+            # article_counts says the page is stored but it has no rows
+            num_article = await asyncio.to_thread(recount_articles, company, category)
+        db_pages = stored_pages(num_article)
+        raise pageNotInDatabaseError(
+            f"Company: {company.capitalize()} - Category: {category} - Page: {page} not contained in db.\nDatabase pages: {db_pages}\nCheck 'found' to see if GNEWS has more articles", db_pages)
+    except Error as e:
+        print(e)
+    return []
+
+
+async def get_page_after(company: str, cursor: str = None, category: str = None, size: int = 10):
+    """See database_functions.get_page_after
+
+    Raises:
+        ValueError: cursor is malformed
+
+    Returns:
+        (list[Article], str): articles in page and cursor of the next page
+    """
+    params = [company, category] if category else [company]
+    where = None
+    if cursor:
+        date, id = decode_cursor(cursor)
+        where = AFTER_CURSOR
+        params += [date, date, id]
+
+    sql = article_query(category, where=where) + f"""
+    {PAGE_ORDER}
+    LIMIT %s"""
+    params.append(size + 1)
+
+    articles = []
+    next_cursor = None
+    try:
+        result = await query(sql, params)
+        articles = [row_to_article(row) for row in result[:size]]
+        if len(result) > size:
+            last = result[size - 1]
+            next_cursor = encode_cursor(last[5], last[0])
+    except Error as e:
+        print(e)
+
+    return articles, next_cursor
+
+
+async def search_articles(text: str, company: str = None, category: str = None, start=None, end=None,
+                          cursor: str = None, size: int = 10):
+    """See database_functions.search_articles
+
+    Raises:
+        ValueError: text has no words or cursor is malformed
+
+    Returns:
+        (list[Article], str): matching articles, newest first, and cursor of the next page
+    """
+    sql, params = search_query(text, company, category, start, end, cursor, size)
+
+    articles = []
+    next_cursor = None
+    try:
+        result = await query(sql, params)
+        articles = [row_to_article(row) for row in result[:size]]
+        if len(result) > size:
+            last = result[size - 1]
+            next_cursor = encode_cursor(last[5], last[0])
+    except Error as e:
+        print(e)
+
+    return articles, next_cursor
+
+
+async def check_company_version():
+    """See database_functions.check_company_version"""
+    if not company_version.due():
+        return
+    try:
+        rows = await query(COMPANY_VERSION_QUERY)
+    except Error as e:
+        print(e)
+        return
+    company_version.seen(rows[0][0] if rows else 0)
+
+
+async def search_company_table(search: str):
+    """See database_functions.search_company_table. The index is only reloaded in a worker thread"""
+    await check_company_version()
+    if company_index.is_stale():
+        await asyncio.to_thread(refresh_company_index)
+    if not company_index.is_stale():
+        return company_index.search(search, 5)
+
+    key = search.lower()
+    names = search_cache.get(key)
+    if names is MISSING:
+        like = f"%{search}%"
+        results = await query(COMPANY_SEARCH_SQL, (search, like, search, like))
+        names = [x[0] for x in results]
+        search_cache.set(key, names)
+    return list(names)
+
+
+async def get_company_data(company: str):
+    """See database_functions.get_company_data, shares its cache
+
+    Returns:
+        list: [name, description, website, logo_url, industries]. None if company doesn't exist
+    """
+    await check_company_version()
+    key = company.lower()
+    data = company_cache.get(key)
+    if data is not MISSING:
+        return list(data)
+
+    data = None
+    try:
+        results = await query("SELECT * FROM companies c WHERE c.name = %s", (company, ))
+        if results:
+            industries = await query("SELECT industry FROM industries WHERE name = %s", (company, ))
+            data = list(results[0])
+            data.append([x[0] for x in industries])
+    except Error as e:
+        print(e)
+        return data
+
+    if data:
+        company_cache.set(key, data)
+    return list(data) if data else data
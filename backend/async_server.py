@@ -0,0 +1,164 @@
+"""
+Async (ASGI) serving mode: the same /search, /company and /articles/ API as server.py on
+Quart, with aiomysql for database reads and httpx for GNEWS (see async_database.py,
+async_articles.py).
+
+Requires the packages in requirements-async.txt. Run from /backend with an ASGI server, e.g.
+    hypercorn async_server:app --bind 0.0.0.0:8080
+or `python async_server.py` for development.
+"""
+
+import asyncio
+from datetime import datetime
+
+from quart import Quart, request, jsonify
+from quart_cors import cors
+
+import async_database as db
+import async_articles
+from article_functions import gnews_budget, refresh_scheduler
+from database_functions import refresh_company_index
+from ethics_categories import ETHICS_CATEGORIES
+from cache import cache_stats
+from models import RetrievalError
+
+app = cors(Quart(__name__))
+
+
+@app.before_serving
+async def startup():
+    await db.init_pool()
+    async_articles.init_client()
+    await asyncio.to_thread(refresh_company_index)
+    refresh_scheduler.start()
+
+
+@app.after_serving
+async def shutdown():
+    refresh_scheduler.stop(timeout=5)
+    await async_articles.close_client()
+    await db.close_pool()
+
+
+@app.get("/search") #?query
+async def search_company():
+    """Search company endpoint, see server.py"""
+    query = request.args.get("query")
+
+    if not query:
+        json = {"error": "Missing required search parameter 'query'"}
+        code = 400
+    else:
+        query = query.replace("'", "").replace('"', "")
+        json = {"results": await db.search_company_table(query)}
+        code = 200
+
+    return jsonify(json), code
+
+
+@app.get("/company/<string:company>")
+async def get_company(company):
+    data = await db.get_company_data(company)
+
+    if not data:
+        json = {"Error": "Company does not exist in database"}
+        code = 404
+    else:
+        json = {"name": data[0], "description": data[1], "website": data[2], "logo": data[3], "industries": data[4]}
+        code = 200
+
+    return jsonify(json), code
+
+
+@app.get("/articles/") #?company, page | cursor, category = none
+async def get_articles():
+    """Articles endpoint, see server.py"""
+    args = request.args
+    company = args.get("company")
+    category = args.get("category", None)
+    page = args.get("page")
+    cursor = args.get("cursor")
+
+    if category and (category.lower() == "null" or category.lower() == "none"):
+        category = None
+
+    if not (company and (page or cursor is not None)):
+        json = {"Error": f"Missing one or more required parameters: 'company', 'page' (or 'cursor')"}
+        code = 400
+
+    elif category not in ETHICS_CATEGORIES and category is not None:
+        json = {"Error": f"Category must be one of the following: {', '.join(ETHICS_CATEGORIES.keys())} or None"}
+        code = 400
+    else:
+        next_cursor = None
+        try:
+            if cursor is not None:
+                articles, next_cursor, rows = await async_articles.fetch_articles_after(company, cursor or None, category)
+            else:
+                articles, rows = await async_articles.fetch_articles(company, int(page), category)
+        except ValueError as e: #bad page number or cursor
+            json = {"Error": str(e)}
+            code = 400
+        except Exception as e:
+            if str(e)[:4] == "page":
+                code = 400
+            elif str(e)[:3] == "API":
+                code = 403
+            elif isinstance(e, RetrievalError): #stored what succeeded, try again later
+                print(e)
+                code = 502
+            else: #company doesn't exist in db
+                print(e)
+                code = 404
+            json = {"Error": str(e)}
+        else:
+            json = {"articles": [article.to_json() for article in articles], "found": db.all_found_in(rows),
+                    "stored": db.all_stored_in(await db.get_article_counts(company))}
+            if cursor is not None:
+                json["next_cursor"] = next_cursor
+            code = 200
+
+    return jsonify(json), code
+
+
+@app.get("/articles/search") #?q, company = none, category = none, from = none, to = none, cursor = none
+async def search_articles():
+    """Full-text article search, see server.py"""
+    args = request.args
+    text = args.get("q")
+    category = args.get("category", None)
+
+    if category and (category.lower() == "null" or category.lower() == "none"):
+        category = None
+
+    if not text:
+        json = {"Error": "Missing required search parameter 'q'"}
+        code = 400
+    elif category not in ETHICS_CATEGORIES and category is not None:
+        json = {"Error": f"Category must be one of the following: {', '.join(ETHICS_CATEGORIES.keys())} or None"}
+        code = 400
+    else:
+        try:
+            start = datetime.fromisoformat(args["from"]) if args.get("from") else None
+            end = datetime.fromisoformat(args["to"]) if args.get("to") else None
+            articles, next_cursor = await db.search_articles(text, args.get("company") or None, category, start, end,
+                                                             args.get("cursor") or None)
+        except ValueError as e: #bad date, cursor or query
+            json = {"Error": str(e)}
+            code = 400
+        else:
+            json = {"articles": [article.to_json() for article in articles], "next_cursor": next_cursor}
+            code = 200
+
+    return jsonify(json), code
+
+
+@app.get("/stats")
+async def get_stats():
+    """Runtime counters for monitoring, see server.py"""
+    json = {"db_pool": db.pool_stats(), "gnews": await asyncio.to_thread(gnews_budget), "cache": cache_stats(),
+            "refresh": refresh_scheduler.get_stats(), "retrievals": async_articles.retrievals.get_stats()}
+    return jsonify(json), 200
+
+if __name__ == '__main__':
+    app.run(debug=True)
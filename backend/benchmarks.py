@@ -0,0 +1,343 @@
+"""
+Benchmarks for the database and article hot paths.
+
+Run from /backend against a populated database, e.g.
+    python benchmarks.py retrieval Apple
+    python benchmarks.py ingest Apple 500
+    python benchmarks.py search app bank
+    python benchmarks.py categorize 100000
+    python benchmarks.py description fixtures_dir [Apple Walmart ...]  (companies' pages are saved first)
+    python benchmarks.py fulltext Apple 1000000 ["child labor" ...]  (seeds articles up to the count, committed)
+    python benchmarks.py fulltext_cleanup  (deletes seeded articles)
+    python benchmarks.py counts Apple
+"""
+
+import sys
+import time
+import uuid
+import os
+import random
+import tracemalloc
+from datetime import datetime, timedelta
+from statistics import median
+
+from database_functions import *
+from categorizer import KeywordCategorizer
+
+
+def questions(connection):
+    """Number of statements the server has executed for this connection's session"""
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW SESSION STATUS LIKE 'Questions'")
+        return int(cursor.fetchall()[0][1])
+
+
+def measure(fn, repeats: int = 5):
+    """Run fn on this thread's pooled connection
+
+    Returns:
+        (result, queries per call, median seconds per call)
+    """
+    times = []
+    queries = 0
+    with db_connection() as connection:
+        for _ in range(repeats):
+            before = questions(connection)
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+            # -1 for the SHOW STATUS statement itself
+            queries = questions(connection) - before - 1
+    return result, queries, median(times)
+
+
+def retrieve_articles_per_row(company: str, limit: int):
+    """Previous retrieval path: one categories query per row (N+1), kept for comparison"""
+    articles = []
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT * FROM articles a
+                JOIN articles_companies ac ON ac.id = a.id
+                WHERE company = %s ORDER BY a.published_date DESC LIMIT %s""", (company, limit))
+            for row in cursor.fetchall():
+                cursor.execute("SELECT category FROM categories WHERE id = %s", (row[0], ))
+                categories = [x[0] for x in cursor.fetchall()]
+                articles.append(Article(company, row[1], row[3], row[4], categories, row[5], row[2], retrieved=row[6]))
+    return articles
+
+
+def bench_retrieval(company: str, sizes=(10, 100, 1000)):
+    """Query count and latency of page and bulk retrieval, set-based vs per-row"""
+    print(f"{'path':<12}{'limit':>7}{'rows':>7}{'queries':>9}{'ms':>10}")
+    for size in sizes:
+        for name, fn in (("set-based", lambda: retrieve_articles(company, limit=size)),
+                         ("per-row", lambda: retrieve_articles_per_row(company, size))):
+            articles, queries, seconds = measure(fn)
+            print(f"{name:<12}{size:>7}{len(articles):>7}{queries:>9}{seconds*1000:>10.2f}")
+
+    articles, queries, seconds = measure(lambda: get_page(company, 1))
+    print(f"{'get_page(1)':<12}{10:>7}{len(articles):>7}{queries:>9}{seconds*1000:>10.2f}")
+
+
+def synthetic_articles(company: str, n: int):
+    """n articles with unique urls, a few categories each"""
+    categories = list(ETHICS_CATEGORIES)
+    now = datetime.now()
+    return [Article(company, f"Benchmark headline {i}", f"https://example.com/bench/{uuid.uuid4().hex}",
+                    "Benchmark", categories[i % 3::3], now - timedelta(minutes=i), f"Benchmark description {i}")
+            for i in range(n)]
+
+
+def insert_articles_per_row(articles: list[Article], connection):
+    """Previous ingest path: one INSERT per article, category and company link, kept for comparison"""
+    with connection.cursor() as cursor:
+        for article in articles:
+            cursor.execute("""INSERT INTO articles (title, description, url, source, published_date, retrieved)
+                VALUES (%s, %s, %s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE retrieved = NOW()""",
+                           (article.headline, article.description, article.url, article.source, article.date_published))
+            id = cursor.lastrowid
+            for category in article.categories:
+                cursor.execute("INSERT IGNORE INTO categories (id, category) VALUES (%s, %s)", (id, category))
+            cursor.execute("INSERT IGNORE INTO articles_companies (id, company) VALUES (%s, %s)", (id, article.company))
+
+
+def bench_ingest(company: str, n: int = 100):
+    """Rows/sec of batched vs per-row insert_articles. Every run is rolled back"""
+    n = int(n)
+    print(f"{'path':<12}{'articles':>9}{'queries':>9}{'ms':>10}{'rows/s':>10}")
+    for name, insert in (("batched", lambda articles, c: insert_articles(articles, c, commit=False)),
+                         ("per-row", insert_articles_per_row)):
+        with db_connection() as connection:
+            articles = synthetic_articles(company, n)
+            before = questions(connection)
+            start = time.perf_counter()
+            insert(articles, connection)
+            seconds = time.perf_counter() - start
+            queries = questions(connection) - before - 1
+            connection.rollback()
+        print(f"{name:<12}{n:>9}{queries:>9}{seconds*1000:>10.2f}{n/seconds:>10.0f}")
+
+
+def bench_search(*queries, repeats: int = 1000):
+    """Per-query latency of the in-memory search index vs the SQL LIKE path"""
+    queries = queries or ("a", "ap", "app", "bank", "motors", "xyz")
+    refresh_company_index()
+    print(f"{'query':<12}{'index us':>10}{'sql us':>10}  results")
+    for query in queries:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            names = company_index.search(query, 5)
+        index_us = (time.perf_counter() - start) / repeats * 1e6
+
+        sql_repeats = max(1, repeats // 100)
+        start = time.perf_counter()
+        for _ in range(sql_repeats):
+            sql_names = search_company_sql(query)
+        sql_us = (time.perf_counter() - start) / sql_repeats * 1e6
+
+        note = "" if names == sql_names else f" (sql: {sql_names})"
+        print(f"{query:<12}{index_us:>10.1f}{sql_us:>10.1f}  {names}{note}")
+
+
+def get_categories_per_keyword(headline: str, description: str):
+    """Previous get_categories: one substring scan per keyword per text, kept for comparison"""
+    categories = []
+    for category in ETHICS_CATEGORIES.keys():
+        if any(kw.strip('"') for kw in ETHICS_CATEGORIES[category] if (kw.lower().strip('"') in description.lower() or kw.lower().strip('"') in headline.lower())):
+            categories.append(category)
+    return categories
+
+
+def synthetic_headlines(n: int, seed: int = 0):
+    """(headline, description) pairs, about a third containing a keyword"""
+    rng = random.Random(seed)
+    words = ["company", "reports", "quarterly", "earnings", "shares", "market", "new", "product", "launch",
+             "ceo", "says", "the", "of", "in", "to", "and", "for", "amid", "growth", "investors", "analysts",
+             "expected", "billion", "deal", "acquisition", "plans", "announces", "regulators", "review"]
+    keywords = [kw.strip('"') for kws in ETHICS_CATEGORIES.values() for kw in kws]
+
+    def sentence(length):
+        sentence = [rng.choice(words) for _ in range(length)]
+        if rng.random() < 0.35:
+            sentence.insert(rng.randrange(length), rng.choice(keywords))
+        return " ".join(sentence).capitalize()
+
+    return [(sentence(10), sentence(30)) for _ in range(n)]
+
+
+def bench_categorize(n: int = 100000):
+    """Articles/sec of the compiled categorizer vs per-keyword scans, and check outputs are identical"""
+    corpus = synthetic_headlines(int(n))
+    categorizer = KeywordCategorizer(ETHICS_CATEGORIES)
+
+    results = {}
+    for name, fn in (("compiled", categorizer.categorize), ("per-keyword", get_categories_per_keyword)):
+        start = time.perf_counter()
+        results[name] = [fn(headline, description) for headline, description in corpus]
+        seconds = time.perf_counter() - start
+        print(f"{name:<12}{len(corpus)/seconds:>12.0f} articles/s")
+
+    mismatches = sum(a != b for a, b in zip(results["compiled"], results["per-keyword"]))
+    print(f"identical output: {mismatches == 0} ({mismatches} mismatches)")
+
+
+def save_description_fixtures(directory: str, companies):
+    """Save the wikipedia page of each company as directory/<company>.html, skipping saved ones"""
+    from data_collection import get_wikipedia_url, http_get
+    os.makedirs(directory, exist_ok=True)
+    for company in companies:
+        path = os.path.join(directory, f"{company}.html")
+        if os.path.exists(path):
+            continue
+        url = get_wikipedia_url(company)
+        if url:
+            res = http_get(url, timeout=10)
+            if res.status_code == 200:
+                with open(path, "wb") as f:
+                    f.write(res.content)
+
+
+def bench_description(directory: str, *companies, chunk_size: int = 16384):
+    """Parse time and peak memory of streamed vs whole-page description extraction over saved
+    wikipedia pages, and check outputs are identical. Reading the file is included in both, as
+    downloading is: the whole-page path needs all of it, the streamed one stops early"""
+    util_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "util")
+    if util_dir not in sys.path:
+        sys.path.append(util_dir)
+    from data_collection import extract_description_soup, extract_description_stream
+
+    if companies:
+        save_description_fixtures(directory, companies)
+
+    def soup(path):
+        with open(path, "rb") as f:
+            return extract_description_soup(f.read())
+
+    def stream(path):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return extract_description_stream(iter(lambda: f.read(chunk_size), ""))
+
+    paths = sorted(os.path.join(directory, x) for x in os.listdir(directory) if x.endswith(".html"))
+    print(f"{'page':<28}{'KB':>7}{'soup ms':>9}{'soup KB':>9}{'stream ms':>11}{'stream KB':>11}  identical")
+    mismatches = 0
+    for path in paths:
+        row = []
+        results = []
+        for fn in (soup, stream):
+            tracemalloc.start()
+            results.append(fn(path))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # timing without tracemalloc overhead
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                fn(path)
+                times.append(time.perf_counter() - start)
+            row += [median(times), peak]
+        identical = results[0] == results[1]
+        mismatches += not identical
+        name = os.path.basename(path)[:-5]
+        print(f"{name[:27]:<28}{os.path.getsize(path)/1024:>7.0f}{row[0]*1000:>9.1f}{row[1]/1024:>9.0f}"
+              f"{row[2]*1000:>11.1f}{row[3]/1024:>11.0f}  {identical}")
+    print(f"identical output: {mismatches == 0} ({mismatches} mismatches in {len(paths)} pages)")
+
+
+SEED_URL = "https://example.com/bench/"
+
+
+def seed_articles(company: str, total: int, batch: int = 10000):
+    """Insert synthetic articles (committed, FULLTEXT indexes only committed rows) until the
+    articles table holds `total` rows. Returns the number inserted"""
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM articles")
+            missing = max(0, total - cursor.fetchall()[0][0])
+
+        categories = list(ETHICS_CATEGORIES)
+        now = datetime.now()
+        for offset in range(0, missing, batch):
+            n = min(batch, missing - offset)
+            texts = synthetic_headlines(n, seed=offset)
+            articles = [Article(company, headline, f"{SEED_URL}{uuid.uuid4().hex}", "Benchmark",
+                                categories[i % 3::3], now - timedelta(minutes=offset + i), description)
+                        for i, (headline, description) in enumerate(texts)]
+            insert_articles(articles, connection)
+            print(f"seeded {offset + n}/{missing}")
+    return missing
+
+
+def search_articles_like(text: str, size: int = 10):
+    """Search without the FULLTEXT index: every word LIKE '%word%' in title or description (full scan)"""
+    words = text.replace('"', " ").split()
+    conditions = " AND ".join(["(a.title LIKE %s OR a.description LIKE %s)"] * len(words))
+    params = [f"%{word}%" for word in words for _ in range(2)] + [size]
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""SELECT a.id FROM articles a WHERE {conditions}
+                ORDER BY a.published_date DESC, a.id DESC LIMIT %s""", params)
+            return cursor.fetchall()
+
+
+def bench_fulltext(company: str, total: int = 1000000, *queries, repeats: int = 5):
+    """First-page latency of FULLTEXT search vs LIKE scans, after seeding the articles table up to
+    `total` rows, across companies and filtered by company"""
+    seed_articles(company, int(total))
+    queries = queries or ("child labor", "lawsuit", "emissions", '"data breach"', "union strike")
+    print(f"{'query':<16}{'fulltext ms':>12}{'+company ms':>12}{'like ms':>10}  results")
+    for text in queries:
+        results, _, fulltext = measure(lambda: search_articles(text)[0], repeats)
+        _, _, by_company = measure(lambda: search_articles(text, company)[0], repeats)
+        rows, _, like = measure(lambda: search_articles_like(text), max(1, repeats // 5))
+        print(f"{text:<16}{fulltext*1000:>12.2f}{by_company*1000:>12.2f}{like*1000:>10.2f}  {len(results)}/{len(rows)}")
+
+
+def bench_fulltext_cleanup():
+    """Delete the articles seeded by bench_fulltext"""
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            deleted = cursor.execute("DELETE FROM articles WHERE url LIKE %s", (SEED_URL + "%", ))
+        connection.commit()
+    print(f"deleted {deleted} articles")
+    rebuild_article_counts()
+
+
+def count_articles_join(company: str, category: str = None):
+    """Previous count: count(*) over the articles_companies (and categories) join, kept for comparison"""
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            if category:
+                cursor.execute("""SELECT count(*) FROM articles_companies ac
+                    JOIN categories c ON c.id = ac.id
+                    WHERE ac.company = %s AND c.category = %s""", (company, category))
+            else:
+                cursor.execute("SELECT count(*) FROM articles_companies WHERE company = %s", (company, ))
+            return cursor.fetchall()[0][0]
+
+
+def bench_counts(company: str, repeats: int = 20):
+    """Stored-article counts per category: count(*) joins vs article_counts, and check they agree"""
+    print(f"{'category':<18}{'join ms':>9}{'counts ms':>11}  stored")
+    for category in [None] + list(ETHICS_CATEGORIES):
+        joined, _, join_time = measure(lambda: count_articles_join(company, category), repeats)
+        stored, _, counts_time = measure(lambda: num_articles_in_db(company, category=category), repeats)
+        mismatch = "" if joined == stored else f"  MISMATCH: join counts {joined}, run rebuild_article_counts()"
+        print(f"{str(category):<18}{join_time * 1000:>9.2f}{counts_time * 1000:>11.2f}  {stored}{mismatch}")
+
+
+BENCHMARKS = {
+    "retrieval": bench_retrieval,
+    "ingest": bench_ingest,
+    "search": bench_search,
+    "categorize": bench_categorize,
+    "description": bench_description,
+    "fulltext": bench_fulltext,
+    "fulltext_cleanup": bench_fulltext_cleanup,
+    "counts": bench_counts,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"usage: python benchmarks.py [{'|'.join(BENCHMARKS)}] args...")
+    else:
+        BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,143 @@
+"""
+In-process caches for data that only changes when util/database_setup.py repopulates it
+(company records and company search results), plus invalidation of the company search index.
+
+Entries expire after a TTL and the least recently used entry is evicted when a cache is full.
+database_setup runs in its own process: after writing companies it bumps the 'companies' row of
+the data_versions table (COMPANY_VERSION_BUMP). Servers read that version at most every
+`company_version.interval` seconds (database_functions.check_company_version) and drop their
+company caches when it changed, so setup changes are seen within seconds, not a TTL.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from search_index import company_index
+
+MISSING = object()
+
+
+class TTLCache:
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        """
+        Args:
+            maxsize (int, optional): max entries, least recently used evicted first. Defaults to 1024.
+            ttl (float, optional): seconds an entry stays valid. Defaults to 300.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key: (expires, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        """Return cached value, or `default` (MISSING) if absent or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "evictions": self.evictions,
+            }
+
+
+class VersionWatch:
+
+    def __init__(self, on_change, interval: float = 5):
+        """Calls on_change() when a version read from the database changes
+
+        Args:
+            on_change (callable): called when a version differs from the last one seen
+            interval (float, optional): seconds between version reads. Defaults to 5.
+        """
+        self.on_change = on_change
+        self.interval = interval
+        self.version = None
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def due(self):
+        """True (for one caller) if the version should be read again"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next:
+                return False
+            self._next = now + self.interval
+            return True
+
+    def seen(self, version):
+        """Record the version read, calling on_change if it changed since the last read"""
+        with self._lock:
+            changed = self.version is not None and version != self.version
+            self.version = version
+        if changed:
+            self.on_change()
+
+
+COMPANY_VERSION_QUERY = "SELECT version FROM data_versions WHERE name = 'companies'"
+COMPANY_VERSION_BUMP = """INSERT INTO data_versions (name, version) VALUES ('companies', 1)
+    ON DUPLICATE KEY UPDATE version = version + 1"""
+
+# Company records by lower-case name (get_company_data), only companies that exist
+company_cache = TTLCache(maxsize=1024, ttl=3600)
+# Search results by lower-case query (search_company_table)
+search_cache = TTLCache(maxsize=4096, ttl=600)
+
+
+def invalidate_company_caches(company: str = None):
+    """Drop this process' cached data after companies/industries are written.
+
+    Args:
+        company (str, optional): company that changed. None drops every company.
+    """
+    if company is None:
+        company_cache.clear()
+    else:
+        company_cache.invalidate(company.lower())
+    # Any search could list the company
+    search_cache.clear()
+    company_index.mark_stale()
+
+
+# Drops every company cache when util/database_setup.py changed companies
+company_version = VersionWatch(invalidate_company_caches)
+
+
+def cache_stats():
+    return {"company": company_cache.stats(), "search": search_cache.stats()}
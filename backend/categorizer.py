@@ -0,0 +1,86 @@
+"""
+Precompiled keyword matcher for categorizing articles (see ETHICS_CATEGORIES).
+
+All keywords are compiled once into a single regex shaped like a trie, so text is scanned in
+one pass with at most one branch per character instead of one substring scan per keyword.
+Matching is case-insensitive substring matching, the same as the original per-keyword checks.
+"""
+
+import re
+
+
+def trie_pattern(words):
+    """Regex matching any of `words`, alternatives factored by common prefix
+    e.g. ["car", "carbon", "cat"] -> ca(?:r(?:bon)?|t)"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}  # end of word
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        group = "(?:" + "|".join(branches) + ")"
+        # a word ends here, the longer words are optional (greedy: longest match first)
+        return group + "?" if "" in node else group
+
+    return build(trie)
+
+
+class KeywordCategorizer:
+
+    def __init__(self, categories: dict, whole_words: bool = False):
+        """
+        Args:
+            categories (dict): {category: [keywords]}, keywords may be double-quoted
+            whole_words (bool, optional): only match keywords on word boundaries ("race" no longer
+                matches "embrace"). Defaults to False, plain substring matching.
+        """
+        self.order = list(categories)
+        keyword_categories = {}
+        for category, keywords in categories.items():
+            for keyword in keywords:
+                keyword_categories.setdefault(keyword.lower().strip('"'), set()).add(category)
+
+        # The regex reports the longest keyword starting at a position. Any other keyword starting
+        # there is a prefix of it, so each keyword carries the categories of its prefixes too
+        # (with whole_words, only prefixes that end on a word boundary inside the keyword)
+        def is_prefix(other, keyword):
+            if not keyword.startswith(other):
+                return False
+            return not whole_words or len(other) == len(keyword) or not re.match(r"\w", keyword[len(other)])
+
+        self.categories_of = {
+            keyword: frozenset().union(*(cats for other, cats in keyword_categories.items() if is_prefix(other, keyword)))
+            for keyword in keyword_categories
+        }
+
+        pattern = trie_pattern(keyword_categories)
+        if whole_words:
+            pattern = rf"\b(?:{pattern})\b"
+        self.pattern = re.compile(pattern)
+
+    def categorize(self, *texts):
+        """Get all categories whose keywords appear in any of texts
+
+        Returns:
+            list[str]: matched categories, in the order categories were given
+        """
+        # Keywords contain no newlines, so nothing matches across texts
+        text = "\n".join(x.lower() for x in texts if x)
+        found = set()
+        search = self.pattern.search
+        match = search(text)
+        while match:
+            found |= self.categories_of[match.group()]
+            if len(found) == len(self.order):
+                break
+            # resume one character later, keywords may overlap
+            match = search(text, match.start() + 1)
+
+        return [category for category in self.order if category in found]
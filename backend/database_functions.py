@@ -5,14 +5,172 @@ Functions for performing CRUD operations on database.
 ... API for database
 """
 
+import re
+import time
+import threading
+import base64
+from collections import Counter
+from datetime import datetime
+from contextlib import contextmanager
 from models import Article, pageNotInDatabaseError
-from pymysql import connect, Error
+from pymysql import Error
 from config import db_host, db_pass, db_user, db_name
 from ethics_categories import ETHICS_CATEGORIES
+from db_pool import ConnectionPool, PoolTimeout
+from replicas import ReplicaSet
+from cache import company_cache, search_cache, company_version, MISSING, COMPANY_VERSION_QUERY
+from search_index import company_index
+
+# Optional pool tuning in config.py, defaults sized for waitress' 4 worker threads + headroom
+try:
+    from config import db_pool_size
+except ImportError:
+    db_pool_size = 8
+
+# Categories are packed into one column by GROUP_CONCAT. No category contains a comma
+CATEGORY_SEPARATOR = ","
+# article_counts category of a company's total (articles in several categories count once)
+ALL_CATEGORIES = ""
+
+# Optional read replicas in config.py: db_replicas = ["host", "host:port", ...], same user, password
+# and database as the primary. See replicas.py
+try:
+    from config import db_replicas
+except ImportError:
+    db_replicas = []
+try:
+    from config import db_replica_max_lag
+except ImportError:
+    db_replica_max_lag = 5
+
+pool = ConnectionPool(size=db_pool_size, host=db_host, user=db_user, password=db_pass, database=db_name)
+
+
+def replica_pool(address: str):
+    """Pool of a replica. Short timeouts: when a replica is down or busy, reading from the primary is better than waiting"""
+    host, _, port = address.partition(":")
+    return ConnectionPool(size=db_pool_size, timeout=1, host=host, port=int(port or 3306), user=db_user,
+                          password=db_pass, database=db_name, connect_timeout=2)
+
+
+replicas = ReplicaSet({address: replica_pool(address) for address in db_replicas}, max_lag=db_replica_max_lag)
+# company (lowercase): time.time() of this process' last committed article write on it
+_written = {}
 
 
 def db_connection():
-    return connect(host=db_host, user=db_user, password=db_pass, database=db_name)
+    """Check out a pooled connection for the current thread. Use as a context manager;
+    nested calls on the same thread share one connection.
+    """
+    return pool.connection()
+
+
+def pool_stats():
+    stats = pool.get_stats()
+    if replicas.replicas:
+        stats["replication"] = replicas.get_stats()
+    return stats
+
+
+def note_write(company: str):
+    """Record a committed write of company's articles, later reads of them wait for replicas to apply it"""
+    _written[company.lower()] = time.time()
+
+
+def read_rows(query: str, params=(), company: str = None, min_rows: int = 0):
+    """Run a read on a replica that is caught up, else on the primary (see replicas.py).
+    A read failing on a replica (or waiting for one of its connections) is retried on the primary
+
+    Args:
+        company (str, optional): the read is of company's articles, and must see this process' writes on them
+        min_rows (int, optional): retry on the primary if a replica returns fewer rows, for reads where
+            a short result triggers work (a lagging replica looks like missing articles). Defaults to 0.
+
+    Returns:
+        list: rows
+    """
+    replica = replicas.choose(_written.get(company.lower(), 0.0) if company else 0.0)
+    if replica is not None:
+        try:
+            with replica.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall()
+            if len(rows) >= min_rows:
+                return rows
+            replicas.count("primary_retries")
+        except (Error, PoolTimeout) as e:
+            print(f"replica {replica.name}: {e}")
+            replicas.failed(replica, e)
+
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+
+# Per-thread state of the current request scope (see request_scope())
+_request = threading.local()
+
+
+@contextmanager
+def request_scope():
+    """Run a request's data access on a single pooled connection.
+
+    Every helper called inside the block reuses the same connection, and rows read from the
+    'found' table are memoized so get_found, get_cache_timestamp and get_all_found share one query
+    (likewise 'article_counts' rows). The memo is dropped whenever a write changes them for that company.
+    """
+    with db_connection() as connection:
+        if getattr(_request, "found", None) is not None:
+            yield connection
+            return
+
+        _request.found = {}
+        _request.counts = {}
+        try:
+            yield connection
+        finally:
+            _request.found = None
+            _request.counts = None
+
+def forget_found(company: str):
+    """Drop the memoized 'found' rows of company and, inside request_scope(), start a new read
+    snapshot on the scope's connection, so the next reads see what other threads or processes
+    have committed since (e.g. a retrieval this request waited for)
+    """
+    memo = getattr(_request, "found", None)
+    if memo is not None:
+        memo.pop(company, None)
+        _request.counts.pop(company.lower(), None)
+        with db_connection() as connection:
+            connection.commit()
+
+
+@contextmanager
+def advisory_lock(name: str, timeout: float = 60):
+    """Hold a named server-wide lock (GET_LOCK) on this thread's connection, so only one
+    process at a time runs the block for `name`
+
+    Args:
+        name (str): lock name, max 64 characters
+        timeout (float, optional): seconds to wait for the lock. Defaults to 60.
+
+    Yields:
+        bool: True if the lock is held, False if waiting timed out
+    """
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+            acquired = cursor.fetchall()[0][0] == 1
+        # New snapshot, to see what the previous holder committed
+        connection.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (name, ))
 
 # Create
 
@@ -23,70 +181,197 @@ def insert_article(article: Article):
     Args:
         article (Article): article
     """
-    with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
-        print(connection)
+    with db_connection() as connection:
+        insert_articles([article], connection)
 
-        # Ignore articles with identical urls
-        article_query = """
-        INSERT INTO articles (title, description, url, source, published_date, retrieved)
-        VALUES (%s, %s, %s, %s,%s, NOW())
-        ON DUPLICATE KEY UPDATE
-            retrieved = NOW()"""
 
-        category_query = """
-        INSERT IGNORE INTO categories (id, category)
-        VALUES (%s, %s)"""
+# Rows per multi-row INSERT/SELECT, keeps statements well under max_allowed_packet
+INSERT_BATCH_SIZE = 500
 
-        articles_companies_query = """
-        INSERT IGNORE INTO articles_companies (id, company)
-        VALUES (%s, %s)"""
 
-        with connection.cursor() as cursor:
-            cursor.execute(article_query, (article.headline, article.description,
-                            article.url, article.source, article.date_published))
+def insert_articles(articles: list[Article], connection, commit: bool = True):
+    """Insert a batch of articles, their categories and company links.
+
+    Articles are written with multi-row INSERTs, then the ids of every url (new or
+    already stored) are looked up by url_hash in one query, since lastrowid is only valid for the
+    last newly inserted row. Categories and company links are inserted set-wise.
 
-            id = cursor.lastrowid
-            for category in article.categories:
-                cursor.execute(category_query, (id, category))
+    Args:
+        articles (list[Article]): articles, may contain the same url more than once
+        connection: database connection
+        commit (bool, optional): commit when done. Defaults to True.
+    """
+    # Same url from several queries (e.g. categories): insert once, keep every category and company
+    by_url = {}
+    category_links = set()
+    company_links = set()
+    for article in articles:
+        by_url.setdefault(article.url, article)
+        for category in article.categories:
+            category_links.add((article.url, category))
+        company_links.add((article.url, article.company))
+
+    urls = list(by_url)
+    if not urls:
+        return
 
-            cursor.execute(articles_companies_query, (id, article.company))
-            print(f"{cursor.rowcount} rows affected")
+    with connection.cursor() as cursor:
+        inserted = 0
+        for i in range(0, len(urls), INSERT_BATCH_SIZE):
+            batch = [by_url[url] for url in urls[i:i + INSERT_BATCH_SIZE]]
+            # Ignore articles with identical urls
+            article_query = f"""
+            INSERT INTO articles (title, description, url, source, published_date, retrieved)
+            VALUES {", ".join(["(%s, %s, %s, %s, %s, NOW())"] * len(batch))}
+            ON DUPLICATE KEY UPDATE
+                retrieved = NOW()"""
+            params = [x for a in batch for x in (a.headline, a.description, a.url, a.source, a.date_published)]
+            inserted += cursor.execute(article_query, params)
+
+        # url_hash is the unique key (urls are TEXT)
+        ids = {}
+        for i in range(0, len(urls), INSERT_BATCH_SIZE):
+            batch = urls[i:i + INSERT_BATCH_SIZE]
+            cursor.execute(
+                f"SELECT id, url FROM articles WHERE url_hash IN ({', '.join(['UNHEX(MD5(%s))'] * len(batch))})", batch)
+            for id, url in cursor.fetchall():
+                ids[url] = id
+
+        categories = [(ids[url], category) for url, category in category_links if url in ids]
+        companies = [(ids[url], company) for url, company in company_links if url in ids]
+
+        # Links stored before this batch, to count only the new ones in article_counts
+        companies_before, categories_before = stored_links(cursor, list(set(ids.values())))
+        companies_after = {id: set(x) for id, x in companies_before.items()}
+        categories_after = {id: set(x) for id, x in categories_before.items()}
+        for id, company in companies:
+            companies_after.setdefault(id, set()).add(company)
+        for id, category in categories:
+            categories_after.setdefault(id, set()).add(category)
+
+        if categories:
+            cursor.executemany("""
+            INSERT IGNORE INTO categories (id, category)
+            VALUES (%s, %s)""", categories)
+
+        if companies:
+            cursor.executemany("""
+            INSERT IGNORE INTO articles_companies (id, company)
+            VALUES (%s, %s)""", companies)
+
+        update_article_counts(cursor, count_changes(companies_before, categories_before, companies_after, categories_after))
+        # Also for articles already stored: retrieved changed, and maybe their links
+        refresh_article_index(cursor, list(set(ids.values())))
+
+        # rowcount for ON DUPLICATE KEY UPDATE: 1 per new row, 2 per updated row
+        print(f"{len(urls)} articles written ({inserted} rows affected), {len(categories)} categories, {len(companies)} company links")
+
+    if commit:
         connection.commit()
+        for company in {company for _, company in company_links}:
+            note_write(company)
 
 
+def linked_companies(cursor, ids: list[int], lock: bool = False):
+    """Companies linked to each article
 
-def insert_articles(articles: list[Article], connection):
+    Args:
+        lock (bool, optional): also lock the article rows until commit, so concurrent writers of
+            the same articles are serialized. Defaults to False.
 
-    # Ignore articles with identical urls
-    article_query = """
-    INSERT INTO articles (title, description, url, source, published_date, retrieved)
-    VALUES ( %s, %s, %s, %s,%s, NOW())
-    ON DUPLICATE KEY UPDATE
-        retrieved = NOW()"""
+    Returns:
+        dict: {id: set(companies)}
+    """
+    companies = {}
+    for i in range(0, len(ids), INSERT_BATCH_SIZE):
+        batch = ids[i:i + INSERT_BATCH_SIZE]
+        marks = ", ".join(["%s"] * len(batch))
+        if lock:
+            cursor.execute(f"SELECT id FROM articles WHERE id IN ({marks}) FOR UPDATE", batch)
+        cursor.execute(f"SELECT id, company FROM articles_companies WHERE id IN ({marks})", batch)
+        for id, company in cursor.fetchall():
+            companies.setdefault(id, set()).add(company)
+    return companies
 
-    category_query = """
-    INSERT IGNORE INTO categories (id, category)
-    VALUES (%s, %s)"""
 
-    articles_companies_query = """
-            INSERT IGNORE INTO articles_companies (id, company)
-            VALUES (%s, %s)"""
+def stored_links(cursor, ids: list[int]):
+    """Companies and categories of articles, locking them until commit (see linked_companies)
 
-    with connection.cursor() as cursor:
-        for article in articles:
-            cursor.execute(article_query, (article.headline, article.description, article.url, article.source, article.date_published))
+    Returns:
+        (dict, dict): {id: set(companies)}, {id: set(categories)}
+    """
+    companies = linked_companies(cursor, ids, lock=True)
+    categories = {}
+    for i in range(0, len(ids), INSERT_BATCH_SIZE):
+        batch = ids[i:i + INSERT_BATCH_SIZE]
+        cursor.execute(f"SELECT id, category FROM categories WHERE id IN ({', '.join(['%s'] * len(batch))})", batch)
+        for id, category in cursor.fetchall():
+            categories.setdefault(id, set()).add(category)
+    return companies, categories
+
+
+def count_changes(companies_before: dict, categories_before: dict, companies_after: dict, categories_after: dict):
+    """Change of stored-article counts when article links go from before to after
 
-            id = cursor.lastrowid
-            for category in article.categories:
-                cursor.execute(category_query, (id, category))
+    Args:
+        companies_before, companies_after (dict): {id: set(companies)}
+        categories_before, categories_after (dict): {id: set(categories)}
 
-            cursor.execute(articles_companies_query, (id, article.company))
-            
-            print(f"{cursor.rowcount} rows affected")
-    connection.commit()
+    Returns:
+        Counter: {(company, category): change}, category ALL_CATEGORIES counts every article of company
+    """
+    changes = Counter()
+    for id in set(companies_before) | set(companies_after) | set(categories_before) | set(categories_after):
+        # Company names compare case-insensitively in the database (a link to "Apple" is one to "apple"),
+        # keep the stored spelling
+        names = {company.lower(): company for company in companies_after.get(id, ())}
+        names.update({company.lower(): company for company in companies_before.get(id, ())})
+        before = {(company.lower(), category) for company in companies_before.get(id, ())
+                  for category in categories_before.get(id, set()) | {ALL_CATEGORIES}}
+        after = {(company.lower(), category) for company in companies_after.get(id, ())
+                 for category in categories_after.get(id, set()) | {ALL_CATEGORIES}}
+        for company, category in after - before:
+            changes[(names[company], category)] += 1
+        for company, category in before - after:
+            changes[(names[company], category)] -= 1
+    return changes
+
+
+def update_article_counts(cursor, changes: Counter):
+    """Apply count_changes() to article_counts, in the caller's transaction"""
+    rows = [(company, category, change) for (company, category), change in changes.items() if change]
+    if rows:
+        cursor.executemany("""
+        INSERT INTO article_counts (company, category, stored) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE stored = stored + VALUES(stored)""", rows)
+
+    memo = getattr(_request, "counts", None)
+    if memo is not None:
+        for company, category, change in rows:
+            memo.pop(company.lower(), None)
+
+
+def rebuild_article_counts():
+    """Recompute article_counts from articles_companies and categories, in one transaction"""
+    try:
+        with db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM article_counts")
+                cursor.execute("""
+                INSERT INTO article_counts (company, category, stored)
+                SELECT company, %s, count(*) FROM articles_companies GROUP BY company""", (ALL_CATEGORIES, ))
+                cursor.execute("""
+                INSERT INTO article_counts (company, category, stored)
+                SELECT ac.company, c.category, count(*) FROM articles_companies ac
+                JOIN categories c ON c.id = ac.id
+                GROUP BY ac.company, c.category""")
+            connection.commit()
+            print("article_counts rebuilt")
+    except Error as e:
+        print(e)
 
 
-def insert_found(company: str, category: str, found: int, connection, update=True):
+def insert_found(company: str, category: str, found: int, connection, update=True, commit: bool = True):
     """Insert the # of found articles (from GNEWS) to the db
 
     Args:
@@ -94,6 +379,7 @@ def insert_found(company: str, category: str, found: int, connection, update=Tru
         category (str): Category of search
         found (int): num of found articles
         update (bool): whether to update value if found. ONLY UPDATE IF ARTICLE SEARCH HAD NO DATE RESTRICTION
+        commit (bool, optional): commit when done. Defaults to True.
     """
     if update:
         query = """
@@ -112,7 +398,11 @@ def insert_found(company: str, category: str, found: int, connection, update=Tru
     with connection.cursor() as cursor:
         cursor.execute(query, (company, category, found))
 
-    connection.commit()
+    if commit:
+        connection.commit()
+    memo = getattr(_request, "found", None)
+    if memo is not None:
+        memo.pop(company, None)
 
     print(f"Inserted {company} - {category}: {found}")
 
@@ -127,57 +417,103 @@ def retrieve_articles(company: str, category: str = None, limit: int = None):
     """
 
     articles = []
-    try:
-        with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
-            print(connection)
-            if category:
-                query = """
-                SELECT * FROM articles a
-                JOIN categories ON categories.id = a.id
-                JOIN articles_companies ac ON ac.id = a.id
-                WHERE company = %s AND category = %s
-                ORDER BY published_date DESC
-                """
-                params = (company, category)
-            else:
-                query = """SELECT * 
-                FROM articles 
-                JOIN articles_companies ac ON articles.id = ac.id
-                WHERE company = %s ORDER BY published_date DESC"""
-                params = (company, )
-
-            if limit and isinstance(limit, int):
-                query += f" LIMIT {limit}"
-
-            categories_query = """SELECT category FROM categories WHERE id = %s"""
+    query = article_query(category) + " " + PAGE_ORDER
+    params = (company, category) if category else (company, )
 
-            with connection.cursor() as cursor:
-                cursor.execute(query, params)
-                results = cursor.fetchall()
-
-                if results:
-                    for row in results:
-                        # Get categories from categories table
-                        cursor.execute(categories_query, (row[0],))
-                        categories = []
-                        cat_results = cursor.fetchall()
-
-                        for cat_row in cat_results:
-                            categories.append(cat_row[0])
-
-                        # Refer to util/database_setup.py create_tables() for table schemas
-                        article = Article(
-                            company.upper(), row[1], row[3], row[4], categories, row[5], row[2], retrieved=row[6])
-
-                        articles.append(article)
-                else:
-                    print(f"no articles on {company} found")
+    if limit and isinstance(limit, int):
+        query += f" LIMIT {limit}"
+
+    try:
+        results = read_rows(query, params, company)
+        if results:
+            articles = [row_to_article(row) for row in results]
+        else:
+            print(f"no articles on {company} found")
     except Error as e:
         print(e)
 
     return articles
 
 
+def article_query(category: str = None, where: str = None):
+    """Build the SELECT for fully hydrated article rows of a company (and category).
+
+    Rows come from the article_index read model (see index_rows): one row per article, company
+    and category, with every column row_to_article needs. With PAGE_ORDER and a LIMIT a page
+    is one range scan of its (company, category, published_date, id) index.
+    Rows are in the format `row_to_article` expects.
+    Parameters are (company, ) or (company, category), followed by any in `where`. Caller appends ORDER BY/LIMIT.
+
+    Args:
+        category (str, optional): only articles in category. Defaults to None.
+        where (str, optional): extra condition on article_index `ai` (see AFTER_CURSOR)
+    """
+    # The company-wide rows have category ALL_CATEGORIES
+    conditions = ["ai.company = %s", "ai.category = %s" if category else f"ai.category = '{ALL_CATEGORIES}'"]
+    if where:
+        conditions.append(where)
+
+    return f"""
+    SELECT ai.id, ai.title, ai.description, ai.url, ai.source, ai.published_date, ai.retrieved, ai.company, ai.categories
+    FROM article_index ai
+    WHERE {" AND ".join(conditions)}"""
+
+
+# Newest first, in index order of article_index (company, category, published_date, id)
+PAGE_ORDER = "ORDER BY ai.published_date DESC, ai.id DESC"
+# Keyset condition for the articles after a cursor's (published_date, id), see article_query
+AFTER_CURSOR = "(ai.published_date < %s OR (ai.published_date = %s AND ai.id < %s))"
+
+
+def oldest_date_query(category: str = None):
+    """SELECT of the oldest stored published_date of a company (and category), the first entry of
+    its article_index range. Parameters are (company, ) or (company, category)"""
+    category_condition = "category = %s" if category else f"category = '{ALL_CATEGORIES}'"
+    return f"""
+    SELECT published_date FROM article_index
+    WHERE company = %s AND {category_condition}
+    ORDER BY published_date ASC, id ASC
+    LIMIT 1"""
+
+
+# article_index columns, in the order index_rows() selects them
+INDEX_COLUMNS = "company, category, id, title, description, url, source, published_date, retrieved, categories"
+
+
+def index_rows(condition: str):
+    """SELECTs of the article_index rows of the articles matching condition, built from the
+    normalized tables: for every company link one row with category ALL_CATEGORIES and one per
+    category, each with the article's categories packed like article_query's
+
+    Args:
+        condition (str): condition on articles `a`, without parameters (e.g. "a.id IN (1, 2)")
+
+    Returns:
+        list[str]: SELECTs of INDEX_COLUMNS
+    """
+    packed = f"""(SELECT GROUP_CONCAT(p.category ORDER BY p.category SEPARATOR '{CATEGORY_SEPARATOR}')
+        FROM categories p WHERE p.id = a.id)"""
+    columns = f"a.id, a.title, a.description, a.url, a.source, a.published_date, a.retrieved, {packed}"
+    return [
+        f"""SELECT ac.company, '{ALL_CATEGORIES}', {columns} FROM articles a
+        JOIN articles_companies ac ON ac.id = a.id WHERE {condition}""",
+        f"""SELECT ac.company, c.category, {columns} FROM articles a
+        JOIN articles_companies ac ON ac.id = a.id
+        JOIN categories c ON c.id = a.id WHERE {condition}""",
+    ]
+
+
+def refresh_article_index(cursor, ids: list[int]):
+    """Rewrite the article_index rows of articles from the normalized tables, in the caller's
+    transaction. Called wherever their links, categories or columns change"""
+    for i in range(0, len(ids), INSERT_BATCH_SIZE):
+        batch = [int(id) for id in ids[i:i + INSERT_BATCH_SIZE]]
+        condition = f"a.id IN ({', '.join(map(str, batch))})"
+        cursor.execute(f"DELETE FROM article_index WHERE id IN ({', '.join(['%s'] * len(batch))})", batch)
+        for select in index_rows(condition):
+            cursor.execute(f"INSERT INTO article_index ({INDEX_COLUMNS}) {select}")
+
+
 def get_oldest_date(company: str, connection, category: str = None):
     """Get the publish date of the oldest article stored in the database (of a particular company)
 
@@ -189,22 +525,8 @@ def get_oldest_date(company: str, connection, category: str = None):
         datetime: date of oldest article
     """
     date = None
-    if category:
-        query = """SELECT published_date FROM articles a
-        JOIN categories c ON a.id = c.id
-        JOIN articles_companies ac ON ac.id = a.id
-        WHERE category = %s AND company = %s
-        ORDER BY a.published_date ASC
-        LIMIT 1"""
-        params = (category, company)
-    else:
-        query = """
-        SELECT published_date FROM articles a
-        JOIN articles_companies ac on ac.id = a.id
-        WHERE company = %s 
-        ORDER BY published_date ASC
-        LIMIT 1"""
-        params = (company, )
+    query = oldest_date_query(category)
+    params = (company, category) if category else (company, )
 
     with connection.cursor() as cursor:
         cursor.execute(query, params)
@@ -215,27 +537,6 @@ def get_oldest_date(company: str, connection, category: str = None):
     return date
 
 
-def get_cache_timestamp(company: str, category: str = None):
-    timestamp = None
-    try: 
-        with db_connection() as connection:
-            if category is None: 
-                query = """SELECT cache_time FROM found WHERE company = %s ORDER BY cache_time DESC LIMIT 1"""
-                params=(company, )
-            else:
-                query = """SELECT cache_time FROM found WHERE company = %s AND category = %s """
-                params = (company, category)
-            
-            with connection.cursor() as cursor: 
-                cursor.execute(query, params)
-                results = cursor.fetchall()
-                if results:
-                    timestamp = results[0][0]   
-    except Error as e: 
-        print(e)
-    return timestamp
-
-
 def company_exists(company: str):
     """Check if company exists in database
 
@@ -244,7 +545,7 @@ def company_exists(company: str):
     """
     exists = False
     try:
-        with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
+        with db_connection() as connection:
             print(connection)
             with connection.cursor() as cursor:
                 cursor.execute(
@@ -256,6 +557,51 @@ def company_exists(company: str):
     return exists
 
 
+def get_found_rows(company: str):
+    """Get every 'found' row of a company in one query. Memoized inside request_scope()
+
+    Args:
+        company (str): company name
+
+    Returns:
+        dict: {category: (found, cache_time)}. Empty if articles on company were never retrieved
+    """
+    memo = getattr(_request, "found", None)
+    if memo is not None and company in memo:
+        return memo[company]
+
+    rows = {}
+    try:
+        with db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT category, found, cache_time FROM found WHERE company = %s", (company, ))
+                rows = {x[0]: (x[1], x[2]) for x in cursor.fetchall()}
+    except Error as e:
+        print(e)
+        return rows
+
+    if memo is not None:
+        memo[company] = rows
+    return rows
+
+
+def get_cache_timestamp(company: str, category: str = None):
+    """Get time articles on company (and category) were last retrieved from GNEWS. If category
+    is None, the most recent of all categories
+
+    Returns:
+        datetime: cache time, None if never retrieved
+    """
+    rows = get_found_rows(company)
+    if category is None:
+        timestamps = [x[1] for x in rows.values() if x[1] is not None]
+        return max(timestamps) if timestamps else None
+
+    row = rows.get(category)
+    return row[1] if row else None
+
+
 def get_found(company: str, category: str = None):
     """Get the number of 'found' articles in category. If category is none,
     count total
@@ -263,72 +609,105 @@ def get_found(company: str, category: str = None):
     Args:
         company (str): company name
         category (str, optional): category to search for. Defaults to None.
+
+    Returns:
+        int: found articles. None if category is None and company was never retrieved
     """
-    found = 0
-    try:
-        if category:
-            params = (company, category)
-            query = """SELECT found FROM found WHERE company = %s AND category = %s"""
-        else:
-            params = (company, )
-            query = """SELECT sum(found) FROM found WHERE company = %s"""
+    rows = get_found_rows(company)
+    if category:
+        row = rows.get(category)
+        return row[0] if row else 0
+
+    if not rows:
+        return None
+    return sum(x[0] for x in rows.values())
 
-        with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
-            print(connection)
-            with connection.cursor() as cursor:
-                cursor.execute(query, params)
-                results = cursor.fetchall()
-                if results:
-                    found = results[0][0]
 
+def get_stale_found(older_than: datetime):
+    """Get (company, category, cache_time) of every 'found' row cached before `older_than`, stalest first"""
+    rows = []
+    try:
+        with db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT company, category, cache_time FROM found WHERE cache_time <= %s ORDER BY cache_time", (older_than, ))
+                rows = list(cursor.fetchall())
     except Error as e:
         print(e)
-
-    return found
+    return rows
 
 
 def get_all_found(company: str):
-    query = """SELECT category, found FROM found WHERE company = %s"""
+    rows = get_found_rows(company)
     found = None
+    if rows:
+        found = {category: x[0] for category, x in rows.items()}
+        found["all"] = sum(found.values())
+
+    return found
+
+
+def get_article_counts(company: str):
+    """Get the number of articles stored on company, per category, from article_counts (kept up to
+    date by insert_articles). Memoized inside request_scope()
+
+    Returns:
+        dict: {category: stored}, ALL_CATEGORIES for all articles. Empty if none are stored
+    """
+    memo = getattr(_request, "counts", None)
+    key = company.lower()
+    if memo is not None and key in memo:
+        return memo[key]
+
+    counts = {}
     try:
         with db_connection() as connection:
             with connection.cursor() as cursor:
-                cursor.execute(query, (company, ))
-                results = cursor.fetchall()
-                if results:
-                    found = results
-                    found = {x[0]: x[1] for x in found}
-                    found["all"] = sum(found.values())
+                cursor.execute("SELECT category, stored FROM article_counts WHERE company = %s", (company, ))
+                counts = dict(cursor.fetchall())
     except Error as e:
         print(e)
+        return counts
 
-    return found
+    if memo is not None:
+        memo[key] = counts
+    return counts
 
 
-def num_articles_in_db(company: str, connection, category: str = None):
-    num = 0
+def get_all_stored(company: str):
+    """Stored articles per category, in the format of get_all_found ("all" for every article)"""
+    counts = get_article_counts(company)
+    stored = {category: counts.get(category, 0) for category in ETHICS_CATEGORIES}
+    stored["all"] = counts.get(ALL_CATEGORIES, 0)
+    return stored
 
-    if category:
-        query = """
-        SELECT count(*) FROM articles
-        JOIN categories ON categories.id = articles.id
-        JOIN articles_companies ac ON articles.id = ac.id
-        WHERE company = %s AND category = %s"""
-        params = (company, category)
 
-    else:
-        query = """SELECT count(*) FROM articles 
-        JOIN articles_companies ac ON articles.id = ac.id
-        WHERE company = %s"""
-        params = (company,)
+def recount_articles(company: str, category: str = None):
+    """Count company's stored articles (in category) from article_index and correct article_counts with it
+
+    Returns:
+        int: number of articles stored
+    """
+    print(f"article_counts of {company} - {category} disagrees with article_index, recounting")
+    key = category or ALL_CATEGORIES
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM article_index WHERE company = %s AND category = %s", (company, key))
+            stored = cursor.fetchall()[0][0]
+            cursor.execute("""
+            INSERT INTO article_counts (company, category, stored) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE stored = VALUES(stored)""", (company, key, stored))
+        connection.commit()
+
+    memo = getattr(_request, "counts", None)
+    if memo is not None:
+        memo.pop(company.lower(), None)
+    return stored
 
-    with connection.cursor() as cursor:
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        if results:
-            num = results[0][0]
 
-    return num
+def num_articles_in_db(company: str, connection = None, category: str = None):
+    """Number of articles on company (in category) stored, see get_article_counts"""
+    return get_article_counts(company).get(category or ALL_CATEGORIES, 0)
 
 
 def get_page(company: str, page: int, category: str = None):
@@ -351,42 +730,26 @@ def get_page(company: str, page: int, category: str = None):
     page_offset = (page-1)*10
     page_arr = []  # array of articles
 
-    try:
-        with db_connection() as connection:
-            num_article = num_articles_in_db(company, connection, category)
-            db_pages = calculate_pages(num_article)
-
-            if page > db_pages:
-                raise pageNotInDatabaseError(
-                    f"Company: {company.capitalize()} - Category: {category} - Page: {page} not contained in db.\nDatabase pages: {db_pages}\nCheck 'found' to see if GNEWS has more articles", db_pages)
-
-            elif not category:
-                query = """
-                SELECT * 
-                FROM articles 
-                JOIN articles_companies ac on articles.id = ac.id
-                WHERE company = %s 
-                ORDER BY published_date DESC
-                LIMIT 10 OFFSET %s"""
-                params = (company, page_offset)
-
-            else:
-                query = """
-                SELECT * 
-                FROM articles a 
-                JOIN categories c ON a.id = c.id 
-                JOIN articles_companies ac ON a.id = ac.id
-                WHERE company = %s AND category = %s
-                LIMIT 10 OFFSET %s"""
-                params = (company, category, page_offset)
+    # Whether an empty page is past the stored articles is an article_counts lookup
+    query = article_query(category) + f"""
+    {PAGE_ORDER}
+    LIMIT 10 OFFSET %s"""
+    params = (company, category, page_offset) if category else (company, page_offset)
 
-            with connection.cursor() as cursor:
-                cursor.execute(query, params)
-                result = cursor.fetchall()
+    try:
+        result = read_rows(query, params, company, min_rows=1)
+        if result:
+            for row in result:
+                page_arr.append(row_to_article(row))
+        else:
+            num_article = num_articles_in_db(company, category=category)
+            if num_article > page_offset:
+                # article_counts says the page is stored but it has no rows
+                num_article = recount_articles(company, category)
+            db_pages = stored_pages(num_article)
 
-                if result:
-                    for row in result:
-                        page_arr.append(row_to_article(row, cursor))
+            raise pageNotInDatabaseError(
+                f"Company: {company.capitalize()} - Category: {category} - Page: {page} not contained in db.\nDatabase pages: {db_pages}\nCheck 'found' to see if GNEWS has more articles", db_pages)
 
     except Error as e:
         print(e)
@@ -394,44 +757,184 @@ def get_page(company: str, page: int, category: str = None):
     return page_arr
 
 
-def row_to_article(row, cursor):
-    """Convert row from 'articles' table into Article object.
-    Helper function to help retrieval of articles
+def get_page_after(company: str, cursor: str = None, category: str = None, size: int = 10):
+    """Get the next `size` articles after cursor, newest first (keyset pagination).
+
+    Unlike get_page this never counts or skips rows: the cursor encodes the (published_date, id)
+    of the last article returned, so every page is an index range scan from that point.
 
     Args:
-        row (list): table row
-        cursor (MySQLCursorAbstract): SQL cursor
+        company (str): name of company
+        cursor (str, optional): cursor returned with the previous page. None for the first page
+        category (str, optional): category. Defaults to None.
+        size (int, optional): articles per page. Defaults to 10.
+
+    Raises:
+        ValueError: cursor is malformed
 
     Returns:
-        Article: Article object
+        (list[Article], str): articles in page and cursor of the next page, None if this is the last stored page
+    """
+    params = [company, category] if category else [company]
+    where = None
+    if cursor:
+        date, id = decode_cursor(cursor)
+        where = AFTER_CURSOR
+        params += [date, date, id]
+
+    query = article_query(category, where=where) + f"""
+    {PAGE_ORDER}
+    LIMIT %s"""
+    # One extra row tells whether there is a next page
+    params.append(size + 1)
+
+    articles = []
+    next_cursor = None
+    try:
+        # No next page makes fetch_articles_after query GNEWS for older articles
+        result = read_rows(query, params, company, min_rows=size + 1)
+        articles = [row_to_article(row) for row in result[:size]]
+        if len(result) > size:
+            last = result[size - 1]
+            next_cursor = encode_cursor(last[5], last[0])
+    except Error as e:
+        print(e)
+
+    return articles, next_cursor
+
+
+def fulltext_query(text: str):
+    """Convert user search text into a BOOLEAN MODE query requiring every word ("quoted phrases" kept
+    together). Boolean operators typed by the user are removed
+
+    Raises:
+        ValueError: text contains no words
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]+)"|(\S+)', text):
+        term = re.sub(r'[+\-<>()~*"@]', " ", phrase or word).strip()
+        if term:
+            terms.append(f'+"{term}"' if phrase or " " in term else f"+{term}")
+    if not terms:
+        raise ValueError(f"Invalid search query: {text}")
+    return " ".join(terms)
+
+
+def search_query(text: str, company: str = None, category: str = None, start: datetime = None,
+                 end: datetime = None, cursor: str = None, size: int = 10):
+    """Build the full-text search over article titles and descriptions (FULLTEXT index text_search)
+
+    Rows are in the format `row_to_article` expects, newest first. An article linked to several
+    companies is returned once, with `company` if given, else the first of its companies.
+
+    Raises:
+        ValueError: text has no words or cursor is malformed
+
+    Returns:
+        (str, list): query and parameters
     """
+    company_join = "AND ac.company = %s" if company else ""
+    category_join = "JOIN categories f ON f.id = a.id AND f.category = %s" if category else ""
+    params = [company] if company else []
+    if category:
+        params.append(category)
+
+    where = ["MATCH (a.title, a.description) AGAINST (%s IN BOOLEAN MODE)"]
+    params.append(fulltext_query(text))
+    if start:
+        where.append("a.published_date >= %s")
+        params.append(start)
+    if end:
+        where.append("a.published_date < %s")
+        params.append(end)
+    if cursor:
+        date, id = decode_cursor(cursor)
+        where.append("(a.published_date < %s OR (a.published_date = %s AND a.id < %s))")
+        params += [date, date, id]
+    params.append(size + 1)
+
+    return f"""
+    SELECT a.id, a.title, a.description, a.url, a.source, a.published_date, a.retrieved, MIN(ac.company),
+        GROUP_CONCAT(DISTINCT c.category ORDER BY c.category SEPARATOR '{CATEGORY_SEPARATOR}')
+    FROM articles a
+    JOIN articles_companies ac ON ac.id = a.id {company_join}
+    {category_join}
+    LEFT JOIN categories c ON c.id = a.id
+    WHERE {" AND ".join(where)}
+    GROUP BY a.id
+    ORDER BY a.published_date DESC, a.id DESC
+    LIMIT %s""", params
+
+
+def search_articles(text: str, company: str = None, category: str = None, start: datetime = None,
+                    end: datetime = None, cursor: str = None, size: int = 10):
+    """Search stored article headlines and descriptions, across companies unless company is given.
+    Paginated like get_page_after
+
+    Args:
+        text (str): words to search for, all must appear. "quoted phrases" match exactly
+        company (str, optional): only articles on company. Defaults to None.
+        category (str, optional): only articles in category. Defaults to None.
+        start (datetime, optional): only articles published at or after start. Defaults to None.
+        end (datetime, optional): only articles published before end. Defaults to None.
+        cursor (str, optional): cursor returned with the previous page. None for the first page
+        size (int, optional): articles per page. Defaults to 10.
+
+    Raises:
+        ValueError: text has no words or cursor is malformed
+
+    Returns:
+        (list[Article], str): matching articles, newest first, and cursor of the next page (None if last)
+    """
+    query, params = search_query(text, company, category, start, end, cursor, size)
+
+    articles = []
+    next_cursor = None
     try:
-        categories_query = """SELECT category FROM categories WHERE id = %s"""
-        name_query = """SELECT company FROM articles_companies WHERE id = %s"""
-        # Get categories from categories table
-        cursor.execute(categories_query, (row[0],))
-        categories = []
-        cat_results = cursor.fetchall()
-
-        
-        for cat_row in cat_results:
-            categories.append(cat_row[0])
-
-        cursor.execute(name_query, (row[0], ))
-        name = cursor.fetchall()
-        if name:
-            name = name[0][0]
-        
-        # Refer to util/database_setup.py create_tables() for table schemas
-        article = Article(name, row[1], row[3], row[4],
-                        categories, row[5], row[2], retrieved=row[6])
+        result = read_rows(query, params, company)
+        articles = [row_to_article(row) for row in result[:size]]
+        if len(result) > size:
+            last = result[size - 1]
+            next_cursor = encode_cursor(last[5], last[0])
     except Error as e:
         print(e)
-    return article
+
+    return articles, next_cursor
+
+
+def encode_cursor(published_date: datetime, id: int):
+    """Opaque page cursor for (published_date, id)"""
+    raw = f"{published_date.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """Inverse of encode_cursor. Raises ValueError if cursor is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        date, id = raw.split("|")
+        return datetime.fromisoformat(date), int(id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid page cursor: {cursor}") from e
+
+
+def row_to_article(row):
+    """Convert row selected by `article_query` into Article object.
+
+    Args:
+        row (list): (id, title, description, url, source, published_date, retrieved, company, categories)
+
+    Returns:
+        Article: Article object
+    """
+    categories = row[8].split(CATEGORY_SEPARATOR) if row[8] else []
+    return Article(row[7], row[1], row[3], row[4], categories, row[5], row[2], retrieved=row[6])
 
 
 def search_company_table(search: str):
-    """Search for company in database. Returns 5 companies like search string
+    """Search for company in database. Returns 5 companies like search string.
+    Served from the in-memory index (search_index.py), reloaded when stale. Falls back
+    to SQL (cached, see cache.py) if the index can't be loaded
 
     Args:
         search (str): _description_
@@ -439,39 +942,93 @@ def search_company_table(search: str):
     Returns:
         list: list of company names matching search
     """
+    check_company_version()
+    if company_index.is_stale():
+        refresh_company_index()
+    if not company_index.is_stale():
+        return company_index.search(search, 5)
+
+    key = search.lower()
+    names = search_cache.get(key)
+    if names is MISSING:
+        names = search_company_sql(search)
+        search_cache.set(key, names)
+    return list(names)
+
+
+# Companies whose name or an alias contains the search, ranked like search_index.py: best match
+# position (over the name and aliases), then name. Params: (search, like, search, like)
+COMPANY_SEARCH_SQL = """
+SELECT name FROM (
+    SELECT name, LOCATE(%s, name) AS position FROM companies WHERE name LIKE %s
+    UNION ALL
+    SELECT c.name, LOCATE(%s, a.alias) FROM aliases a JOIN companies c ON c.name = a.name WHERE a.alias LIKE %s
+) matches
+GROUP BY name
+ORDER BY MIN(position), name
+LIMIT 5"""
+
+
+def search_company_sql(search: str):
+    """SQL implementation of search_company_table: name or alias LIKE '%search%' ranked by match position, then name"""
     names = []
-    print("")
     like = f"%{search}%"
-    with db_connection() as connection:
-        print(connection)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT name FROM companies WHERE name LIKE %s ORDER BY LOCATE(%s, name), name LIMIT 5", (like, search))
-            results = cursor.fetchall()
-            if results:
-                names = [x[0] for x in results]
+    results = read_rows(COMPANY_SEARCH_SQL, (search, like, search, like))
+    if results:
+        names = [x[0] for x in results]
     return names
 
 
+def check_company_version():
+    """Drop cached company data if util/database_setup.py changed companies since the last check (see cache.py)"""
+    if not company_version.due():
+        return
+    try:
+        rows = read_rows(COMPANY_VERSION_QUERY)
+    except Error as e:
+        print(e)
+        return
+    company_version.seen(rows[0][0] if rows else 0)
+
+
+def refresh_company_index():
+    """(Re)load the company search index from the companies and aliases tables"""
+    try:
+        companies = [x[0] for x in read_rows("SELECT name FROM companies")]
+        aliases = read_rows("SELECT name, alias FROM aliases")
+        company_index.build(companies, aliases)
+    except Error as e:
+        print(e)
+
+
 def get_company_data(company: str):
+    """Get company row and its industries. Cached if the company exists (see cache.py)
+
+    Returns:
+        list: [name, description, website, logo_url, industries]. None if company doesn't exist
+    """
+    check_company_version()
+    key = company.lower()
+    data = company_cache.get(key)
+    if data is not MISSING:
+        return list(data)
+
     data = None
     try:
-        with db_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "SELECT * FROM companies c WHERE c.name = %s", (company, ))
-                results = cursor.fetchall()
-                if results:
-                    cursor.execute(
-                        "SELECT industry FROM industries WHERE name = %s", (company, ))
-                    industries = [x[0] for x in cursor.fetchall()]
-                    data = list(results[0])
-                    data.append(industries)
+        results = read_rows("SELECT * FROM companies c WHERE c.name = %s", (company, ))
+        if results:
+            industries = [x[0] for x in read_rows("SELECT industry FROM industries WHERE name = %s", (company, ))]
+            data = list(results[0])
+            data.append(industries)
 
     except Error as e:
         print(e)
+        return data
 
-    return data
+    # Not cached when missing: the company may be added by util/database_setup.py any time
+    if data:
+        company_cache.set(key, data)
+    return list(data) if data else data
 # Update
 
 # Delete
@@ -479,6 +1036,11 @@ def get_company_data(company: str):
 # util
 
 
+def stored_pages(num_articles: int):
+    """Number of pages with at least one of num_articles stored articles"""
+    return -(-num_articles // 10)
+
+
 def calculate_pages(num_articles: int):
     if num_articles == 0:
         return 0
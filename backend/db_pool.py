@@ -0,0 +1,196 @@
+"""
+Bounded MariaDB connection pool shared by the database helpers.
+
+Connections are checked out per thread: nested `connection()` blocks on the same
+thread reuse the connection already held, so a request handler and every helper it
+calls share one connection. Idle connections are pinged before reuse and recycled
+after sitting in the pool too long.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pymysql import connect, Error
+
+
+class PoolTimeout(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+
+class ConnectionPool:
+
+    def __init__(self, size: int = 8, timeout: float = 10, max_idle: float = 300, ping_after: float = 30, **connect_args):
+        """Initialize pool. Connections are created lazily, up to `size`
+
+        Args:
+            size (int): max number of open connections
+            timeout (float): seconds to wait for a free connection before raising PoolTimeout
+            max_idle (float): seconds a connection may sit idle before it is closed instead of reused
+            ping_after (float): seconds idle after which a connection is pinged before reuse
+            connect_args: arguments passed to pymysql.connect (host, user, password, database...)
+        """
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.connect_args = connect_args
+
+        self._idle = deque()  # (connection, time returned to pool)
+        self._open = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        self.stats = {
+            "checkouts": 0,
+            "reentrant_checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "creations": 0,
+            "recycled": 0,
+            "failed_pings": 0,
+        }
+
+    def _create(self):
+        connection = connect(**self.connect_args)
+        with self._cond:
+            self.stats["creations"] += 1
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def _acquire(self):
+        """Take an idle connection, or reserve a slot for a new one if below `size`, otherwise wait.
+
+        Returns:
+            (connection, seconds idle). connection is None if a new one should be created
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self.stats["checkouts"] += 1
+            waited = False
+            while True:
+                while self._idle:
+                    connection, returned = self._idle.pop()
+                    idle_for = time.monotonic() - returned
+                    if idle_for <= self.max_idle:
+                        return connection, idle_for
+
+                    self.stats["recycled"] += 1
+                    self._open -= 1
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+                if self._open < self.size:
+                    self._open += 1
+                    return None, 0
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+                if not waited:
+                    self.stats["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+
+    def _checkout(self):
+        connection, idle_for = self._acquire()
+        if connection is None:
+            try:
+                return self._create()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+
+        if idle_for > self.ping_after:
+            try:
+                connection.ping(reconnect=True)
+            except Error:
+                with self._cond:
+                    self.stats["failed_pings"] += 1
+                self._discard(connection)
+                return self._checkout()
+        return connection
+
+    def _release(self, connection, broken: bool = False):
+        if not broken:
+            try:
+                # End any open transaction so the next user doesn't read a stale snapshot
+                connection.rollback()
+            except Error:
+                broken = True
+
+        if broken:
+            self._discard(connection)
+        else:
+            with self._cond:
+                self._idle.append((connection, time.monotonic()))
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the current thread.
+
+        Reentrant: if this thread already holds a connection it is yielded again and only
+        returned to the pool when the outermost block exits. Uncommitted work is rolled back
+        on return.
+        """
+        held = getattr(self._local, "connection", None)
+        if held is not None:
+            self._local.depth += 1
+            with self._cond:
+                self.stats["reentrant_checkouts"] += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        connection = self._checkout()
+        self._local.connection = connection
+        self._local.depth = 1
+        broken = False
+        try:
+            yield connection
+        except Error:
+            broken = not connection.open
+            raise
+        finally:
+            self._local.connection = None
+            self._local.depth = 0
+            self._release(connection, broken)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["size"] = self.size
+            stats["open"] = self._open
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._open - len(self._idle)
+        return stats
+
+    def close(self):
+        """Close all idle connections. Connections in use are closed when released"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+        for connection, _ in idle:
+            try:
+                connection.close()
+            except Exception:
+                pass
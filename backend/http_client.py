@@ -0,0 +1,280 @@
+"""
+Shared outbound HTTP client.
+
+One requests.Session per client keeps connections alive (pooled per host), failed requests
+are retried with exponential backoff (connection errors, 429 and 5xx, honouring Retry-After)
+and requests can be rate limited per host.
+
+With a cache directory, GET responses carrying an ETag or Last-Modified header (or a
+Cache-Control max-age) are stored on disk. A stored response is returned without a request
+while fresh, otherwise it is revalidated with If-None-Match / If-Modified-Since and a
+304 Not Modified returns the stored body, so unchanged pages aren't downloaded again.
+get_parsed() streams a page through a parser that may stop reading early and stores the
+parsed result instead of the body, revalidated the same way.
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import threading
+from collections import Counter
+from hashlib import sha256
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from rate_limit import TokenBucket
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def freshness(headers):
+    """Seconds a response may be reused without revalidation (Cache-Control max-age), None if it must not be stored"""
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return 0
+    match = re.search(r"(?<!s-)max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else 0
+
+
+class HTTPClient:
+
+    def __init__(self, cache_dir: str = None, rates: dict = None, default_rate: float = None,
+                 pool_maxsize: int = 10, retries: int = 3, backoff: float = 0.5,
+                 headers: dict = None, max_age: float = 0):
+        """
+        Args:
+            cache_dir (str, optional): directory of the response cache. Defaults to None, no caching.
+            rates (dict, optional): {host: requests per second}. Defaults to None.
+            default_rate (float, optional): requests per second to hosts not in rates. Defaults to None, unlimited.
+            pool_maxsize (int, optional): kept-alive connections per host. Defaults to 10.
+            retries (int, optional): retries of a failed request. Defaults to 3.
+            backoff (float, optional): backoff factor, retries wait backoff * 2^(retry - 1) seconds. Defaults to 0.5.
+            headers (dict, optional): headers sent with every request. Defaults to None.
+            max_age (float, optional): seconds stored responses are used without revalidation when the
+                server doesn't say (Cache-Control max-age). Defaults to 0, always revalidate.
+        """
+        self.cache_dir = cache_dir
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.max_age = max_age
+
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({"GET", "HEAD"}), raise_on_status=False,
+                      respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=max(10, len(self.rates)), pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        self.hosts = Counter()  # network requests per host
+
+    def get(self, url: str, params=None, headers: dict = None, cache: bool = True, max_age: float = None, **kwargs):
+        """GET url, from the cache when possible. Same arguments as requests.get
+
+        Args:
+            cache (bool, optional): use the cache (if the client has one). Defaults to True.
+            max_age (float, optional): overrides the client's max_age for this request.
+
+        Returns:
+            requests.Response: `from_cache` is True if the body came from the cache
+        """
+        if not self.cache_dir or not cache or kwargs.get("stream"):
+            return self._send(url, params=params, headers=headers, **kwargs)
+
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        key = sha256(f"{full_url}\n{(headers or {}).get('Accept', '')}".encode("utf-8")).hexdigest()
+        entry = self._read(key)
+        max_age = self.max_age if max_age is None else max_age
+
+        if entry:
+            meta, body = entry
+            if time.time() - meta["stored"] < max(meta["fresh"], max_age):
+                self._count("hits", saved=len(body))
+                return self._response(full_url, meta, body)
+
+            headers = dict(headers or {})
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        res = self._send(url, params=params, headers=headers, **kwargs)
+
+        if entry and res.status_code == 304:
+            meta, body = entry
+            meta["stored"] = time.time()
+            fresh = freshness(res.headers)
+            if fresh is not None:
+                meta["fresh"] = fresh
+            self._write(key, meta)
+            self._count("revalidated", saved=len(body))
+            return self._response(full_url, meta, body)
+
+        self._count("misses")
+        fresh = freshness(res.headers)
+        etag, last_modified = res.headers.get("ETag"), res.headers.get("Last-Modified")
+        if res.status_code == 200 and fresh is not None and (etag or last_modified or fresh or max_age):
+            meta = {
+                "status": res.status_code,
+                "headers": {k: v for k, v in res.headers.items() if k.lower() in ("content-type", "etag", "last-modified")},
+                "encoding": res.encoding,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fresh": fresh,
+                "stored": time.time(),
+            }
+            self._write(key, meta, res.content)
+            self._count("stored")
+        return res
+
+    def get_parsed(self, url: str, parse, name: str, params=None, headers: dict = None, max_age: float = None, **kwargs):
+        """GET url streamed, through parse, caching parse's result instead of the body.
+        A stored result is returned while fresh, otherwise the request is revalidated like get()'s
+        and on 304 the stored result is returned without downloading or parsing the page
+
+        Args:
+            parse (callable): called with the streamed requests.Response of a 200, may stop reading
+                early. Returns a JSON-serializable result
+            name (str): kind of result, part of the cache key so one url can be parsed several ways
+            max_age (float, optional): overrides the client's max_age for this request.
+
+        Returns:
+            (result, status code): result is None unless the status is 200
+        """
+        kwargs["stream"] = True
+        if not self.cache_dir:
+            with self._send(url, params=params, headers=headers, **kwargs) as res:
+                return (parse(res) if res.status_code == 200 else None), res.status_code
+
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        key = sha256(f"{full_url}\n{name}".encode("utf-8")).hexdigest()
+        entry = self._read(key)
+        max_age = self.max_age if max_age is None else max_age
+
+        if entry:
+            meta, body = entry
+            if time.time() - meta["stored"] < max(meta["fresh"], max_age):
+                self._count("hits")
+                return json.loads(body), meta["status"]
+
+            headers = dict(headers or {})
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self._send(url, params=params, headers=headers, **kwargs) as res:
+            if entry and res.status_code == 304:
+                meta, body = entry
+                meta["stored"] = time.time()
+                fresh = freshness(res.headers)
+                if fresh is not None:
+                    meta["fresh"] = fresh
+                self._write(key, meta)
+                self._count("revalidated")
+                return json.loads(body), meta["status"]
+
+            self._count("misses")
+            if res.status_code != 200:
+                return None, res.status_code
+
+            result = parse(res)
+            fresh = freshness(res.headers)
+            etag, last_modified = res.headers.get("ETag"), res.headers.get("Last-Modified")
+            if fresh is not None and (etag or last_modified or fresh or max_age):
+                meta = {"status": 200, "etag": etag, "last_modified": last_modified, "fresh": fresh, "stored": time.time()}
+                self._write(key, meta, json.dumps(result).encode("utf-8"))
+                self._count("stored")
+            return result, 200
+
+    def _send(self, url: str, **kwargs):
+        host = urlparse(url).netloc
+        rate = self.rates.get(host, self.default_rate)
+        if rate:
+            with self._lock:
+                limiter = self._limiters.get(host)
+                if limiter is None:
+                    limiter = self._limiters[host] = TokenBucket(rate)
+            limiter.wait()
+
+        try:
+            res = self.session.get(url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._count("errors")
+            raise
+        with self._lock:
+            self.stats["requests"] += 1
+            self.hosts[host] += 1
+            if not kwargs.get("stream"):
+                self.stats["bytes_downloaded"] += len(res.content)
+        return res
+
+    def _count(self, stat: str, saved: int = 0):
+        with self._lock:
+            self.stats[stat] += 1
+            self.stats["bytes_saved"] += saved
+
+    def _paths(self, key: str):
+        path = os.path.join(self.cache_dir, key[:2], key)
+        return path + ".json", path + ".gz"
+
+    def _read(self, key: str):
+        """(meta, body) stored for key, None if absent or unreadable"""
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            with gzip.open(body_path, "rb") as f:
+                return meta, f.read()
+        except (OSError, ValueError, EOFError):
+            return None
+
+    def _write(self, key: str, meta: dict, body: bytes = None):
+        """Store meta (and body), each replaced atomically so concurrent readers never see half a file"""
+        meta_path, body_path = self._paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        if body is not None:
+            with gzip.open(body_path + suffix, "wb") as f:
+                f.write(body)
+            os.replace(body_path + suffix, body_path)
+        with open(meta_path + suffix, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + suffix, meta_path)
+
+    @staticmethod
+    def _response(url: str, meta: dict, body: bytes):
+        """requests.Response holding a stored body"""
+        res = requests.Response()
+        res.status_code = meta["status"]
+        res.headers = CaseInsensitiveDict(meta["headers"])
+        res.encoding = meta["encoding"]
+        res.url = url
+        res._content = body
+        res._content_consumed = True
+        res.from_cache = True
+        return res
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["hosts"] = dict(self.hosts)
+        lookups = sum(stats.get(x, 0) for x in ("hits", "revalidated", "misses"))
+        stats["hit_rate"] = (stats.get("hits", 0) + stats.get("revalidated", 0)) / lookups if lookups else 0
+        return stats
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,179 @@
+"""
+Load test comparing serving modes (waitress server.py vs async_server.py) against a local
+GNEWS stand-in, so cold company pages can be exercised without spending the real API quota.
+
+Run from /backend:
+    python loadtest.py standin --port 9000 --latency 0.5
+
+Start the servers with the stand-in as GNEWS endpoint, and gnews_rate / gnews_daily_quota in
+config.py raised high enough for the test:
+    GNEWS_ENDPOINT=http://127.0.0.1:9000/search waitress-serve --port 8080 --threads 8 server:app
+    GNEWS_ENDPOINT=http://127.0.0.1:9000/search hypercorn async_server:app --bind 127.0.0.1:8081
+
+Then run the same request mix against each, making the companies cold first (--cold deletes
+their 'found' rows so the first page request for each goes to GNEWS):
+    python loadtest.py run http://127.0.0.1:8080 http://127.0.0.1:8081 --requests 2000 --concurrency 50 --companies 100 --cold
+"""
+
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+from hashlib import md5
+from datetime import datetime, timedelta
+from statistics import quantiles
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from ethics_categories import ETHICS_CATEGORIES
+
+
+def standin_handler(latency: float, per_page: int = 10, total: int = 37):
+    """Request handler answering like the GNEWS search endpoint after `latency` seconds"""
+    keywords = [kw.strip('"') for kws in ETHICS_CATEGORIES.values() for kw in kws]
+
+    class GNewsStandIn(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            query = params.get("q", "")
+            company = query.split('"')[1] if query.count('"') >= 2 else "company"
+            to = datetime.fromisoformat(params["to"].replace("Z", "")) if "to" in params else datetime.now()
+            seed = md5(f"{query}|{to.isoformat()}".encode()).hexdigest()
+
+            rng = random.Random(seed)
+            articles = [{
+                "title": f"{company} {rng.choice(keywords)} report {i}",
+                "description": f"{company} faces questions over {rng.choice(keywords)}",
+                "url": f"https://standin.example/{seed}/{i}",
+                "source": {"name": "Stand-in"},
+                "publishedAt": (to - timedelta(hours=i + 1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            } for i in range(per_page)]
+
+            body = json.dumps({"totalArticles": total, "articles": articles}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return GNewsStandIn
+
+
+def run_standin(port: int, latency: float):
+    server = ThreadingHTTPServer(("127.0.0.1", port), standin_handler(latency))
+    print(f"GNEWS stand-in on http://127.0.0.1:{port}/search, latency {latency}s")
+    server.serve_forever()
+
+
+def load_companies(n: int):
+    from database_functions import db_connection
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM companies ORDER BY name LIMIT %s", (n, ))
+            return [x[0] for x in cursor.fetchall()]
+
+
+def make_cold(companies: list[str]):
+    """Forget that articles on companies were retrieved, so their next page request queries GNEWS"""
+    from database_functions import db_connection
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM found WHERE company = %s", [(c, ) for c in companies])
+        connection.commit()
+
+
+def request_mix(companies: list[str], n: int, seed: int = 0):
+    """n request paths: mostly first article pages, some company pages and searches"""
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(n):
+        company = rng.choice(companies)
+        kind = rng.random()
+        if kind < 0.6:
+            paths.append(f"/articles/?company={quote(company)}&page=1")
+        elif kind < 0.85:
+            paths.append(f"/company/{quote(company)}")
+        else:
+            paths.append(f"/search?query={quote(company[:rng.randint(1, 4)])}")
+    return paths
+
+
+async def run_load(base_url: str, paths: list[str], concurrency: int):
+    """Send paths with `concurrency` requests in flight
+
+    Returns:
+        dict: requests/sec, latency percentiles (ms) and status counts
+    """
+    import httpx
+
+    latencies = []
+    statuses = Counter()
+    queue = iter(paths)
+
+    async def worker(client):
+        for path in queue:
+            start = time.perf_counter()
+            try:
+                res = await client.get(base_url + path)
+                statuses[res.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+
+    cuts = quantiles(latencies, n=100)
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / seconds,
+        "p50": cuts[49] * 1000,
+        "p99": cuts[98] * 1000,
+        "max": max(latencies) * 1000,
+        "statuses": dict(statuses),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load test server.py vs async_server.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    standin = commands.add_parser("standin", help="run the local GNEWS stand-in")
+    standin.add_argument("--port", type=int, default=9000)
+    standin.add_argument("--latency", type=float, default=0.5, help="seconds per GNEWS response")
+
+    run = commands.add_parser("run", help="send the same request mix to each server")
+    run.add_argument("urls", nargs="+", help="base urls of running servers")
+    run.add_argument("--requests", type=int, default=2000)
+    run.add_argument("--concurrency", type=int, default=50)
+    run.add_argument("--companies", type=int, default=100, help="number of companies in the mix")
+    run.add_argument("--cold", action="store_true", help="make the companies cold before each server's run")
+
+    args = parser.parse_args(argv)
+    if args.command == "standin":
+        run_standin(args.port, args.latency)
+        return
+
+    companies = load_companies(args.companies)
+    paths = request_mix(companies, args.requests)
+    print(f"{'server':<28}{'req/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}  statuses")
+    for url in args.urls:
+        if args.cold:
+            make_cold(companies)
+        result = asyncio.run(run_load(url.rstrip("/"), paths, args.concurrency))
+        print(f"{url:<28}{result['rps']:>8.1f}{result['p50']:>9.1f}{result['p99']:>9.1f}{result['max']:>9.1f}  {result['statuses']}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -58,4 +58,10 @@ class pageNotInDatabaseError(Exception):
 class APILimitReached(Exception):
     def __init__(self, *args):
         super().__init__(*args)
+
+class RetrievalError(Exception):
+    """GNEWS queries of some categories failed (after the others were stored)"""
+    def __init__(self, msg, errors: dict):
+        super().__init__(msg)
+        self.errors = errors  # {category: exception}
         
@@ -0,0 +1,95 @@
+"""
+EXPLAIN regression check of the hot article queries: assert_plans() raises AssertionError if any
+of them sorts (filesort) or builds a temporary table, or if a lookup doesn't use the index it was
+written for. util/database_setup.migrate() runs it after applying migrations; to run it on its own
+(e.g. in a deploy script) against a populated database, from /backend:
+    python query_plans.py [company] [category]
+The company defaults to the one with the most stored articles. Exits with status 1 if a plan regressed.
+"""
+
+import sys
+from datetime import datetime
+
+from database_functions import (db_connection, article_query, oldest_date_query, PAGE_ORDER, AFTER_CURSOR)
+
+
+def hot_queries(company: str, category: str):
+    """(name, sql, params, expected index or None) of the queries serving article requests"""
+    page = article_query() + f" {PAGE_ORDER} LIMIT 10 OFFSET %s"
+    category_page = article_query(category) + f" {PAGE_ORDER} LIMIT 10 OFFSET %s"
+    after = article_query(where=AFTER_CURSOR) + f" {PAGE_ORDER} LIMIT %s"
+    now = datetime.now()
+    return [
+        ("get_page", page, (company, 0), "page"),
+        ("get_page deep", page, (company, 1000), "page"),
+        ("get_page category", category_page, (company, category, 0), "page"),
+        ("get_page_after", after, (company, now, now, 2**63, 11), "page"),
+        ("get_oldest_date", oldest_date_query(), (company, ), "page"),
+        ("get_oldest_date category", oldest_date_query(category), (company, category), "page"),
+        ("num_articles_in_db", "SELECT category, stored FROM article_counts WHERE company = %s", (company, ), "PRIMARY"),
+        ("article id by url", "SELECT id, url FROM articles WHERE url_hash IN (UNHEX(MD5(%s)))",
+         ("https://example.com/", ), "url_hash"),
+    ]
+
+
+def explain(cursor, sql: str, params):
+    """EXPLAIN rows of sql as dicts"""
+    cursor.execute("EXPLAIN " + sql, params)
+    columns = [x[0].lower() for x in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def check_plan(rows: list[dict], index: str = None):
+    """Problems with a plan: sorting, temporary tables and, if index is given, the first table not using it
+
+    Returns:
+        list[str]: problems, empty if the plan is fine
+    """
+    problems = []
+    for row in rows:
+        extra = row.get("extra") or ""
+        for bad in ("Using filesort", "Using temporary"):
+            if bad in extra:
+                problems.append(f"{row['table']}: {bad}")
+    if index and rows and rows[0].get("key") != index:
+        problems.append(f"{rows[0]['table']}: uses {rows[0].get('key')}, expected {index}")
+    return problems
+
+
+def largest_company(cursor):
+    """Company with the most stored articles, so plans are checked on a realistic amount of rows"""
+    cursor.execute("SELECT company FROM article_counts WHERE category = '' ORDER BY stored DESC LIMIT 1")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def assert_plans(company: str = None, category: str = "labor"):
+    """Check the plans of hot_queries
+
+    Raises:
+        AssertionError: a plan regressed
+    """
+    failures = []
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            company = company or largest_company(cursor)
+            if not company:
+                print("No stored articles, query plans not checked")
+                return
+            for name, sql, params, index in hot_queries(company, category):
+                rows = explain(cursor, sql, params)
+                problems = check_plan(rows, index)
+                plan = ", ".join(f"{row['table']}:{row['type']}/{row.get('key')}" for row in rows)
+                print(f"{'FAIL' if problems else 'ok':<6}{name:<26}{plan}")
+                for problem in problems:
+                    print(f"{'':<6}{problem}")
+                    failures.append(f"{name}: {problem}")
+    assert not failures, f"Query plans regressed ({company}): {'; '.join(failures)}"
+
+
+if __name__ == "__main__":
+    try:
+        assert_plans(*sys.argv[1:])
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,216 @@
+"""
+Thread-safe rate limiting and daily quota accounting for outbound API calls.
+"""
+
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """Allow `rate` calls per second on average, with bursts of up to `capacity`, across all threads
+
+        Args:
+            rate (float): tokens added per second
+            capacity (float, optional): max tokens stored. Defaults to 1 (no bursts).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token now, going into debt if there is none
+
+        Returns:
+            float: seconds to wait before using it
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def reserve_times(self, n: int = 1):
+        """Take n tokens now (see reserve)
+
+        Returns:
+            list[float]: time.monotonic() at which each token may be used
+        """
+        now = time.monotonic()
+        return [now + self.reserve() for _ in range(n)]
+
+    def wait(self):
+        """Take a token, blocking until one is available. Callers are served in arrival order"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        """wait() for asyncio code, sleeps without blocking the event loop"""
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return max(0, self._tokens)
+
+
+class SharedTokenBucket(TokenBucket):
+
+    def __init__(self, rate: float, capacity: float, name: str, connection_factory):
+        """TokenBucket kept in the `rate_limits` table, so every worker process sharing the API key
+        draws from the same rate. The row stores when the next token is free (as database time),
+        reservations lock it, so concurrent workers are spaced out like callers of one bucket.
+
+        Args:
+            rate (float): tokens added per second
+            capacity (float): max tokens stored
+            name (str): name of API (key in rate_limits)
+            connection_factory (callable): returns a database connection context manager
+        """
+        super().__init__(rate, capacity)
+        self.name = name
+        self.connection_factory = connection_factory
+
+    def reserve_times(self, n: int = 1):
+        if n <= 0:
+            return []
+        interval = 1 / self.rate
+        with self.connection_factory() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT IGNORE INTO rate_limits (name, next_free) VALUES (%s, 0)", (self.name, ))
+                cursor.execute("SELECT next_free, UNIX_TIMESTAMP(NOW(6)) FROM rate_limits WHERE name = %s FOR UPDATE",
+                               (self.name, ))
+                next_free, now = (float(x) for x in cursor.fetchone())
+                delays = []
+                for _ in range(n):
+                    next_free = max(next_free, now) + interval
+                    # the first `capacity` tokens of an idle bucket are free now
+                    delays.append(max(0, next_free - now - self.capacity * interval))
+                cursor.execute("UPDATE rate_limits SET next_free = %s WHERE name = %s", (next_free, self.name))
+            connection.commit()
+        start = time.monotonic()
+        return [start + delay for delay in delays]
+
+    def reserve(self):
+        return max(0, self.reserve_times()[0] - time.monotonic())
+
+    async def wait_async(self):
+        # the reservation is a database round trip, don't block the loop on it
+        delay = await asyncio.to_thread(self.reserve)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def available(self):
+        with self.connection_factory() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT next_free, UNIX_TIMESTAMP(NOW(6)) FROM rate_limits WHERE name = %s", (self.name, ))
+                row = cursor.fetchone()
+            connection.commit()
+        if not row:
+            return self.capacity
+        next_free, now = (float(x) for x in row)
+        return max(0, self.capacity - max(0, next_free - now) * self.rate)
+
+
+class DailyQuota:
+
+    def __init__(self, limit: int, api: str, connection_factory=None):
+        """Count calls against a daily budget which resets at midnight UTC.
+
+        In-process by default. With `connection_factory` the ledger is the `api_usage` table,
+        so every worker process sharing the API key draws from the same budget.
+
+        Args:
+            limit (int): calls per day
+            api (str): name of API (key in api_usage)
+            connection_factory (callable, optional): returns a database connection context manager
+        """
+        self.limit = limit
+        self.api = api
+        self.connection_factory = connection_factory
+        self._day = None
+        self._used = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def today():
+        return datetime.now(timezone.utc).date()
+
+    def _roll(self):
+        today = self.today()
+        if today != self._day:
+            self._day = today
+            self._used = 0
+
+    def try_acquire(self, n: int = 1):
+        """Record up to n calls, as many as the budget allows
+
+        Returns:
+            int: calls that may be made, 0 if the daily budget is used up
+        """
+        if self.connection_factory:
+            return self._db_acquire(n)
+
+        with self._lock:
+            self._roll()
+            granted = max(0, min(n, self.limit - self._used))
+            self._used += granted
+            return granted
+
+    def exhaust(self):
+        """Mark today's budget as used up, e.g. when the API answers that the limit is reached"""
+        if self.connection_factory:
+            self._db_execute("""
+            INSERT INTO api_usage (api, day, used) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE used = GREATEST(used, VALUES(used))""", (self.api, self.today(), self.limit))
+            return
+
+        with self._lock:
+            self._roll()
+            self._used = self.limit
+
+    def used(self):
+        if self.connection_factory:
+            rows = self._db_execute("SELECT used FROM api_usage WHERE api = %s AND day = %s", (self.api, self.today()))
+            return rows[0][0] if rows else 0
+
+        with self._lock:
+            self._roll()
+            return self._used
+
+    def remaining(self):
+        return max(0, self.limit - self.used())
+
+    def _db_acquire(self, n: int):
+        day = self.today()
+        with self.connection_factory() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT IGNORE INTO api_usage (api, day, used) VALUES (%s, %s, 0)", (self.api, day))
+                # The row stays locked until commit, so concurrent workers can't overspend
+                cursor.execute("SELECT used FROM api_usage WHERE api = %s AND day = %s FOR UPDATE", (self.api, day))
+                granted = max(0, min(n, self.limit - cursor.fetchone()[0]))
+                if granted:
+                    cursor.execute("UPDATE api_usage SET used = used + %s WHERE api = %s AND day = %s",
+                                   (granted, self.api, day))
+            connection.commit()
+        return granted
+
+    def _db_execute(self, query, params):
+        with self.connection_factory() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            connection.commit()
+        return rows
@@ -0,0 +1,153 @@
+"""
+Re-categorize every stored article with the current keywords in ethics_categories.py.
+
+Categories are computed once at ingest, so editing ETHICS_CATEGORIES leaves older articles
+tagged with the old keyword set. This job streams the articles table in id order through a
+server-side cursor, recomputes each chunk's categories and applies only the difference.
+Each chunk is committed together with its checkpoint, so an interrupted run resumes after
+the last committed chunk. Memory use is bounded by the chunk size.
+
+The checkpoint is kept per keyword set (job_name()), so after the keywords change again the
+next run starts from the first article instead of resuming the finished run.
+
+Run from /backend:
+    python recategorize.py            resume (or start) the job
+    python recategorize.py --restart  start again from the first article
+"""
+
+import sys
+import time
+import json
+from hashlib import md5
+from collections import Counter
+from pymysql import connect
+from pymysql.cursors import SSCursor
+
+from database_functions import (db_connection, pool, linked_companies, update_article_counts,
+                                refresh_article_index)
+from ethics_categories import ETHICS_CATEGORIES
+from categorizer import KeywordCategorizer
+
+JOB = "recategorize"
+CHUNK_SIZE = 1000
+
+
+def job_name(categories: dict = ETHICS_CATEGORIES):
+    """Checkpoint key of the job for a keyword set"""
+    digest = md5(json.dumps(categories, sort_keys=True).encode()).hexdigest()[:12]
+    return f"{JOB}-{digest}"
+
+
+def get_checkpoint(connection, job: str):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT position FROM job_checkpoints WHERE job = %s", (job, ))
+        results = cursor.fetchall()
+    return results[0][0] if results else 0
+
+
+def set_checkpoint(connection, job: str, position: int):
+    """Save checkpoint, committed with the caller's transaction"""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+        INSERT INTO job_checkpoints (job, position, updated) VALUES (%s, %s, NOW())
+        ON DUPLICATE KEY UPDATE position = VALUES(position), updated = NOW()""", (job, position))
+
+
+def diff_chunk(rows, connection, categorizer: KeywordCategorizer):
+    """Compare stored categories of a chunk of articles with recomputed ones
+
+    Args:
+        rows (list): (id, title, description) rows
+
+    Returns:
+        (list, list): (id, category) pairs to insert, and to delete
+    """
+    ids = [row[0] for row in rows]
+    stored = {}
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT id, category FROM categories WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        for id, category in cursor.fetchall():
+            stored.setdefault(id, set()).add(category)
+
+    insert, delete = [], []
+    for id, title, description in rows:
+        current = set(categorizer.categorize(title, description))
+        old = stored.get(id, set())
+        insert += [(id, category) for category in current - old]
+        delete += [(id, category) for category in old - current]
+    return insert, delete
+
+
+def count_diff(cursor, insert: list, delete: list):
+    """Change of article_counts from inserting and deleting (id, category) pairs
+
+    Returns:
+        Counter: {(company, category): change}
+    """
+    companies = linked_companies(cursor, list({id for id, _ in insert + delete}))
+    changes = Counter()
+    for pairs, change in ((insert, 1), (delete, -1)):
+        for id, category in pairs:
+            for company in companies.get(id, ()):
+                changes[(company, category)] += change
+    return changes
+
+
+def recategorize(chunk_size: int = CHUNK_SIZE, restart: bool = False):
+    """Run (or resume) the job
+
+    Returns:
+        dict: articles processed, category rows inserted and deleted
+    """
+    categorizer = KeywordCategorizer(ETHICS_CATEGORIES)
+    job = job_name()
+    totals = {"articles": 0, "inserted": 0, "deleted": 0}
+    start = time.perf_counter()
+
+    with db_connection() as writer:
+        # categories.category references ethics_categories, new categories must exist first
+        with writer.cursor() as cursor:
+            cursor.executemany("INSERT IGNORE INTO ethics_categories (category) VALUES (%s)", list(ETHICS_CATEGORIES))
+            # Checkpoints of earlier keyword sets are obsolete
+            cursor.execute("DELETE FROM job_checkpoints WHERE job LIKE %s AND job != %s", (JOB + "%", job))
+            if restart:
+                set_checkpoint(writer, job, 0)
+        writer.commit()
+
+        position = get_checkpoint(writer, job)
+        print(f"Re-categorizing articles after id {position}")
+
+        # Separate unpooled connection, a streaming cursor can't share its connection with writes
+        with connect(**pool.connect_args, cursorclass=SSCursor) as reader:
+            with reader.cursor() as stream:
+                # Give the server time to wait on us while a chunk is being written
+                stream.execute("SET SESSION net_write_timeout = 600")
+                stream.execute("SELECT id, title, description FROM articles WHERE id > %s ORDER BY id", (position, ))
+
+                while True:
+                    rows = stream.fetchmany(chunk_size)
+                    if not rows:
+                        break
+
+                    insert, delete = diff_chunk(rows, writer, categorizer)
+                    with writer.cursor() as cursor:
+                        if insert:
+                            cursor.executemany("INSERT IGNORE INTO categories (id, category) VALUES (%s, %s)", insert)
+                        if delete:
+                            cursor.executemany("DELETE FROM categories WHERE id = %s AND category = %s", delete)
+                        update_article_counts(cursor, count_diff(cursor, insert, delete))
+                        refresh_article_index(cursor, list({id for id, _ in insert + delete}))
+                    set_checkpoint(writer, job, rows[-1][0])
+                    writer.commit()
+
+                    totals["articles"] += len(rows)
+                    totals["inserted"] += len(insert)
+                    totals["deleted"] += len(delete)
+                    print(f"id {rows[-1][0]}: {totals['articles']} articles, +{totals['inserted']} -{totals['deleted']} categories")
+
+    print(f"Done in {time.perf_counter() - start:.1f}s: {totals}")
+    return totals
+
+
+if __name__ == "__main__":
+    recategorize(restart="--restart" in sys.argv)
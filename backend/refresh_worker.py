@@ -0,0 +1,163 @@
+"""
+Background refresh of cached articles.
+
+While the scheduler runs, page-1 requests for stale companies are served from the database
+and the refresh is queued here instead of blocking the request (stale-while-revalidate).
+Between queued refreshes the worker proactively refreshes the most requested stale
+(company, category) pairs, keeping a reserve of the daily GNEWS budget for cold fetches.
+"""
+
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+from models import APILimitReached
+from ethics_categories import ETHICS_CATEGORIES
+
+
+class RefreshScheduler:
+
+    def __init__(self, refresh, remaining_budget, stale_pairs, interval: float = 60,
+                 max_age: timedelta = timedelta(days=2), reserve: int = 20, per_run: int = 5):
+        """
+        Args:
+            refresh (callable): refresh(company, category) retrieves new articles, category None for all
+            remaining_budget (callable): returns GNEWS requests left today
+            stale_pairs (callable): stale_pairs(older_than) returns [(company, category, cache_time)]
+            interval (float, optional): seconds between proactive runs. Defaults to 60.
+            max_age (timedelta, optional): age after which cached articles are stale. Defaults to 2 days.
+            reserve (int, optional): GNEWS requests per day never spent by proactive refreshes. Defaults to 20.
+            per_run (int, optional): max proactive refreshes per run. Defaults to 5.
+        """
+        self.refresh = refresh
+        self.remaining_budget = remaining_budget
+        self.stale_pairs = stale_pairs
+        self.interval = interval
+        self.max_age = max_age
+        self.reserve = reserve
+        self.per_run = per_run
+
+        self.demand = Counter()  # (lower-case company, category): requests since start
+        self._queue = deque()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.stats = {"queued": 0, "refreshed": 0, "proactive": 0, "failed": 0, "skipped_budget": 0, "last_run": None}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the worker thread, unless it is running"""
+        with self._lock:
+            if not self.running:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="refresh-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def record_request(self, company: str, category: str = None):
+        """Count a page request, used to prioritise proactive refreshes"""
+        with self._lock:
+            self.demand[(company.lower(), category)] += 1
+
+    def request_refresh(self, company: str, category: str = None):
+        """Queue a refresh of (company, category), ahead of proactive refreshes. Duplicates are ignored"""
+        key = (company.lower(), category)
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+            self._queue.append((company, category))
+            self.stats["queued"] += 1
+        self._wake.set()
+
+    @staticmethod
+    def cost(category: str = None):
+        """GNEWS requests used by one refresh"""
+        return len(ETHICS_CATEGORIES) if category is None else 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"refresh worker: {e}")
+
+    def run_once(self):
+        """Refresh every queued pair, then up to `per_run` of the most requested stale pairs"""
+        self.stats["last_run"] = datetime.now().isoformat()
+
+        while True:
+            with self._lock:
+                if not self._queue:
+                    break
+                company, category = self._queue.popleft()
+                self._queued.discard((company.lower(), category))
+            # Queued refreshes are on behalf of a waiting user, they may use the reserve
+            if self.remaining_budget() < self.cost(category):
+                self.stats["skipped_budget"] += 1
+                continue
+            if not self._refresh(company, category):
+                return
+
+        for company, category in self._proactive_candidates():
+            if self.remaining_budget() - self.cost(category) < self.reserve:
+                self.stats["skipped_budget"] += 1
+                break
+            if not self._refresh(company, category, proactive=True):
+                return
+
+    def _proactive_candidates(self):
+        """Stale pairs that have been requested, most requested first, then stalest first"""
+        with self._lock:
+            demand = dict(self.demand)
+        if not demand:
+            return []
+
+        stale = self.stale_pairs(datetime.now() - self.max_age)
+        oldest = {}  # (company, category): oldest cache_time
+        for company, category, cache_time in stale:
+            for key in ((company, category), (company, None)):
+                if (key[0].lower(), key[1]) in demand and (key not in oldest or cache_time < oldest[key]):
+                    oldest[key] = cache_time
+
+        ranked = sorted(oldest, key=lambda key: (-demand[(key[0].lower(), key[1])], oldest[key]))
+        return ranked[:self.per_run]
+
+    def _refresh(self, company: str, category: str = None, proactive: bool = False):
+        """Returns False if the API limit was reached and the run should stop"""
+        try:
+            self.refresh(company, category)
+            self.stats["refreshed"] += 1
+            if proactive:
+                self.stats["proactive"] += 1
+        except APILimitReached as e:
+            print(f"refresh worker: {e}")
+            self.stats["failed"] += 1
+            return False
+        except Exception as e:
+            print(f"refresh worker: {company} - {category}: {e}")
+            self.stats["failed"] += 1
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._queue)
+            stats["tracked"] = len(self.demand)
+        stats["running"] = self.running
+        return stats
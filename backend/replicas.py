@@ -0,0 +1,163 @@
+"""
+Read replica routing: reads that can be served slightly behind the primary go to a MariaDB
+replica, writes and every other read stay on the primary (database_functions.pool).
+
+A replica's lag is read from SHOW SLAVE STATUS (Seconds_Behind_Master) every
+`check_interval` seconds by a background thread, so requests never wait on a check. A read
+goes to a replica only if its lag is at most `max_lag` seconds and it has applied everything
+up to the read's `after` time, the last write of this process the read has to see
+(read-your-writes). Replicas that are unreachable, not replicating or failing reads are
+skipped, and checked again after a backoff that doubles with each failure (up to
+`max_backoff` seconds). Meanwhile reads fall back to the primary.
+
+Run from /backend to print the state of the replicas in config.py:
+    python replicas.py
+"""
+
+import time
+import threading
+import itertools
+from pymysql import Error
+
+from db_pool import PoolTimeout
+
+
+class Replica:
+
+    def __init__(self, name: str, pool):
+        self.name = name
+        self.pool = pool
+        self.lag = None  # seconds behind the primary, None if unknown or not replicating
+        self.applied_until = 0.0  # time.time() up to which the primary's writes are applied
+        self.checked = 0.0
+        self.next_check = 0.0
+        self.failures = 0  # consecutive failed checks and reads
+        self.error = None
+
+
+class ReplicaSet:
+
+    def __init__(self, pools: dict, max_lag: float = 5, check_interval: float = 1, max_backoff: float = 60):
+        """
+        Args:
+            pools (dict): {name: ConnectionPool} of the replicas
+            max_lag (float): seconds a replica may lag to be read from
+            check_interval (float): seconds between lag checks of a replica
+            max_backoff (float): longest wait before checking a failing replica again
+        """
+        self.replicas = [Replica(name, pool) for name, pool in pools.items()]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"replica_reads": 0, "primary_reads": 0, "primary_retries": 0, "errors": 0}
+
+    def start(self):
+        """Start the background lag checks (done by choose() on first use)"""
+        with self._lock:
+            if self._thread is None and self.replicas:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="replica-checks", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            for replica in self.replicas:
+                if time.time() >= replica.next_check:
+                    self.check(replica)
+            self._stop.wait(self.check_interval)
+
+    def check(self, replica: Replica):
+        """Measure replica's lag"""
+        now = time.time()
+        try:
+            with replica.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SHOW SLAVE STATUS")
+                    row = cursor.fetchone()
+                    columns = [x[0] for x in cursor.description or ()]
+            status = dict(zip(columns, row)) if row else {}
+            lag = status.get("Seconds_Behind_Master")
+            error = None if lag is not None else "not replicating"
+        except (Error, PoolTimeout) as e:
+            lag = None
+            error = str(e)
+
+        replica.checked = now
+        if lag is None:
+            self._back_off(replica, error)
+            return
+        replica.lag = lag
+        # Seconds_Behind_Master is in whole seconds, count one more
+        replica.applied_until = now - lag - 1
+        replica.error = None
+        replica.failures = 0
+        replica.next_check = now + self.check_interval
+
+    def _back_off(self, replica: Replica, error: str):
+        replica.lag = None
+        replica.error = error
+        replica.failures += 1
+        replica.next_check = time.time() + min(self.check_interval * 2 ** replica.failures, self.max_backoff)
+
+    def choose(self, after: float = 0.0):
+        """Pick a replica for a read, round robin among the ones caught up
+
+        Args:
+            after (float): time.time() of the last write the read must see
+
+        Returns:
+            Replica: or None to read from the primary
+        """
+        if not self.replicas:
+            return None
+        if self._thread is None:
+            self.start()
+
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.lag is not None and replica.lag <= self.max_lag and replica.applied_until >= after:
+                self.count("replica_reads")
+                return replica
+
+        self.count("primary_reads")
+        return None
+
+    def failed(self, replica: Replica, error: Exception):
+        """Skip replica, backing off before checking it again, after a read failed on it"""
+        self._back_off(replica, str(error))
+        self.count("errors")
+
+    def count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["replicas"] = {replica.name: {"lag": replica.lag, "error": replica.error, "failures": replica.failures,
+                                            "pool": replica.pool.get_stats()}
+                             for replica in self.replicas}
+        return stats
+
+
+if __name__ == "__main__":
+    from database_functions import replicas
+
+    if not replicas.replicas:
+        print("No replicas configured (db_replicas in config.py)")
+    for replica in replicas.replicas:
+        replicas.check(replica)
+        usable = replica.lag is not None and replica.lag <= replicas.max_lag
+        print(f"{replica.name}: lag {replica.lag}s, {'usable' if usable else 'not used'}"
+              f"{f' ({replica.error})' if replica.error else ''}")
@@ -0,0 +1,100 @@
+"""
+In-memory substring index over company names and aliases for /search autocomplete.
+
+Every 1-, 2- and 3-character substring of each (lower-cased) name or alias maps to the
+companies containing it. Queries of up to 3 characters are a single lookup, longer ones
+intersect the postings of their trigrams and verify the candidates. Ranking matches
+search_company_table's SQL: position of the match, then name.
+"""
+
+import threading
+import time
+
+GRAM_SIZE = 3
+
+
+def grams(text: str):
+    """All substrings of text of length 1 to GRAM_SIZE"""
+    return {text[i:i + n] for n in range(1, GRAM_SIZE + 1) for i in range(len(text) - n + 1)}
+
+
+class CompanySearchIndex:
+
+    def __init__(self, max_age: float = 600):
+        """
+        Args:
+            max_age (float, optional): seconds before the index is considered stale and reloaded,
+                picks up changes made by other processes. Defaults to 600.
+        """
+        self.max_age = max_age
+        self._built = None  # monotonic time of last build
+        self._stale = True
+        self._lock = threading.Lock()
+        # (names, strings, postings) replaced as a whole so searches never see a half built index
+        self._data = ([], [], {})
+
+    def build(self, companies: list[str], aliases: list[tuple[str, str]] = ()):
+        """Build the index
+
+        Args:
+            companies (list[str]): company names
+            aliases (list[tuple[str, str]]): (company name, alias)
+        """
+        names = sorted(set(companies), key=str.lower)
+        ids = {name: i for i, name in enumerate(names)}
+
+        # (owner id, lower-cased text) for every name and alias
+        strings = [(i, name.lower()) for i, name in enumerate(names)]
+        strings += [(ids[name], alias.lower()) for name, alias in aliases if name in ids and alias]
+
+        postings = {}
+        for s, (owner, text) in enumerate(strings):
+            for gram in grams(text):
+                postings.setdefault(gram, []).append(s)
+
+        with self._lock:
+            self._data = (names, strings, {gram: frozenset(x) for gram, x in postings.items()})
+            self._built = time.monotonic()
+            self._stale = False
+
+    def mark_stale(self):
+        """Force a reload before the next search"""
+        with self._lock:
+            self._stale = True
+
+    def is_stale(self):
+        with self._lock:
+            return self._stale or time.monotonic() - self._built > self.max_age
+
+    def search(self, query: str, limit: int = 5):
+        """Companies whose name or alias contains query (case-insensitive)
+
+        Returns:
+            list[str]: up to `limit` names, ordered by match position then name
+        """
+        names, strings, postings = self._data
+        query = query.lower()
+        if not query:
+            return names[:limit]
+
+        if len(query) <= GRAM_SIZE:
+            candidates = postings.get(query, ())
+        else:
+            lists = sorted((postings.get(query[i:i + GRAM_SIZE], frozenset())
+                            for i in range(len(query) - GRAM_SIZE + 1)), key=len)
+            candidates = lists[0].intersection(*lists[1:])
+
+        # best (lowest) match position per company
+        best = {}
+        for s in candidates:
+            owner, text = strings[s]
+            position = text.find(query)
+            if position >= 0 and position < best.get(owner, float("inf")):
+                best[owner] = position
+
+        # names are sorted, so owner id breaks ties alphabetically
+        ranked = sorted(best, key=lambda owner: (best[owner], owner))
+        return [names[owner] for owner in ranked[:limit]]
+
+
+company_index = CompanySearchIndex()
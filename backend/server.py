@@ -1,13 +1,29 @@
+import threading
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from waitress import serve
-from article_functions import fetch_articles
-from database_functions import search_company_table, get_company_data, get_all_found
+from datetime import datetime
+from article_functions import fetch_articles, fetch_articles_after, gnews_budget, gnews_client, refresh_scheduler, retrievals
+from database_functions import search_company_table, get_company_data, get_all_found, get_all_stored, pool_stats, request_scope, refresh_company_index, search_articles
 from ethics_categories import ETHICS_CATEGORIES
+from cache import cache_stats
+from models import RetrievalError
 
 app = Flask(__name__)
 CORS(app)
 
+_started = threading.Event()
+
+@app.before_request
+def start_background_work():
+    """On the first request, however the app is served (python server.py, waitress-serve server:app...):
+    start the refresh worker and load the company search index in the background"""
+    if _started.is_set():
+        return
+    _started.set()
+    refresh_scheduler.start()  # no-op if already running
+    threading.Thread(target=refresh_company_index, name="company-index", daemon=True).start()
+
 @app.get("/search") #?query
 def search_company(): 
     """Search company endpoint. 
@@ -46,43 +62,104 @@ def get_company(company):
     return jsonify(json), code
 
 
-@app.get("/articles/") #?company, page, category = none
+@app.get("/articles/") #?company, page | cursor, category = none
 def get_articles():
+    """Articles endpoint. Paginate with either `page` (page number) or `cursor`.
+    Cursor mode: pass an empty `cursor` for the first page, then the returned `next_cursor`
+    until it is null.
+    """
     args = request.args
     company = args.get("company")
     category = args.get("category", None)
     page = args.get("page")
+    cursor = args.get("cursor")
     
     if category and (category.lower() == "null" or category.lower() == "none"):
         category = None
         
-    if not (company and page):
-        json = {"Error": f"Missing one or more required parameters: 'company', 'page'"}
+    if not (company and (page or cursor is not None)):
+        json = {"Error": f"Missing one or more required parameters: 'company', 'page' (or 'cursor')"}
         code = 400
     
     elif category not in ETHICS_CATEGORIES and category is not None:
         json = {"Error": f"Category must be one of the following: {', '.join(ETHICS_CATEGORIES.keys())} or None"}
         code = 400
     else:
-        try:
-            articles = fetch_articles(company, int(page), category)
-        except Exception as e:
-            if str(e)[:4] == "page":
+        #one connection and one read of the 'found' table for the whole request
+        with request_scope():
+            next_cursor = None
+            try:
+                if cursor is not None:
+                    articles, next_cursor = fetch_articles_after(company, cursor or None, category)
+                else:
+                    articles = fetch_articles(company, int(page), category)
+            except ValueError as e: #bad page number or cursor
+                json = {"Error": str(e)}
                 code = 400
-            elif str(e)[:3] == "API":
-                code = 403
-            else: #company doesn't exist in db
-                print(e)
-                code = 404
+            except Exception as e:
+                if str(e)[:4] == "page":
+                    code = 400
+                elif str(e)[:3] == "API":
+                    code = 403
+                elif isinstance(e, RetrievalError): #stored what succeeded, try again later
+                    print(e)
+                    code = 502
+                else: #company doesn't exist in db
+                    print(e)
+                    code = 404
+                json = {"Error": str(e)}
+                
+            else:
+                found = get_all_found(company)
+                json = {"articles": [article.to_json() for article in articles], "found": found,
+                        "stored": get_all_stored(company)}
+                if cursor is not None:
+                    json["next_cursor"] = next_cursor
+                code = 200
+    
+    return jsonify(json), code
+
+@app.get("/articles/search") #?q, company = none, category = none, from = none, to = none, cursor = none
+def search_articles_endpoint():
+    """Full-text search of stored article headlines and descriptions, newest first.
+    `from`/`to` are ISO dates (from inclusive, to exclusive). Paginate with the returned
+    `next_cursor` until it is null.
+    """
+    args = request.args
+    text = args.get("q")
+    category = args.get("category", None)
+
+    if category and (category.lower() == "null" or category.lower() == "none"):
+        category = None
+
+    if not text:
+        json = {"Error": "Missing required search parameter 'q'"}
+        code = 400
+    elif category not in ETHICS_CATEGORIES and category is not None:
+        json = {"Error": f"Category must be one of the following: {', '.join(ETHICS_CATEGORIES.keys())} or None"}
+        code = 400
+    else:
+        try:
+            start = datetime.fromisoformat(args["from"]) if args.get("from") else None
+            end = datetime.fromisoformat(args["to"]) if args.get("to") else None
+            articles, next_cursor = search_articles(text, args.get("company") or None, category, start, end,
+                                                    args.get("cursor") or None)
+        except ValueError as e: #bad date, cursor or query
             json = {"Error": str(e)}
-            
+            code = 400
         else:
-            found = get_all_found(company)
-            json = {"articles": [article.to_json() for article in articles], "found": found}
+            json = {"articles": [article.to_json() for article in articles], "next_cursor": next_cursor}
             code = 200
-    
+
     return jsonify(json), code
 
+@app.get("/stats")
+def get_stats():
+    """Runtime counters for monitoring (connection pool, GNEWS budget, caches, refresh worker, GNEWS HTTP client, coalesced retrievals)"""
+    json = {"db_pool": pool_stats(), "gnews": gnews_budget(), "cache": cache_stats(), "refresh": refresh_scheduler.get_stats(),
+            "http": gnews_client.get_stats(), "retrievals": retrievals.get_stats()}
+    return jsonify(json), 200
+
 if __name__ =='__main__':
     app.run(debug=True)
     # serve(app, host = "0.0.0.0", port=8080) 
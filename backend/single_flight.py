@@ -0,0 +1,95 @@
+"""
+Single-flight call coalescing: concurrent calls with the same key share one execution.
+
+The first caller of a key runs the function, callers arriving while it runs wait for it and
+get its result (or exception) instead of running it again. Used so simultaneous requests for
+the same cold company page trigger one GNEWS retrieval rather than one each.
+"""
+
+import asyncio
+import threading
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}  # key: _Call in flight
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0, "in_flight": 0}
+
+    def do(self, key, fn):
+        """Run fn(), unless a call with key is already running on another thread, then wait for it
+
+        Returns:
+            fn's result, or the running call's result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["calls"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop"""
+
+    def __init__(self):
+        self._calls = {}  # key: Future of the call in flight
+        self.stats = {"calls": 0, "coalesced": 0, "in_flight": 0}
+
+    async def do(self, key, fn):
+        """Await fn(), unless a call with key is already running, then await its result"""
+        future = self._calls.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            # shield: a cancelled waiter must not cancel the shared call
+            return await asyncio.shield(future)
+
+        self.stats["calls"] += 1
+        future = self._calls[key] = asyncio.ensure_future(fn())
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                del self._calls[key]
+            else:
+                future.add_done_callback(lambda _: self._calls.pop(key, None))
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["in_flight"] = len(self._calls)
+        return stats
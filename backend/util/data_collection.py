@@ -8,10 +8,18 @@ Thank you wikidata !
 """
 
 import time
+import os
+import threading
+import gzip
+import json
+import codecs
+from html.parser import HTMLParser
+from functools import lru_cache
 from bs4 import BeautifulSoup
 import requests
 import re
-from hashlib import md5
+from hashlib import md5, sha256
+from urllib.parse import unquote
 
 
 # For encoding printing error (quick fix)
@@ -26,12 +34,354 @@ headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
 }
 
+# Backend modules (appended, so this directory's config.py still wins)
+backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if backend_dir not in sys.path:
+    sys.path.append(backend_dir)
+from http_client import HTTPClient
+
+# Requests per second per host, shared by every thread so parallel lookups stay polite
+HOST_RATES = {
+    "www.wikidata.org": 5,
+    "en.wikipedia.org": 5,
+    "query.wikidata.org": 2,
+}
+DEFAULT_HOST_RATE = 2
+
+# Every fetch goes through this client: kept-alive connections, retries, and an HTTP cache
+# revalidating stored pages (ETag / Last-Modified) so a rebuild only downloads what changed
+HTTP_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".http_cache")
+client = HTTPClient(cache_dir=HTTP_CACHE_DIR, rates=HOST_RATES, default_rate=DEFAULT_HOST_RATE, pool_maxsize=16)
+
+
+def http_get(url: str, **kwargs):
+    """GET through the shared client (see http_client.HTTPClient.get), waiting on the host's rate limit first"""
+    return client.get(url, **kwargs)
+
+
+# Wikidata searches and SPARQL results are cached on disk as gzipped JSON named by the sha256
+# of their key, so each one is downloaded once per build (fetched past the HTTP cache, one layer
+# is enough). Entities are only in the HTTP cache, revalidated each build so edits are picked up.
+# Set WIKIDATA_OFFLINE=1 to rebuild from the caches only (expired entries are used and stored
+# entities aren't revalidated, nothing is fetched unless missing), and
+# WIKIDATA_CACHE_DIR to use another directory (e.g. an empty one, to query sparql_standin.py)
+CACHE_DIR = os.environ.get("WIKIDATA_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".wikidata_cache")
+CACHE_TTL = 7 * 24 * 3600
+OFFLINE = os.environ.get("WIKIDATA_OFFLINE") == "1"
+MISSING = object()
+
+
+def cache_path(key: str, cache_dir: str = None):
+    return os.path.join(cache_dir or CACHE_DIR, sha256(key.encode("utf-8")).hexdigest() + ".json.gz")
+
+
+def cache_read(key: str, ttl: float = CACHE_TTL, expired: bool = False):
+    """Cached JSON for key, MISSING if absent or older than ttl (unless expired or OFFLINE)"""
+    path = cache_path(key)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age < ttl or expired or OFFLINE:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return MISSING
+
+
+def cache_write(key: str, data):
+    path = cache_path(key)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def cached_json(key: str, fetch, ttl: float = CACHE_TTL):
+    """Return JSON for key from the disk cache, or call fetch() and cache its result.
+    If fetching fails, an expired entry is used when there is one
+
+    Args:
+        key (str): cache key, e.g. "entity:Q312"
+        fetch (callable): returns the JSON data
+        ttl (float, optional): seconds a cached entry is fresh. Defaults to CACHE_TTL.
+    """
+    data = cache_read(key, ttl)
+    if data is not MISSING:
+        return data
+
+    try:
+        data = fetch()
+    except (requests.exceptions.RequestException, ValueError):
+        data = cache_read(key, expired=True)
+        if data is MISSING:
+            raise
+        print(f"Using expired cache for {key}")
+        return data
+
+    cache_write(key, data)
+    return data
+
+
+@lru_cache(maxsize=64)
+def get_entity(qid: str):
+    """Get wikidata entity data (labels, aliases, claims, sitelinks...) of qid. Fetched once per run,
+    stored in the HTTP cache and revalidated (ETag / Last-Modified) by the next run
+
+    Args:
+        qid (str): wikidata id
+
+    Returns:
+        dict: entity, i.e. ["entities"][qid] of Special:EntityData/{qid}.json
+    """
+    data = http_get(entity_url + f"{qid}.json", timeout=30, max_age=float("inf") if OFFLINE else None).json()
+    entities = data["entities"]
+    # A redirected qid is returned under its target's id
+    return entities[qid] if qid in entities else next(iter(entities.values()))
+
+
+wikidata_api = "https://www.wikidata.org/w/api.php"
+# Overridable to point bulk_enrich at a local stand-in serving recorded responses
+sparql_endpoint = os.environ.get("WIKIDATA_SPARQL_ENDPOINT", "https://query.wikidata.org/sparql")
+# wbgetentities accepts up to 50 ids per request
+LABEL_BATCH_SIZE = 50
+
+# qid: English label (None if it has none), shared by every lookup in the run
+_labels = {}
+_labels_lock = threading.Lock()
+
+
+def get_labels(qids: list[str]):
+    """Get English labels of wikidata ids. Unknown ids are resolved in batches of 50 per
+    wbgetentities request, and every label is memoized (and cached on disk) for the rest of the run
+
+    Args:
+        qids (list[str]): wikidata ids
+
+    Returns:
+        dict: {qid: label or None}
+    """
+    with _labels_lock:
+        missing = [qid for qid in dict.fromkeys(qids) if qid not in _labels]
+
+    fetch = []
+    for qid in missing:
+        label = cache_read(f"label:{qid}")
+        if label is MISSING:
+            fetch.append(qid)
+        else:
+            with _labels_lock:
+                _labels[qid] = label
+
+    for i in range(0, len(fetch), LABEL_BATCH_SIZE):
+        batch = fetch[i:i + LABEL_BATCH_SIZE]
+        params = {
+            "action": "wbgetentities",
+            "ids": "|".join(batch),
+            "props": "labels",
+            "languages": "en",
+            "format": "json"
+        }
+        entities = http_get(wikidata_api, params=params, timeout=30, cache=False).json().get("entities", {})
+
+        # Redirected ids come back under their target's id
+        redirects = {entity["redirects"]["from"]: entity for entity in entities.values() if "redirects" in entity}
+        for qid in batch:
+            entity = entities.get(qid) or redirects.get(qid) or {}
+            label = entity.get("labels", {}).get("en", {}).get("value")
+            cache_write(f"label:{qid}", label)
+            with _labels_lock:
+                _labels[qid] = label
+
+    with _labels_lock:
+        return {qid: _labels.get(qid) for qid in qids}
+
+
+def get_industry_qids(qid: str):
+    """Get ids of a company's industries (claim "P452" https://www.wikidata.org/wiki/Property:P452)"""
+    qids = []
+    for industry_claim in get_entity(qid).get("claims", {}).get("P452", []):
+        try:
+            qids.append(industry_claim["mainsnak"]["datavalue"]["value"]["id"])
+        except (KeyError, TypeError):
+            continue
+    return qids
+
+
+def prefetch_industry_labels(company_qids: list[str]):
+    """Resolve the industry labels of many companies at once, so get_company_industries
+    only reads the memo: a few wbgetentities requests instead of one per industry claim"""
+    industry_qids = [industry for qid in company_qids if qid for industry in get_industry_qids(qid)]
+    get_labels(industry_qids)
+    print(f"Resolved {len(set(industry_qids))} industry labels")
 
-def get_description(company: str, id=None):
+
+# Class of the div holding the article body
+CONTENT_CLASS = "mw-content-ltr mw-parser-output"
+
+
+def clean_description(first: str, paragraphs: list[str]):
+    """Pick and clean the description out of the article's first paragraphs
+
+    Args:
+        first (str): text of the first class-less <p> directly in the content div, else of any class-less <p> in it
+        paragraphs (list[str]): text of the class-less <p> directly in the content div (at least the first two)
+
+    Returns:
+        str: description
+    """
+    description = first.strip()
+
+    # If wiki page has the coordinates listed first
+    if description and description[0].isdigit():
+        # Edge case if coordinate and desc are in the same <p>
+        if len(paragraphs) == 1:
+            lines = description.split('\n')
+            del lines[0]  # removes second line (index 1)
+            description = '\n'.join(lines)
+        else:
+            description = paragraphs[1]
+
+    # remove citations brackets ([9]) and pronounciation
+    description = re.sub(r'\[\d+\]', '', description)
+    description = re.sub(
+        r'\(([^()]*\/[^()]*?)\)', '', description)
+    return re.sub(r'\s{2,}', ' ', description).strip()
+
+
+def extract_description_soup(html):
+    """Description from a whole wikipedia page, parsed into a BeautifulSoup tree
+
+    Returns:
+        str: description, None if no paragraph was found
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    content_div = soup.find("div", {"class": CONTENT_CLASS})
+    if content_div is None:
+        return None
+
+    # class_=None: paragraphs without a class ({"class": ""} stopped matching those in bs4 4.13)
+    description = content_div.find("p", class_=None, recursive=False)
+    if not description:
+        description = content_div.find("p", class_=None, recursive=True)
+    if description is None:
+        return None
+
+    ps = content_div.find_all("p", class_=None, recursive=False)
+    return clean_description(description.get_text(), [p.get_text() for p in ps])
+
+
+class FirstParagraphParser(HTMLParser):
+    """Collects the paragraphs extract_description_soup would use, and sets `done` as soon as no
+    later markup can change the result, so the rest of the page doesn't need to be downloaded"""
+
+    VOID = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+    # get_text() leaves out the contents of these
+    HIDDEN = {"style", "script", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []  # open tags inside the content div, the div itself first
+        self.paragraphs = []  # text of class-less <p> directly in the div
+        self.nested = None  # text of the first class-less <p> anywhere in the div
+        self.done = False
+        self._p = None  # (stack depth, text parts, direct child) of the <p> being read
+        self._hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.done or tag in self.VOID:
+            return
+        attrs = dict(attrs)
+        if not self.stack:
+            if tag == "div" and attrs.get("class") == CONTENT_CLASS:
+                self.stack.append(tag)
+            return
+
+        self.stack.append(tag)
+        if tag in self.HIDDEN:
+            self._hidden += 1
+        elif tag == "p" and self._p is None and not attrs.get("class"):
+            direct = len(self.stack) == 2
+            if direct or self.nested is None:
+                self._p = (len(self.stack), [], direct)
+
+    def handle_endtag(self, tag):
+        if self.done or tag not in self.stack:
+            # Like the tree builder, end tags without an open tag are ignored
+            return
+        # Close everything up to the matching open tag
+        while self.stack:
+            closed = self.stack.pop()
+            if closed in self.HIDDEN:
+                self._hidden -= 1
+            if self._p and len(self.stack) < self._p[0]:
+                self._end_paragraph()
+            if closed == tag:
+                break
+        if not self.stack:
+            self.done = True  # end of the content div
+
+    def handle_data(self, data):
+        if self._p and not self._hidden:
+            self._p[1].append(data)
+
+    def _end_paragraph(self):
+        _, parts, direct = self._p
+        self._p = None
+        text = "".join(parts)
+        if direct:
+            self.paragraphs.append(text)
+            first = self.paragraphs[0].strip()
+            # A second paragraph is only needed when the first starts with coordinates
+            if len(self.paragraphs) >= 2 or not (first and first[0].isdigit()):
+                self.done = True
+        elif self.nested is None:
+            self.nested = text
+
+    def description(self):
+        if self.paragraphs:
+            return clean_description(self.paragraphs[0], self.paragraphs)
+        if self.nested is not None:
+            return clean_description(self.nested, self.paragraphs)
+        return None
+
+
+def extract_description_stream(chunks):
+    """Description from a wikipedia page given as text chunks, parsing stops after the paragraphs
+    needed. Same result as extract_description_soup
+
+    Args:
+        chunks (iterable[str]): page html
+
+    Returns:
+        str: description, None if no paragraph was found
+    """
+    parser = FirstParagraphParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:
+            break
+    else:
+        parser.close()
+    return parser.description()
+
+
+def iter_text(response, chunk_size: int = 16384):
+    """Decoded text chunks of a streamed response"""
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    for chunk in response.iter_content(chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def get_description(company: str, id=None, url: str = None, stream: bool = True):
     """Scrape company description from wikipedia (first paragraph)
 
     Args:
         company (str): Name of company
+        url (str, optional): wikipedia url if already known (e.g. from bulk_enrich). Defaults to None.
+        stream (bool, optional): parse the page incrementally and stop after the first paragraph,
+            instead of building a tree of the whole page. Defaults to True.
 
     Returns:
         description (str): Description of company
@@ -41,49 +391,20 @@ def get_description(company: str, id=None):
 
     description = None
     status_code = None
-    url = get_wikipedia_url(company, qid=id)
+    if url is None:
+        url = get_wikipedia_url(company, qid=id)
+
+    def parse(res):
+        if stream:
+            return extract_description_stream(iter_text(res))
+        return extract_description_soup(res.content)
 
     if url:
         try:
-            res = requests.get(url, timeout=10)
-            print(f"{company} code: {res.status_code}")
-            status_code = res.status_code
-
-            if res.status_code == 200:
-                soup = BeautifulSoup(res.content, "html.parser")
-
-                content_div = soup.find(
-                    "div", {"class": "mw-content-ltr mw-parser-output"})
-                description = content_div.find(
-                    "p", {"class": ""}, recursive=False)
-
-                if not description:
-                    description = content_div.find(
-                        "p", {"class": ""}, recursive=True)
-
-                # Paragraph found
-                if description is not None:
-                    description = description.get_text().strip()
-
-                    # If wiki page has the coordinates listed first
-                    if description[0].isdigit():
-                        ps = content_div.find_all(
-                            "p", {"class": ""}, recursive=False)
-                        # Edge case if coordinate and desc are in the same <p>
-                        if len(ps) == 1:
-                            lines = description.split('\n')
-                            del lines[0]  # removes second line (index 1)
-                            result = '\n'.join(lines)
-                            description = result
-                        else:
-                            description = ps[1]
-                            description = description.get_text()
-
-                    # remove citations brackets ([9]) and pronounciation
-                    description = re.sub(r'\[\d+\]', '', description)
-                    description = re.sub(
-                        r'\(([^()]*\/[^()]*?)\)', '', description)
-                    description = re.sub(r'\s{2,}', ' ', description).strip()
+            # Streamed and stopped after the first paragraph on a miss, the cache keeps the description
+            # and revalidates it, so an unchanged page isn't downloaded again
+            description, status_code = client.get_parsed(url, parse, "description", timeout=10)
+            print(f"{company} code: {status_code}")
 
         except requests.exceptions.RequestException as e:
             print(f"Failed to fetch company {company}")
@@ -124,10 +445,7 @@ def get_wikipedia_url(company_name: str, lang="en", qid=None):
         qid = get_qid(company_name)
 
     if qid:
-        # get data using qid
-        entity_url = f"https://www.wikidata.org/wiki/Special:EntityData/{qid}.json"
-        entity_data = requests.get(entity_url).json()
-        sitelinks = entity_data["entities"][qid].get("sitelinks", {})
+        sitelinks = get_entity(qid).get("sitelinks", {})
 
         wiki_key = f"{lang}wiki"
 
@@ -148,7 +466,7 @@ def get_fortune_500():
 
     # Iframe from https://www.50pros.com/fortune500
     url = "https://sheet2site.com/api/v3/index.php?key=1S-vhiXvvKFDczI6vAK_dZlGqe3ftxNraArOZIVGivGw&g=1&e=1&e=1"
-    res = requests.get(url, timeout=10)
+    res = http_get(url, timeout=10)
     print(f"code: {res.status_code}")
 
     if res.status_code == 200:
@@ -183,10 +501,7 @@ def get_aliases(name: str):
 
     entity_id = get_qid(name)
 
-    # Step 2: Get full entity data
-    entity_url = f"https://www.wikidata.org/wiki/Special:EntityData/{entity_id}.json"
-    entity_data = requests.get(entity_url).json()
-    entity = entity_data["entities"][entity_id]
+    entity = get_entity(entity_id)
 
     aliases = [alias["value"]
         for alias in entity.get("aliases", {}).get("en", [])]
@@ -194,6 +509,7 @@ def get_aliases(name: str):
     return aliases
 
 
+@lru_cache(maxsize=None)
 def get_qid(name: str):
     """Get qid from wikidata api: "https://www.wikidata.org/w/api.php"
 
@@ -210,14 +526,14 @@ def get_qid(name: str):
 
     company_suffixs = ["inc", "company", "holdings", "group"]
 
-    search_url = "https://www.wikidata.org/w/api.php"
+    search_url = wikidata_api
     params = {
         "action": "wbsearchentities",
         "search": name,
         "language": "en",
         "format": "json"
     }
-    response = requests.get(search_url, params=params).json()
+    response = cached_json(f"search:{name}", lambda: http_get(search_url, params=params, timeout=30, cache=False).json())
 
     if response["search"]:
         results = response["search"]
@@ -260,24 +576,8 @@ def get_company_industries(name: str, qid=None):
     industries = None
 
     if qid:
-        # get data using qid
-        entity_url = f"https://www.wikidata.org/wiki/Special:EntityData/{qid}.json"
-        entity_data = requests.get(entity_url).json()
-        entity = entity_data["entities"][qid]
-        claims = entity.get("claims", {})
-
-        # industry is claim "P452" https://www.wikidata.org/wiki/Property:P452
-        industries = []
-        if "P452" in claims:
-            for industry_claim in claims["P452"]:
-                try:
-                    industry_qid = industry_claim["mainsnak"]["datavalue"]["value"]["id"]
-                    industry_entity_url = f"https://www.wikidata.org/wiki/Special:EntityData/{industry_qid}.json"
-                    industry_entity = requests.get(industry_entity_url).json()
-                    industry_label = industry_entity["entities"][industry_qid]["labels"]["en"]["value"]
-                    industries.append(industry_label)
-                except:
-                    continue
+        labels = get_labels(get_industry_qids(qid))
+        industries = [label for label in labels.values() if label]
 
     if industries: return industries
     else: return None
@@ -298,9 +598,7 @@ def get_company_logo(name: str, id=None, get_url=True):
     logo = None
 
     if id:
-        entity_data = requests.get(entity_url + f"{id}.json").json()
-        entities = entity_data["entities"][id]
-        claims = entities.get("claims", {})
+        claims = get_entity(id).get("claims", {})
 
         if "P154" in claims:
 
@@ -310,7 +608,7 @@ def get_company_logo(name: str, id=None, get_url=True):
 
             if (not get_url):
                     
-                res = requests.get(url, headers=headers)
+                res = http_get(url, headers=headers)
                 if res.status_code == 200:
                     logo = res.content.decode("utf-8")
                 else:
@@ -357,10 +655,9 @@ def get_company_website(company_name:str, id = None):
         LIMIT 1
         """
         
-        url = "https://query.wikidata.org/sparql"
         headers = {"Accept": "application/sparql-results+json"}
 
-        response = requests.get(url, params={"query": query}, headers=headers)
+        response = http_get(sparql_endpoint, params={"query": query}, headers=headers)
 
         if response.ok:
             data = response.json()
@@ -380,11 +677,86 @@ def get_name(name:str, entity_id=None):
         entity_id = get_qid(name) 
 
     if entity_id:
-        # Step 2: Get full entity data
-        entity_url = f"https://www.wikidata.org/wiki/Special:EntityData/{entity_id}.json"
-        entity_data = requests.get(entity_url).json()
-        entity = entity_data["entities"][entity_id]
+        entity = get_entity(entity_id)
         
         new_name = entity["labels"].get("en")["value"]
         
-    return new_name
\ No newline at end of file
+    return new_name
+
+
+# Companies per bulk_enrich query (keeps the GET url well under limits)
+SPARQL_BATCH_SIZE = 100
+
+bulk_query = """
+SELECT ?item ?website ?logo ?industry ?industryLabel ?alias ?article WHERE {{
+  VALUES ?item {{ {values} }}
+  {{ ?item wdt:P856 ?website }}
+  UNION {{ ?item wdt:P154 ?logo }}
+  UNION {{ ?item wdt:P452 ?industry . ?industry rdfs:label ?industryLabel FILTER(LANG(?industryLabel) = "en") }}
+  UNION {{ ?item skos:altLabel ?alias FILTER(LANG(?alias) = "en") }}
+  UNION {{ ?article schema:about ?item ; schema:isPartOf <https://en.wikipedia.org/> }}
+}}"""
+
+
+def sparql_key(query: str):
+    """Cache key of a SPARQL response. Only the query, so responses recorded from Wikidata are
+    replayed whatever the endpoint (see sparql_standin.py)"""
+    return f"sparql:{query}"
+
+
+def bulk_enrich(qids: list[str], endpoint: str = None, batch_size: int = SPARQL_BATCH_SIZE):
+    """Fetch website, logo, industries, aliases and english wikipedia url of many companies with
+    a few VALUES-batched SPARQL queries, instead of separate requests per company and property.
+    Properties are UNIONed so rows don't multiply
+
+    Args:
+        qids (list[str]): wikidata ids of companies
+        endpoint (str, optional): SPARQL endpoint. Defaults to `sparql_endpoint`.
+        batch_size (int, optional): companies per query. Defaults to SPARQL_BATCH_SIZE.
+
+    Raises:
+        Exception: query failed
+
+    Returns:
+        dict: {qid: {"website", "logo", "industries", "aliases", "wikipedia"}}. website/logo/wikipedia
+            are None if not found, logo is an upload.wikimedia.org url as in get_company_logo
+    """
+    endpoint = endpoint or sparql_endpoint
+    qids = [qid for qid in dict.fromkeys(qids) if qid]
+    data = {qid: {"website": None, "logo": None, "industries": [], "aliases": [], "wikipedia": None} for qid in qids}
+
+    for i in range(0, len(qids), batch_size):
+        batch = qids[i:i + batch_size]
+        query = bulk_query.format(values=" ".join(f"wd:{qid}" for qid in batch))
+
+        def fetch():
+            response = http_get(endpoint, params={"query": query}, headers={"Accept": "application/sparql-results+json"},
+                                timeout=60, cache=False)
+            if not response.ok:
+                raise Exception(f"Query failed: {response.status_code}")
+            return response.json()
+
+        bindings = cached_json(sparql_key(query), fetch)["results"]["bindings"]
+
+        for row in bindings:
+            qid = row["item"]["value"].rsplit("/", 1)[-1]
+            if qid not in data:
+                continue
+            company = data[qid]
+
+            if "website" in row and company["website"] is None:
+                company["website"] = row["website"]["value"]
+            elif "logo" in row and company["logo"] is None:
+                # commons Special:FilePath url, convert to the same upload url as get_company_logo
+                filename = unquote(row["logo"]["value"].rsplit("/", 1)[-1])
+                company["logo"] = get_commons_image_url(filename)
+            elif "industryLabel" in row and row["industryLabel"]["value"] not in company["industries"]:
+                company["industries"].append(row["industryLabel"]["value"])
+            elif "alias" in row:
+                company["aliases"].append(row["alias"]["value"])
+            elif "article" in row:
+                company["wikipedia"] = row["article"]["value"]
+
+        print(f"bulk_enrich: {min(i + batch_size, len(qids))}/{len(qids)} companies")
+
+    return data
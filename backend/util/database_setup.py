@@ -4,9 +4,17 @@ Utility script to create database and table structures as well as populate the
 tables with scraped company data. 
 """
 import time
+import os
+import sys
+import subprocess
 from pymysql import connect, Error
 from config import db_host, db_pass, db_user, db_name
-from data_collection import get_fortune_500, get_company_description, get_company_industries, get_aliases, get_company_website, get_company_logo, get_name, get_qid
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from data_collection import get_fortune_500, get_company_description, get_company_industries, get_aliases, get_company_website, get_company_logo, get_name, get_qid, prefetch_industry_labels, bulk_enrich, get_description, client as http_client
+# data_collection puts /backend on sys.path
+from cache import COMPANY_VERSION_BUMP
 EC_keys = ['labor', 'environment', 'privacy', 'governance', 'diversity', 'human rights', 'consumer safety', 'animal welfare']
 
 def create_tables():
@@ -53,8 +61,11 @@ def create_tables():
                 source TEXT NOT NULL,
                 published_date TIMESTAMP,
                 retrieved TIMESTAMP NOT NULL,
+                url_hash BINARY(16) AS (UNHEX(MD5(url))) PERSISTENT,
                 
-                UNIQUE(url(255))
+                UNIQUE url_hash (url_hash),
+                INDEX published (published_date, id),
+                FULLTEXT INDEX text_search (title, description)
                 )"""
                 
             categories_query = """
@@ -63,6 +74,7 @@ def create_tables():
                 category VARCHAR(255) NOT NULL,
                 
                 PRIMARY KEY (id, category),
+                INDEX category_id (category, id),
                 FOREIGN KEY (id) REFERENCES articles(id) ON DELETE CASCADE,
                 FOREIGN KEY (category) REFERENCES ethics_categories(category) ON DELETE CASCADE
                 )"""
@@ -86,15 +98,94 @@ def create_tables():
                 FOREIGN KEY (category) REFERENCES ethics_categories(category)
                 )"""
             
-            articles_companies_query = """CREATE TABLE articles_companies(
+            articles_companies_query = """CREATE TABLE IF NOT EXISTS articles_companies(
                 id BIGINT UNSIGNED NOT NULL,
                 company VARCHAR(50) NOT NULL,
                 PRIMARY KEY (id, company),
+                INDEX company_id (company, id),
+                FOREIGN KEY (id) REFERENCES articles(id) ON DELETE CASCADE,
+                FOREIGN KEY (company) REFERENCES companies(name) ON DELETE CASCADE
+                )"""
+                
+            api_usage_query = """
+            CREATE TABLE IF NOT EXISTS api_usage(
+                api VARCHAR(50) NOT NULL,
+                day DATE NOT NULL,
+                used INT NOT NULL DEFAULT 0,
+                
+                PRIMARY KEY (api, day)
+                )"""
+                
+            # Shared GNEWS request rate (rate_limit.SharedTokenBucket): when the next request may be sent
+            rate_limits_query = """
+            CREATE TABLE IF NOT EXISTS rate_limits(
+                name VARCHAR(50) PRIMARY KEY,
+                next_free DOUBLE NOT NULL DEFAULT 0
+                )"""
+                
+            # Read model of article pages: one row per article, company and category ('' for the
+            # company-wide rows) with everything a page shows, maintained by insert_articles
+            article_index_query = """
+            CREATE TABLE IF NOT EXISTS article_index(
+                company VARCHAR(50) NOT NULL,
+                category VARCHAR(255) NOT NULL,
+                id BIGINT UNSIGNED NOT NULL,
+                title TEXT NOT NULL,
+                description TEXT,
+                url TEXT NOT NULL,
+                source TEXT NOT NULL,
+                published_date TIMESTAMP NULL DEFAULT NULL,
+                retrieved TIMESTAMP NULL DEFAULT NULL,
+                categories TEXT,
+
+                PRIMARY KEY (company, category, id),
+                INDEX page (company, category, published_date, id),
+                INDEX article (id),
                 FOREIGN KEY (id) REFERENCES articles(id) ON DELETE CASCADE,
                 FOREIGN KEY (company) REFERENCES companies(name) ON DELETE CASCADE
                 )"""
+
+            # Stored articles per company and category, maintained by insert_articles so article
+            # counts are a primary key lookup. category '' is the company's total
+            article_counts_query = """
+            CREATE TABLE IF NOT EXISTS article_counts(
+                company VARCHAR(50) NOT NULL,
+                category VARCHAR(255) NOT NULL,
+                stored INT NOT NULL DEFAULT 0,
+
+                PRIMARY KEY (company, category)
+                )"""
+                
+            job_checkpoints_query = """
+            CREATE TABLE IF NOT EXISTS job_checkpoints(
+                job VARCHAR(50) PRIMARY KEY,
+                position BIGINT UNSIGNED NOT NULL,
+                updated TIMESTAMP
+                )"""
+                
+            population_progress_query = """
+            CREATE TABLE IF NOT EXISTS population_progress(
+                name varchar(50) PRIMARY KEY,
+                qid varchar(20),
+                description_done BOOLEAN NOT NULL DEFAULT FALSE,
+                industries_done BOOLEAN NOT NULL DEFAULT FALSE,
+                website_done BOOLEAN NOT NULL DEFAULT FALSE,
+                logo_done BOOLEAN NOT NULL DEFAULT FALSE,
+                updated TIMESTAMP
+                )"""
+                
+            # Bumped by companies_changed() so running servers drop their cached company data (cache.py)
+            data_versions_query = """
+            CREATE TABLE IF NOT EXISTS data_versions(
+                name VARCHAR(50) PRIMARY KEY,
+                version BIGINT UNSIGNED NOT NULL DEFAULT 0
+                )"""
                 
             with connection.cursor() as cursor:
+                # An existing database may predate some revisions, it is brought up to date by migrate()
+                cursor.execute("SHOW TABLES LIKE 'articles'")
+                existing = len(cursor.fetchall()) > 0
+
                 cursor.execute(companies_query)
                 cursor.execute(ethics_categories_query)
                 cursor.execute(industries_query)
@@ -103,15 +194,203 @@ def create_tables():
                 cursor.execute(categories_query)
                 cursor.execute(found_query)
                 cursor.execute(articles_companies_query)
+                cursor.execute(api_usage_query)
+                cursor.execute(rate_limits_query)
+                cursor.execute(article_counts_query)
+                cursor.execute(article_index_query)
+                cursor.execute(job_checkpoints_query)
+                cursor.execute(population_progress_query)
+                cursor.execute(data_versions_query)
+
+                # New database: the tables above are the latest revision, record it without running MIGRATIONS
+                if not existing:
+                    cursor.execute(schema_migrations_query)
+                    cursor.executemany("INSERT IGNORE INTO schema_migrations (version, name, applied) VALUES (%s, %s, NOW())",
+                                       [(version, name) for version, name, _ in MIGRATIONS])
                 
             connection.commit()
             
             print("Tables Created")
     except Error as e:
         print(e)
+        return
 
+    if existing:
+        migrate()
     return
 
+# Schema revisions applied to existing databases by migrate(), in order: (version, name, statements).
+# Statements must be idempotent (IF [NOT] EXISTS), create_tables() already has the latest schema
+MIGRATIONS = [
+    (1, "pagination and full-text indexes", [
+        "CREATE INDEX IF NOT EXISTS published ON articles (published_date, id)",
+        "CREATE INDEX IF NOT EXISTS company_id ON articles_companies (company, id)",
+        "CREATE INDEX IF NOT EXISTS category_id ON categories (category, id)",
+        "CREATE FULLTEXT INDEX IF NOT EXISTS text_search ON articles (title, description)",
+    ]),
+    (2, "stored article counts", [
+        """CREATE TABLE IF NOT EXISTS article_counts(
+            company VARCHAR(50) NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            stored INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (company, category))""",
+        "DELETE FROM article_counts",
+        "INSERT INTO article_counts (company, category, stored) SELECT company, '', count(*) FROM articles_companies GROUP BY company",
+        """INSERT INTO article_counts (company, category, stored)
+        SELECT ac.company, c.category, count(*) FROM articles_companies ac
+        JOIN categories c ON c.id = ac.id GROUP BY ac.company, c.category""",
+    ]),
+    # Full url uniqueness: UNIQUE(url(255)) only compared the first 255 characters
+    (3, "url hash", [
+        "ALTER TABLE articles ADD COLUMN IF NOT EXISTS url_hash BINARY(16) AS (UNHEX(MD5(url))) PERSISTENT AFTER retrieved",
+        "CREATE UNIQUE INDEX IF NOT EXISTS url_hash ON articles (url_hash)",
+        "DROP INDEX IF EXISTS url ON articles",
+    ]),
+    # Company pages and oldest dates read the company's articles in date order from the index
+    (4, "company links in date order", [
+        "ALTER TABLE articles_companies ADD COLUMN IF NOT EXISTS published_date TIMESTAMP NULL DEFAULT NULL",
+        "UPDATE articles_companies ac JOIN articles a ON a.id = ac.id SET ac.published_date = a.published_date",
+        "CREATE INDEX IF NOT EXISTS company_published ON articles_companies (company, published_date, id)",
+        "DROP INDEX IF EXISTS company_id ON articles_companies",
+    ]),
+    # Filled in one pass here, on a large database stop the server during it
+    (5, "article_index read model", [
+        """CREATE TABLE IF NOT EXISTS article_index(
+            company VARCHAR(50) NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            id BIGINT UNSIGNED NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            url TEXT NOT NULL,
+            source TEXT NOT NULL,
+            published_date TIMESTAMP NULL DEFAULT NULL,
+            retrieved TIMESTAMP NULL DEFAULT NULL,
+            categories TEXT,
+            PRIMARY KEY (company, category, id),
+            INDEX page (company, category, published_date, id),
+            INDEX article (id),
+            FOREIGN KEY (id) REFERENCES articles(id) ON DELETE CASCADE,
+            FOREIGN KEY (company) REFERENCES companies(name) ON DELETE CASCADE)""",
+        "DELETE FROM article_index",
+        """INSERT INTO article_index (company, category, id, title, description, url, source, published_date, retrieved, categories)
+        SELECT ac.company, '', a.id, a.title, a.description, a.url, a.source, a.published_date, a.retrieved,
+            (SELECT GROUP_CONCAT(p.category ORDER BY p.category SEPARATOR ',') FROM categories p WHERE p.id = a.id)
+        FROM articles a
+        JOIN articles_companies ac ON ac.id = a.id""",
+        """INSERT INTO article_index (company, category, id, title, description, url, source, published_date, retrieved, categories)
+        SELECT ac.company, c.category, a.id, a.title, a.description, a.url, a.source, a.published_date, a.retrieved,
+            (SELECT GROUP_CONCAT(p.category ORDER BY p.category SEPARATOR ',') FROM categories p WHERE p.id = a.id)
+        FROM articles a
+        JOIN articles_companies ac ON ac.id = a.id
+        JOIN categories c ON c.id = a.id""",
+    ]),
+    # Tables create_tables() added without a migration: shared GNEWS quota, job checkpoints
+    # (recategorize.py) and population progress (populate_pipeline, populate_bulk)
+    (6, "quota, checkpoint and population progress tables", [
+        """CREATE TABLE IF NOT EXISTS api_usage(
+            api VARCHAR(50) NOT NULL,
+            day DATE NOT NULL,
+            used INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (api, day))""",
+        """CREATE TABLE IF NOT EXISTS job_checkpoints(
+            job VARCHAR(50) PRIMARY KEY,
+            position BIGINT UNSIGNED NOT NULL,
+            updated TIMESTAMP)""",
+        """CREATE TABLE IF NOT EXISTS population_progress(
+            name varchar(50) PRIMARY KEY,
+            qid varchar(20),
+            description_done BOOLEAN NOT NULL DEFAULT FALSE,
+            industries_done BOOLEAN NOT NULL DEFAULT FALSE,
+            website_done BOOLEAN NOT NULL DEFAULT FALSE,
+            logo_done BOOLEAN NOT NULL DEFAULT FALSE,
+            updated TIMESTAMP)""",
+    ]),
+    (7, "data versions", [
+        """CREATE TABLE IF NOT EXISTS data_versions(
+            name VARCHAR(50) PRIMARY KEY,
+            version BIGINT UNSIGNED NOT NULL DEFAULT 0)""",
+    ]),
+    # Pages are read from article_index, the company links' dates (migration 4) are unused.
+    # company_id takes over the company foreign key and search's company filter
+    (8, "drop company link dates", [
+        "CREATE INDEX IF NOT EXISTS company_id ON articles_companies (company, id)",
+        "DROP INDEX IF EXISTS company_published ON articles_companies",
+        "ALTER TABLE articles_companies DROP COLUMN IF EXISTS published_date",
+    ]),
+    (9, "shared rate limits", [
+        """CREATE TABLE IF NOT EXISTS rate_limits(
+            name VARCHAR(50) PRIMARY KEY,
+            next_free DOUBLE NOT NULL DEFAULT 0)""",
+    ]),
+]
+
+
+schema_migrations_query = """
+CREATE TABLE IF NOT EXISTS schema_migrations(
+    version INT PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied TIMESTAMP NULL DEFAULT NULL
+    )"""
+
+
+def migrate(check_plans: bool = True):
+    """Apply the MIGRATIONS not yet recorded in schema_migrations, each committed on its own.
+    If any were applied, the hot article queries' plans are checked (query_plans.py)
+
+    Args:
+        check_plans (bool, optional): run the query plan check after applying migrations. Defaults to True.
+
+    Raises:
+        AssertionError: a query no longer uses its index after the migrations
+
+    Returns:
+        list[int]: versions applied
+    """
+    applied = []
+    try:
+        with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(schema_migrations_query)
+                cursor.execute("SELECT version FROM schema_migrations")
+                done = {x[0] for x in cursor.fetchall()}
+
+                for version, name, statements in MIGRATIONS:
+                    if version in done:
+                        continue
+                    print(f"Migration {version}: {name}")
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_migrations (version, name, applied) VALUES (%s, %s, NOW())",
+                                   (version, name))
+                    connection.commit()
+                    applied.append(version)
+
+            print(f"Schema at version {max(done | set(applied), default=0)}")
+    except Error as e:
+        print(e)
+
+    if applied and check_plans:
+        # Own process: query_plans uses /backend's config and database_functions
+        backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if subprocess.run([sys.executable, "query_plans.py"], cwd=backend_dir).returncode:
+            raise AssertionError("Query plans regressed after migrations, see query_plans.py output above")
+    return applied
+
+def companies_changed():
+    """Tell running servers companies changed: they drop their cached company data and search
+    index when they see the bumped version (see cache.py)"""
+    try:
+        with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(COMPANY_VERSION_BUMP)
+            connection.commit()
+    except Error as e:
+        print(e)
+
+def create_indexes():
+    """Bring a database created before the current indexes up to date, see migrate()"""
+    return migrate()
+
 def populate_companies():
     """
     Inserts name and description of fortune 500 companies into "companies" table. 
@@ -141,6 +420,7 @@ def populate_companies():
                 time.sleep(1)
                 
         connection.commit()
+    companies_changed()
     return None
 
 def populate_industries():
@@ -157,6 +437,9 @@ def populate_industries():
                 cursor.execute("DELETE FROM industries")
                 cursor.execute("SELECT name FROM companies")
                 results = cursor.fetchall()
+
+                #Batch resolve every company's industry labels up front
+                prefetch_industry_labels([get_qid(row[0]) for row in results])
                 
                 for row in results:
                     name = row[0]
@@ -168,6 +451,7 @@ def populate_industries():
                             cursor.execute(query, (name, industry))
                     
             connection.commit()
+            companies_changed()
                     
     except Error as e:
         print(e)
@@ -190,6 +474,7 @@ def drop_tables():
                 
                 cursor.execute("DROP TABLE IF EXISTS companies")
             connection.commit()
+            companies_changed()
                 
     except Error as e:
         print(e)
@@ -238,6 +523,7 @@ def insert_company(name: str):
                                     print(f"{name} - inserted")
                                     inserted = True
                     connection.commit()
+                    companies_changed()
             
             except Error as e:
                 print(e)
@@ -263,6 +549,7 @@ def insert_alias(name:str):
                 else:
                     print(f"{name} could not be found in companies table")    
             connection.commit()        
+            companies_changed()
     except Error as e:
         print(e)
 
@@ -298,6 +585,7 @@ def populate_websites():
                         print(e)
                         
                 connection.commit()
+                companies_changed()
 
     except Error as e:
 
@@ -341,13 +629,213 @@ def populate_logos():
                     
                 time.sleep(.5)
         connection.commit()
+    companies_changed()
+
+
+# Pipeline fields: function(name, qid) fetching the value
+PIPELINE_FIELDS = {
+    "description": get_company_description,
+    "industries": get_company_industries,
+    "website": get_company_website,
+    "logo": get_company_logo,
+}
+
+def collect_company(name: str, qid: str, fields: list[str]):
+    """Resolve the company's qid (if not known) once, then fetch `fields` concurrently.
+    Request rates per host are limited in data_collection.http_get
+
+    Returns:
+        (qid, {field: value}) - fields that raised are left out so they are retried next run
+    """
+    if not qid:
+        qid = get_qid(name)
+    values = {}
+    if not qid:
+        return qid, values
+
+    with ThreadPoolExecutor(max_workers=len(fields) or 1) as executor:
+        futures = {field: executor.submit(PIPELINE_FIELDS[field], name, qid) for field in fields}
+        for field, future in futures.items():
+            try:
+                values[field] = future.result()
+            except Exception as e:
+                print(f"{name} - {field}: {e}")
+    return qid, values
+
+def populate_pipeline(names: list[str] = None, workers: int = 4, retry_missing: bool = False):
+    """Populate companies, industries, websites and logos in one parallel, resumable pass.
+
+    Replaces running populate_companies/populate_industries/populate_websites/populate_logos
+    one after another. Progress is checkpointed per company in `population_progress`, so an
+    interrupted run resumes where it stopped and a re-run only fetches what is missing.
+
+    Args:
+        names (list[str], optional): companies to populate. Defaults to the fortune 500 plus every company in the table.
+        workers (int, optional): companies processed concurrently. Defaults to 4.
+        retry_missing (bool, optional): also retry fields already attempted which are still empty
+            (e.g. wikidata has since added a logo). Defaults to False.
+    """
+    with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
+        with connection.cursor() as cursor:
+            if names is None:
+                names = [company[1].capitalize() for company in get_fortune_500()]
+                cursor.execute("SELECT name FROM companies")
+                names += [x[0] for x in cursor.fetchall()]
+            names = list(dict.fromkeys(name.capitalize() for name in names))
+
+            cursor.execute("""
+            SELECT p.name, p.qid, p.description_done, p.industries_done, p.website_done, p.logo_done,
+                c.description IS NULL, c.website IS NULL, c.logo_url IS NULL,
+                NOT EXISTS (SELECT 1 FROM industries i WHERE i.name = p.name)
+            FROM population_progress p
+            LEFT JOIN companies c ON c.name = p.name""")
+            progress = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        # fields still to fetch per company
+        todo = {}
+        for name in names:
+            qid, *done = progress.get(name, (None, False, False, False, False, True, True, True, True))
+            done, missing = done[:4], done[4:]
+            missing = dict(zip(["description", "website", "logo", "industries"], missing))
+            fields = [field for field, field_done in zip(PIPELINE_FIELDS, done)
+                      if not field_done or (retry_missing and missing[field])]
+            if fields:
+                todo[name] = (qid, fields)
+
+        print(f"{len(todo)}/{len(names)} companies to populate")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(collect_company, name, qid, fields): (name, fields)
+                       for name, (qid, fields) in todo.items()}
+
+            #Writes stay on this thread and connection, one commit (checkpoint) per company
+            for future in as_completed(futures):
+                name, fields = futures[future]
+                try:
+                    qid, values = future.result()
+                    store_company(connection, name, qid, values)
+                    connection.commit()
+                    print(f"{name} ({qid}): {', '.join(values) or 'nothing found'}")
+                except Exception as e:
+                    connection.rollback()
+                    print(f"{name}: {e}")
+
+    companies_changed()
+    print(f"http: {http_client.get_stats()}")
+
+def store_company(connection, name: str, qid: str, values: dict):
+    """Write fetched fields of a company and mark them done in population_progress"""
+    description = values.get("description")
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM companies WHERE name = %s", (name, ))
+        exists = bool(cursor.fetchall())
+
+        #Like populate_companies, only add companies a description was found for
+        if exists or description:
+            cursor.execute("""
+            INSERT INTO companies (name, description, website, logo_url)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                description = COALESCE(VALUES(description), description),
+                website = COALESCE(VALUES(website), website),
+                logo_url = COALESCE(VALUES(logo_url), logo_url)""",
+                (name, description, values.get("website"), values.get("logo")))
+
+            if values.get("industries"):
+                cursor.executemany("INSERT IGNORE INTO industries (name, industry) VALUES (%s, %s)",
+                                   [(name, industry) for industry in values["industries"]])
+            done = {field: field in values for field in PIPELINE_FIELDS}
+        else:
+            #No qid or description found, company is skipped (retry_missing tries again)
+            skipped = "description" in values or not qid
+            done = {field: skipped for field in PIPELINE_FIELDS}
+
+        cursor.execute("""
+        INSERT INTO population_progress (name, qid, description_done, industries_done, website_done, logo_done, updated)
+        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+        ON DUPLICATE KEY UPDATE
+            qid = COALESCE(VALUES(qid), qid),
+            description_done = description_done OR VALUES(description_done),
+            industries_done = industries_done OR VALUES(industries_done),
+            website_done = website_done OR VALUES(website_done),
+            logo_done = logo_done OR VALUES(logo_done),
+            updated = NOW()""",
+            (name, qid, done["description"], done["industries"], done["website"], done["logo"]))
+
+def populate_bulk(names: list[str] = None, endpoint: str = None, workers: int = 4):
+    """Populate companies, industries, websites, logos and aliases using data_collection.bulk_enrich:
+    a few batched SPARQL queries for every company instead of several requests per company.
+    Only descriptions (scraped from wikipedia) are still fetched per company, and only if missing.
+
+    Args:
+        names (list[str], optional): companies to populate. Defaults to the fortune 500 plus every company in the table.
+        endpoint (str, optional): SPARQL endpoint, e.g. sparql_standin.py replaying recorded responses.
+            Defaults to data_collection.sparql_endpoint.
+        workers (int, optional): concurrent qid lookups and description fetches. Defaults to 4.
+    """
+    with connect(host=db_host, user=db_user, password=db_pass, database=db_name) as connection:
+        with connection.cursor() as cursor:
+            if names is None:
+                names = [company[1].capitalize() for company in get_fortune_500()]
+                cursor.execute("SELECT name FROM companies")
+                names += [x[0] for x in cursor.fetchall()]
+            names = list(dict.fromkeys(name.capitalize() for name in names))
+
+            cursor.execute("""
+            SELECT p.name, p.qid FROM population_progress p WHERE p.qid IS NOT NULL""")
+            qids = dict(cursor.fetchall())
+            cursor.execute("SELECT name FROM companies WHERE description IS NOT NULL")
+            described = {x[0] for x in cursor.fetchall()}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            unresolved = [name for name in names if name not in qids]
+            for name, qid in zip(unresolved, executor.map(get_qid, unresolved)):
+                qids[name] = qid
+
+            names = [name for name in names if qids.get(name)]
+            print(f"Enriching {len(names)} companies")
+            enriched = bulk_enrich([qids[name] for name in names], endpoint=endpoint)
+
+            def describe(name):
+                if name in described:
+                    return None
+                try:
+                    return get_description(name, qids[name], url=enriched[qids[name]]["wikipedia"])[0]
+                except Exception as e:
+                    print(f"{name} - description: {e}")
+                    return None
+
+            descriptions = dict(zip(names, executor.map(describe, names)))
+
+        for name in names:
+            data = enriched[qids[name]]
+            # A description already stored counts as done (None keeps it), so populate_pipeline doesn't fetch it again
+            values = {"industries": data["industries"], "website": data["website"], "logo": data["logo"],
+                      "description": descriptions[name]}
+            try:
+                store_company(connection, name, qids[name], values)
+                with connection.cursor() as cursor:
+                    #aliases longer than the column are left out, like company names above 50 chars
+                    aliases = [(name, alias) for alias in data["aliases"] if len(alias) <= 50]
+                    if aliases and (name in described or descriptions[name]):
+                        cursor.executemany("INSERT IGNORE INTO aliases (name, alias) VALUES (%s, %s)", aliases)
+                connection.commit()
+                print(f"{name} ({qids[name]}): {', '.join(field for field, value in values.items() if value) or 'nothing found'}")
+            except Error as e:
+                connection.rollback()
+                print(f"{name}: {e}")
 
+    companies_changed()
+    print(f"http: {http_client.get_stats()}")
 
 if __name__ == "__main__":
     #Uncomment this and run script to create database. Will take 20-30 minutes    
+    #(or run populate_pipeline() instead of the populate_* calls below, parallel and resumable,
+    # or populate_bulk() which fetches everything but descriptions in a few batched SPARQL queries)
     
     # drop_tables()
     create_tables()
+    # (existing database: create_tables() adds missing tables and applies new schema revisions with migrate())
     # populate_companies()
     # populate_websites()
     # populate_industries()
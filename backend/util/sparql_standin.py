@@ -0,0 +1,94 @@
+"""
+Local stand-in for the Wikidata SPARQL endpoint replaying recorded responses, so bulk_enrich
+and populate_bulk can be exercised (and timed) without querying Wikidata.
+
+Responses are recorded in data_collection's disk cache, keyed by query only (see
+data_collection.sparql_key): every bulk_enrich run against Wikidata records its queries.
+Queries without a recording are answered 404, or with --record forwarded to Wikidata and
+recorded.
+
+Run from /backend/util:
+    python sparql_standin.py --port 9100 --latency 0.2 [--record]
+
+Then query it with an empty WIKIDATA_CACHE_DIR, so bulk_enrich's own cache doesn't answer first:
+    WIKIDATA_CACHE_DIR=/tmp/wikidata_empty WIKIDATA_SPARQL_ENDPOINT=http://127.0.0.1:9100/sparql python database_setup.py
+(with populate_bulk() uncommented in its main), or pass endpoint= to bulk_enrich / populate_bulk.
+"""
+
+import os
+import sys
+import time
+import json
+import gzip
+import argparse
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from data_collection import CACHE_DIR, cache_path, sparql_key, http_get, headers as user_agent
+
+WIKIDATA_SPARQL = "https://query.wikidata.org/sparql"
+
+
+def standin_handler(recordings: str, latency: float, record: bool = False):
+    """Request handler answering SPARQL GETs from the recordings in directory `recordings` after `latency` seconds"""
+
+    class SparqlStandIn(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            query = parse_qs(urlparse(self.path).query).get("query", [""])[0]
+            path = cache_path(sparql_key(query), recordings)
+            try:
+                with gzip.open(path, "rb") as f:
+                    body = f.read()
+            except OSError:
+                body = self.record(query, path) if record else None
+
+            if body is None:
+                print(f"No recording for query {query[:80]!r}...")
+                self.send_error(404, "No recorded response")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/sparql-results+json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def record(self, query: str, path: str):
+            response = http_get(WIKIDATA_SPARQL, params={"query": query},
+                                headers={**user_agent, "Accept": "application/sparql-results+json"}, timeout=60)
+            if not response.ok:
+                print(f"Recording failed: {response.status_code}")
+                return None
+            data = response.json()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                json.dump(data, f)
+            print(f"Recorded query {query[:80]!r}...")
+            return json.dumps(data).encode("utf-8")
+
+    return SparqlStandIn
+
+
+def run_standin(port: int, latency: float, recordings: str, record: bool):
+    server = ThreadingHTTPServer(("127.0.0.1", port), standin_handler(recordings, latency, record))
+    print(f"SPARQL stand-in on http://127.0.0.1:{port}/sparql, replaying {recordings}, latency {latency}s")
+    server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Wikidata SPARQL stand-in replaying recorded responses")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per response")
+    parser.add_argument("--recordings", default=CACHE_DIR, help="directory of the recorded responses")
+    parser.add_argument("--record", action="store_true", help="forward queries without a recording to Wikidata and record them")
+    args = parser.parse_args(argv)
+    run_standin(args.port, args.latency, args.recordings, args.record)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])